@@ -0,0 +1,199 @@
+import asyncio
+import datetime
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+
+from sqlalchemy import func
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from . import database, migrate, models, shared_state
+
+logger = logging.getLogger(__name__)
+
+# Cold storage for chat history. Sessions with no messages for ARCHIVE_AFTER_DAYS have their
+# rows moved into one compressed blob in chat_archives (zstd when the zstandard package is
+# installed, gzip otherwise). The first /llm/chat turn on an archived session puts the rows
+# back with their original ids, so cursors and summary_upto_id stay valid. compact() then
+# runs VACUUM/ANALYZE to hand the freed pages back to the filesystem.
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def compress(raw: bytes) -> tuple:
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(raw)
+    return "gzip", gzip.compress(raw, compresslevel=6)
+
+
+def decompress(codec: str, payload: bytes) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Archive was written with zstd; install the zstandard package to read it")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return gzip.decompress(payload)
+
+
+def archived_messages(archive: models.ChatArchive) -> list:
+    rows = json.loads(decompress(archive.codec, archive.payload))
+    for row in rows:
+        row["session_id"] = archive.session_id
+        row.setdefault("job_id", None) # archived before job ids were kept
+        row["timestamp"] = datetime.datetime.fromisoformat(row["timestamp"]) if row["timestamp"] else None
+    return rows
+
+
+def archive_session(db: Session, session: models.StudySession) -> dict:
+    messages = db.query(models.ChatMessage).filter(
+        models.ChatMessage.session_id == session.id
+    ).order_by(models.ChatMessage.id).all()
+    if not messages:
+        return None
+    raw = json.dumps([
+        {"id": m.id, "role": m.role, "content": m.content, "timestamp": m.timestamp.isoformat() if m.timestamp else None,
+         "job_id": m.job_id}
+        for m in messages
+    ]).encode()
+    codec, payload = compress(raw)
+    db.add(models.ChatArchive(session_id=session.id, codec=codec, payload=payload,
+                              message_count=len(messages), raw_bytes=len(raw)))
+    # Only what went into the blob: a message written since the select stays live (rehydrate merges)
+    db.query(models.ChatMessage).filter(
+        models.ChatMessage.session_id == session.id, models.ChatMessage.id <= messages[-1].id
+    ).delete(synchronize_session=False)
+    session.archived_at = datetime.datetime.utcnow()
+    return {"messages": len(messages), "raw_bytes": len(raw), "compressed_bytes": len(payload)}
+
+
+def rehydrate(db: Session, session: models.StudySession) -> int:
+    # Async callers: await db.run_sync(archive.rehydrate, session)
+    if session.archived_at is None:
+        return 0
+    archive = db.get(models.ChatArchive, session.id)
+    restored = 0
+    if archive is not None:
+        rows = archived_messages(archive)
+        db.bulk_insert_mappings(models.ChatMessage, rows)
+        db.delete(archive)
+        restored = len(rows)
+    session.archived_at = None
+    db.flush()
+    return restored
+
+
+def archive_inactive(db: Session, older_than: datetime.timedelta, batch: int = 100) -> dict:
+    cutoff = datetime.datetime.utcnow() - older_than
+    totals = {"sessions": 0, "messages": 0, "raw_bytes": 0, "compressed_bytes": 0}
+    while True:
+        session_ids = [row[0] for row in db.query(models.ChatMessage.session_id).join(
+            models.StudySession, models.StudySession.id == models.ChatMessage.session_id
+        ).filter(models.StudySession.archived_at.is_(None)).group_by(
+            models.ChatMessage.session_id
+        ).having(func.max(models.ChatMessage.timestamp) < cutoff).limit(batch).all()]
+        if not session_ids:
+            return totals
+        # One transaction per batch keeps the writer lock short
+        for session in db.query(models.StudySession).filter(models.StudySession.id.in_(session_ids)).all():
+            result = archive_session(db, session)
+            if result:
+                totals["sessions"] += 1
+                for key in ("messages", "raw_bytes", "compressed_bytes"):
+                    totals[key] += result[key]
+        db.commit()
+
+
+def storage_stats(conn) -> dict:
+    if conn.dialect.name == "sqlite":
+        page_size = conn.exec_driver_sql("PRAGMA page_size").scalar()
+        pages = conn.exec_driver_sql("PRAGMA page_count").scalar()
+        free = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+        return {"bytes": pages * page_size, "free_bytes": free * page_size}
+    return {"bytes": conn.exec_driver_sql("SELECT pg_database_size(current_database())").scalar(), "free_bytes": None}
+
+
+def compact(engine: Engine = None) -> dict:
+    # VACUUM can't run inside a transaction. On the writer engine it also queues behind
+    # (and blocks) application writes, so schedule it for quiet hours.
+    engine = engine or database.engine
+    started = time.perf_counter()
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        before = storage_stats(conn)
+        if conn.dialect.name == "sqlite":
+            conn.exec_driver_sql("VACUUM")
+            conn.exec_driver_sql("ANALYZE")
+            # Returns a row; close it, or the statement stays open on the pooled writer connection
+            conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)").close()
+        else:
+            conn.exec_driver_sql("VACUUM ANALYZE")
+        after = storage_stats(conn)
+    return {
+        "bytes_before": before["bytes"],
+        "bytes_after": after["bytes"],
+        "reclaimed_bytes": before["bytes"] - after["bytes"],
+        "free_bytes_before": before["free_bytes"],
+        "duration_s": round(time.perf_counter() - started, 3),
+    }
+
+
+def run_maintenance(older_than_days: float = None) -> dict:
+    days = older_than_days if older_than_days is not None else float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+    db = database.SessionLocal()
+    try:
+        archived = archive_inactive(db, datetime.timedelta(days=days))
+    finally:
+        db.close()
+    finished_at = datetime.datetime.utcnow()
+    report = {
+        "finished_at": finished_at.isoformat(),
+        "archived": archived,
+        "compaction": compact(),
+    }
+    # Stored, so /analytics/storage sees runs made by any worker or by the cron CLI
+    db = database.SessionLocal()
+    try:
+        db.add(models.MaintenanceRun(finished_at=finished_at, report=json.dumps(report)))
+        db.commit()
+    finally:
+        db.close()
+    logger.info("Chat archival and compaction: %s", report)
+    return report
+
+
+def last_report(db: Session):
+    run = db.query(models.MaintenanceRun).order_by(models.MaintenanceRun.id.desc()).first()
+    return json.loads(run.report) if run else None
+
+
+async def periodic_maintenance(interval_seconds: float):
+    # Started from the app lifespan when ARCHIVE_INTERVAL_SECONDS > 0. Every worker runs the
+    # loop, but only the holder of the shared "archive" lease does the work each interval.
+    state = shared_state.get_state()
+    holder = shared_state.holder_id()
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            if await asyncio.to_thread(state.acquire, "archive", holder, 1, interval_seconds * 2):
+                await asyncio.to_thread(run_maintenance)
+        except Exception:
+            logger.exception("Chat archival failed")
+
+
+if __name__ == "__main__":
+    # python -m app.archive run [--older-than-days N] | compact
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    migrate.run()
+    if command == "run":
+        days = float(sys.argv[3]) if sys.argv[2:3] == ["--older-than-days"] else None
+        print(json.dumps(run_maintenance(days), indent=2))
+    elif command == "compact":
+        print(json.dumps(compact(), indent=2))
+    else:
+        print("usage: python -m app.archive run [--older-than-days N] | compact")
+        sys.exit(2)
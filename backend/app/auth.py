@@ -4,16 +4,39 @@ from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from . import schemas, database, models
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+from concurrent.futures import ThreadPoolExecutor
+from . import schemas, database, models, shared_state
+import asyncio
+import os
+import threading
+import time
 
 # Secret key to sign JWTs (should be env variable in prod)
 SECRET_KEY = "supersecretkey" # TODO: Change this
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-# Changed to argon2
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+# Principal resolution: cache the user row per token subject for a short TTL, or with
+# AUTH_TRUST_TOKEN_CLAIMS=1 build the principal straight from the signed token claims.
+PRINCIPAL_CACHE_TTL = float(os.getenv("AUTH_PRINCIPAL_CACHE_TTL", "30"))
+TRUST_TOKEN_CLAIMS = os.getenv("AUTH_TRUST_TOKEN_CLAIMS", "0") == "1"
+PRINCIPAL_FIELDS = ("id", "username", "email", "role", "is_active")
+
+# Changed to argon2. Cost parameters are tunable; hashes made with other parameters
+# are flagged by deprecated="auto" and upgraded on the next successful login.
+ARGON2_TIME_COST = int(os.getenv("AUTH_ARGON2_TIME_COST", "3"))
+ARGON2_MEMORY_COST = int(os.getenv("AUTH_ARGON2_MEMORY_COST", "65536")) # KiB
+ARGON2_PARALLELISM = int(os.getenv("AUTH_ARGON2_PARALLELISM", "4"))
+
+pwd_context = CryptContext(
+    schemes=["argon2"],
+    deprecated="auto",
+    argon2__rounds=ARGON2_TIME_COST,
+    argon2__memory_cost=ARGON2_MEMORY_COST,
+    argon2__parallelism=ARGON2_PARALLELISM,
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/token")
 
 def verify_password(plain_password, hashed_password):
@@ -22,17 +45,132 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+class PasswordHasherPool:
+    # argon2-cffi releases the GIL while hashing, so a dedicated thread pool gives real
+    # parallelism without competing with the request threadpool. Work beyond
+    # workers + max_queue is rejected with a 503 instead of queueing indefinitely.
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.pending = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="argon2")
+
+    async def run(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Authentication service is busy, please retry shortly",
+                    headers={"Retry-After": "1"},
+                )
+            self.pending += 1
+        try:
+            return await asyncio.wrap_future(self._executor.submit(fn, *args))
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+_hasher_pool: Optional[PasswordHasherPool] = None
+
+def get_hasher_pool() -> PasswordHasherPool:
+    global _hasher_pool
+    if _hasher_pool is None:
+        workers = int(os.getenv("AUTH_HASH_WORKERS", str(os.cpu_count() or 1)))
+        _hasher_pool = PasswordHasherPool(workers, int(os.getenv("AUTH_HASH_QUEUE", str(workers * 4))))
+    return _hasher_pool
+
+def set_hasher_pool(pool: Optional[PasswordHasherPool]):
+    global _hasher_pool
+    _hasher_pool = pool
+
+async def verify_password_async(plain_password, hashed_password):
+    # Returns (verified, new_hash); new_hash is set when the stored hash uses outdated parameters
+    return await get_hasher_pool().run(pwd_context.verify_and_update, plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    return await get_hasher_pool().run(pwd_context.hash, password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.now(timezone.utc) + expires_delta
     else:
         expire = datetime.now(timezone.utc) + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "iat": int(time.time())})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
+_principal_cache = {} # username -> (expires_at, snapshot dict)
+_principal_cache_version = 0 # shared "principals" version the local cache was filled under
+_principal_lock = threading.Lock()
+principal_stats = {"cache_hits": 0, "db_lookups": 0, "token_claims": 0, "invalidations": 0}
+
+def principal_claims(user: models.User) -> dict:
+    # Signed claims that let get_current_user skip the DB when TRUST_TOKEN_CLAIMS is on
+    return {"sub": user.username, "uid": user.id, "email": user.email, "role": user.role, "active": user.is_active}
+
+def _principal(snapshot: dict) -> models.User:
+    # Detached User carrying only the principal fields; routes read id/role/is_active from it
+    user = models.User(**snapshot)
+    make_transient_to_detached(user)
+    return user
+
+def invalidate_principal(username: Optional[str] = None):
+    # Other workers notice the bumped version and drop their cached principals; the change
+    # time outlives any token issued before it, so stale claims are refused everywhere
+    state = shared_state.get_state()
+    with _principal_lock:
+        if username is None:
+            _principal_cache.clear()
+        else:
+            _principal_cache.pop(username, None)
+            state.set(f"principal_changed:{username}", str(time.time()), ttl=ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+        principal_stats["invalidations"] += 1
+    state.bump("principals")
+
+@event.listens_for(Session, "after_flush")
+def _collect_changed_principals(session, flush_context):
+    changed = session.info.setdefault("principals_changed", set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, models.User):
+            continue
+        state = inspect(obj)
+        if obj in session.deleted or any(state.attrs[field].history.has_changes() for field in PRINCIPAL_FIELDS):
+            changed.update(set(state.attrs.username.history.deleted) | {obj.username})
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_principals_after_commit(session):
+    # After the commit, as in entitlements: a request that re-caches in between reads the new row
+    for username in session.info.pop("principals_changed", ()):
+        invalidate_principal(username)
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_principals_on_rollback(session, previous_transaction):
+    session.info.pop("principals_changed", None)
+
+def principal_cache_snapshot() -> dict:
+    return {**principal_stats, "entries": len(_principal_cache), "trust_token_claims": TRUST_TOKEN_CLAIMS}
+
+def _principal_from_claims(payload: dict) -> Optional[models.User]:
+    if not TRUST_TOKEN_CLAIMS or "uid" not in payload or "active" not in payload:
+        return None
+    # A role/active change after the token was issued means its claims are stale
+    changed_at = shared_state.get_state().cached_get(f"principal_changed:{payload['sub']}")
+    if changed_at is not None and float(changed_at) >= payload.get("iat", 0):
+        return None
+    principal_stats["token_claims"] += 1
+    return _principal({
+        "id": payload["uid"],
+        "username": payload["sub"],
+        "email": payload.get("email"),
+        "role": payload.get("role"),
+        "is_active": payload["active"],
+    })
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_read_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -46,9 +184,32 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
         token_data = schemas.TokenData(username=username)
     except JWTError:
         raise credentials_exception
+
+    principal = _principal_from_claims(payload)
+    if principal is not None:
+        return principal
+
+    global _principal_cache_version
+    version = shared_state.get_state().cached_version("principals")
+    if version != _principal_cache_version:
+        with _principal_lock:
+            _principal_cache.clear()
+            _principal_cache_version = version
+
+    now = time.monotonic()
+    cached = _principal_cache.get(token_data.username)
+    if cached and cached[0] > now:
+        principal_stats["cache_hits"] += 1
+        return _principal(cached[1])
+
+    principal_stats["db_lookups"] += 1
     user = db.query(models.User).filter(models.User.username == token_data.username).first()
     if user is None:
         raise credentials_exception
+    if PRINCIPAL_CACHE_TTL > 0:
+        snapshot = {field: getattr(user, field) for field in PRINCIPAL_FIELDS}
+        with _principal_lock:
+            _principal_cache[token_data.username] = (now + PRINCIPAL_CACHE_TTL, snapshot)
     return user
 
 def get_current_active_user(current_user: models.User = Depends(get_current_user)):
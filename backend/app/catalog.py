@@ -0,0 +1,49 @@
+import hashlib
+import json
+import threading
+from typing import Tuple
+
+from sqlalchemy.orm import Session
+
+from . import models, schemas, shared_state
+
+# GET /courses is public and read-mostly, so the serialised catalogue is built once per
+# version and served from memory. Writers bump the version via invalidate(); the version
+# lives in shared state so a write in one worker invalidates every worker's copy.
+_lock = threading.Lock()
+_built_version = -1
+_body = b"[]"
+_etag = ""
+
+
+def invalidate():
+    shared_state.get_state().bump("catalog")
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def get_catalog(db: Session) -> Tuple[bytes, str]:
+    global _built_version, _body, _etag
+    version = shared_state.get_state().cached_version("catalog")
+    if _built_version == version:
+        return _body, _etag
+    with _lock:
+        if _built_version == version:
+            return _body, _etag
+        # The version was read first: a write landing mid-build leaves us stale and rebuilt next time
+        courses = db.query(models.Course).order_by(models.Course.id).all()
+        payload = [schemas.CourseResponse.model_validate(course).model_dump() for course in courses]
+        _body = json.dumps(payload, separators=(",", ":")).encode()
+        _etag = make_etag(_body)
+        _built_version = version
+        return _body, _etag
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    # Weak comparison (RFC 9110): compressed responses carry W/"..." for the same representation
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag.removeprefix("W/") in candidates
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import os
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import database, models, llm_providers, retrieval, entitlements
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_PROMPT = "You are an elite AI Study Assistant. Your goal is to help students learn faster, explain complex topics simply, and provide study plans. Be encouraging, concise, and professional."
+SYSTEM_ACK = "Understood. I am ready to assist with any study inquiries."
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a tutoring conversation. Merge the new turns into the "
+    "existing summary. Keep facts the student shared, goals, decisions and open questions. "
+    "Reply with the updated summary only, in at most {max_words} words."
+)
+
+# Fetch history in pages so a long session never loads more rows than the budget needs
+PAGE_SIZE = 50
+
+_summarising = set()
+
+
+estimate_tokens = llm_providers.estimate_tokens
+
+
+def context_token_budget() -> int:
+    return int(os.getenv("LLM_CONTEXT_TOKEN_BUDGET", "3000"))
+
+
+async def select_recent_messages(db: AsyncSession, session: models.StudySession, budget: int):
+    """Newest turns that fit in `budget` tokens, oldest first.
+
+    Returns (messages, has_unsummarised_overflow). The newest message is always included.
+    """
+    selected = []
+    used = 0
+    before_id = None
+    floor_id = session.summary_upto_id or 0
+    while True:
+        query = select(models.ChatMessage).where(
+            models.ChatMessage.session_id == session.id,
+            models.ChatMessage.id > floor_id,
+        )
+        if before_id is not None:
+            query = query.where(models.ChatMessage.id < before_id)
+        page = (await db.execute(query.order_by(models.ChatMessage.id.desc()).limit(PAGE_SIZE))).scalars().all()
+        for msg in page:
+            cost = estimate_tokens(msg.content)
+            if selected and used + cost > budget:
+                selected.reverse()
+                return selected, True
+            selected.append(msg)
+            used += cost
+        if len(page) < PAGE_SIZE:
+            selected.reverse()
+            return selected, False
+        before_id = page[-1].id
+
+
+def build_history(session: models.StudySession, messages: list, course_context: str = "") -> list:
+    # Summary and any other injected context live in the first (system) entry
+    system_text = SYSTEM_PROMPT
+    if course_context:
+        system_text += f"\n\nRelevant course material (cite it when it helps):\n{course_context}"
+    if session.summary:
+        system_text += f"\n\nSummary of the earlier conversation:\n{session.summary}"
+    history = [
+        {"role": "user", "parts": [system_text]},
+        {"role": "model", "parts": [SYSTEM_ACK]},
+    ]
+    for msg in messages:
+        role = "user" if msg.role == "user" else "model"
+        history.append({"role": role, "parts": [msg.content]})
+    return history
+
+
+async def retrieve_course_context(db: AsyncSession, user: models.User, query: str) -> str:
+    # Top-k chunks from the courses this user can read; empty when nothing scores
+    k = int(os.getenv("RETRIEVAL_TOP_K", "3"))
+    if k <= 0:
+        return ""
+    if user.role in [models.UserRole.ADMIN, models.UserRole.OWNER]:
+        course_ids = (await db.execute(select(models.Course.id))).scalars().all()
+    else:
+        course_ids = await db.run_sync(entitlements.enrolled_course_ids, user.id)
+    if not course_ids:
+        return ""
+    # Off the event loop: a reload after another worker's change reads the index from disk,
+    # and scoring is numpy work
+    chunks = await asyncio.to_thread(lambda: retrieval.get_index().search(query, course_ids, k))
+    return retrieval.format_context(chunks)
+
+
+async def refresh_summary(session_id: int, window_start_id: int):
+    """Fold turns older than the current context window into the session's rolling summary.
+
+    Runs as a background task after the reply is sent, on its own session. Each run only
+    reads turns newer than summary_upto_id, capped at LLM_SUMMARY_BATCH_TOKENS, so cost per
+    run stays bounded.
+    """
+    if session_id in _summarising:
+        return
+    _summarising.add(session_id)
+    try:
+        async with database.get_async_sessionmaker()() as db:
+            await _refresh_summary(db, session_id, window_start_id)
+    finally:
+        _summarising.discard(session_id)
+
+
+async def _refresh_summary(db: AsyncSession, session_id: int, window_start_id: int):
+    session = await db.get(models.StudySession, session_id)
+    if session is None:
+        return
+    batch_budget = int(os.getenv("LLM_SUMMARY_BATCH_TOKENS", "4000"))
+    pending = (await db.execute(
+        select(models.ChatMessage).where(
+            models.ChatMessage.session_id == session_id,
+            models.ChatMessage.id > (session.summary_upto_id or 0),
+            models.ChatMessage.id < window_start_id,
+        ).order_by(models.ChatMessage.id.asc()).limit(PAGE_SIZE)
+    )).scalars().all()
+
+    batch = []
+    used = 0
+    for msg in pending:
+        cost = estimate_tokens(msg.content)
+        if batch and used + cost > batch_budget:
+            break
+        batch.append(msg)
+        used += cost
+    if not batch or used < int(os.getenv("LLM_SUMMARY_MIN_TOKENS", "200")):
+        return
+
+    transcript = "\n".join(f"{'Student' if m.role == 'user' else 'Assistant'}: {m.content}" for m in batch)
+    prompt = [
+        {"role": "user", "parts": [SUMMARY_PROMPT.format(max_words=int(os.getenv("LLM_SUMMARY_MAX_WORDS", "250")))]},
+        {"role": "model", "parts": ["Understood."]},
+        {"role": "user", "parts": [f"Existing summary:\n{session.summary or '(none)'}\n\nNew turns:\n{transcript}"]},
+    ]
+    try:
+        summary = await llm_providers.generate(prompt)
+    except Exception:
+        logger.warning("Summarising session %s failed", session_id, exc_info=True)
+        return
+    session.summary = summary
+    session.summary_upto_id = batch[-1].id
+    await db.commit()
@@ -0,0 +1,278 @@
+import hashlib
+import io
+import os
+import sys
+import tempfile
+import threading
+from typing import Iterator, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm.attributes import flag_modified
+
+from . import database, models
+
+# Content bodies larger than CONTENT_INLINE_MAX_BYTES live in a blob store instead of the
+# contents.data column. Blobs are content-addressed (key = sha256 of the body), so the
+# digest doubles as the ETag, identical lesson bodies are stored once and a blob written by
+# a transaction that later rolls back is harmless. Every row records size and sha256;
+# listings return those, and GET /courses/{id}/content/{content_id}/body streams the body.
+#
+#     CONTENT_STORE_URL=file://./content_store         (default) local directory
+#     CONTENT_STORE_URL=s3://bucket/prefix             S3 or any S3-compatible endpoint
+#                                                      (CONTENT_STORE_S3_ENDPOINT, boto3 required)
+#
+#     python -m app.content_store migrate              move existing inline bodies out
+
+INLINE_MAX_BYTES = int(os.getenv("CONTENT_INLINE_MAX_BYTES", "2048"))
+CHUNK_BYTES = 64 * 1024
+
+
+class BlobNotFound(Exception):
+    pass
+
+
+class BlobStore:
+    def put(self, key: str, body: bytes):
+        raise NotImplementedError
+
+    def get(self, key: str) -> bytes:
+        return b"".join(self.iter_range(key, 0, None))
+
+    def iter_range(self, key: str, start: int, end: Optional[int]) -> Iterator[bytes]:
+        # Bytes start..end inclusive (end=None: to the end of the blob), in CHUNK_BYTES pieces
+        raise NotImplementedError
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+
+class LocalBlobStore(BlobStore):
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split("/"))
+
+    def put(self, key, body):
+        path = self.path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so readers never see a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+
+    def iter_range(self, key, start, end):
+        try:
+            f = open(self.path(key), "rb")
+        except FileNotFoundError:
+            raise BlobNotFound(key)
+        with f:
+            f.seek(start)
+            remaining = None if end is None else end - start + 1
+            while remaining is None or remaining > 0:
+                chunk = f.read(CHUNK_BYTES if remaining is None else min(CHUNK_BYTES, remaining))
+                if not chunk:
+                    return
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+
+class S3BlobStore(BlobStore):
+    # Talks to anything with the boto3 S3 client's put_object/get_object/head_object calls:
+    # AWS, MinIO, or LocalS3Client below for tests and development
+    def __init__(self, client, bucket: str, prefix: str = ""):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+
+    def put(self, key, body):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=body)
+
+    def iter_range(self, key, start, end):
+        byte_range = f"bytes={start}-{'' if end is None else end}"
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key, Range=byte_range)
+        except Exception as e:
+            if _is_missing(e):
+                raise BlobNotFound(key) from e
+            raise
+        body = response["Body"]
+        try:
+            while True:
+                chunk = body.read(CHUNK_BYTES)
+                if not chunk:
+                    return
+                yield chunk
+        finally:
+            body.close()
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+            return True
+        except Exception as e:
+            if _is_missing(e):
+                return False
+            raise
+
+
+def _is_missing(error: Exception) -> bool:
+    code = getattr(error, "response", {}).get("Error", {}).get("Code")
+    return isinstance(error, KeyError) or code in ("404", "NoSuchKey", "NotFound")
+
+
+class LocalS3Client:
+    # Filesystem stand-in for the subset of the S3 API that S3BlobStore uses
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split("/"))
+
+    def put_object(self, Bucket, Key, Body):
+        LocalBlobStore(os.path.join(self.root, Bucket)).put(Key, Body)
+
+    def head_object(self, Bucket, Key):
+        path = self._path(Bucket, Key)
+        if not os.path.exists(path):
+            raise KeyError(Key)
+        return {"ContentLength": os.path.getsize(path)}
+
+    def get_object(self, Bucket, Key, Range=None):
+        path = self._path(Bucket, Key)
+        if not os.path.exists(path):
+            raise KeyError(Key)
+        f = open(path, "rb")
+        if Range:
+            start, _, end = Range.removeprefix("bytes=").partition("-")
+            f.seek(int(start))
+            data = f.read(int(end) - int(start) + 1) if end else f.read()
+            f.close()
+            return {"Body": io.BytesIO(data)}
+        return {"Body": f}
+
+
+def create_store(url: Optional[str] = None) -> BlobStore:
+    url = url or os.getenv("CONTENT_STORE_URL", "file://./content_store")
+    if url.startswith("file://"):
+        return LocalBlobStore(url[len("file://"):])
+    if url.startswith("s3://"):
+        import boto3 # only needed for the S3 backend
+
+        bucket, _, prefix = url[len("s3://"):].partition("/")
+        client = boto3.client("s3", endpoint_url=os.getenv("CONTENT_STORE_S3_ENDPOINT") or None)
+        return S3BlobStore(client, bucket, prefix)
+    raise ValueError(f"Unsupported CONTENT_STORE_URL '{url}'")
+
+
+_store: Optional[BlobStore] = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> BlobStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = create_store()
+    return _store
+
+
+def set_store(store: Optional[BlobStore]):
+    global _store
+    _store = store
+
+
+def blob_key(sha256: str) -> str:
+    return f"content/{sha256[:2]}/{sha256}"
+
+
+def prepare(values: dict) -> dict:
+    # For Core inserts (bulk import): fills size/sha256 and moves a large body to the store
+    body = (values.get("data") or "").encode()
+    digest = hashlib.sha256(body).hexdigest()
+    values.update(size=len(body), sha256=digest, blob_key=None)
+    if len(body) > INLINE_MAX_BYTES:
+        get_store().put(blob_key(digest), body)
+        values.update(data=None, blob_key=blob_key(digest))
+    return values
+
+
+def body_bytes(content: models.Content) -> bytes:
+    if content.blob_key:
+        return get_store().get(content.blob_key)
+    return (content.data or "").encode()
+
+
+def body_text(content: models.Content) -> str:
+    return body_bytes(content).decode()
+
+
+def etag(content: models.Content) -> str:
+    # Rows written before size/sha256 existed get theirs on the next `migrate`
+    return '"' + (content.sha256 or hashlib.sha256(body_bytes(content)).hexdigest()) + '"'
+
+
+def iter_body(content: models.Content, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+    if content.blob_key:
+        yield from get_store().iter_range(content.blob_key, start, end)
+        return
+    body = (content.data or "").encode()
+    stop = len(body) if end is None else end + 1
+    for offset in range(start, stop, CHUNK_BYTES):
+        yield body[offset:min(offset + CHUNK_BYTES, stop)]
+
+
+@event.listens_for(models.Content, "before_insert")
+@event.listens_for(models.Content, "before_update")
+def _offload_body(mapper, connection, content):
+    # ORM writes (admin endpoints, seed) go through the same path as bulk imports
+    if content.data is None and content.blob_key:
+        return
+    values = prepare({"data": content.data})
+    content.data, content.size, content.sha256, content.blob_key = (
+        values["data"], values["size"], values["sha256"], values["blob_key"]
+    )
+
+
+def migrate_inline(batch: int = 200) -> dict:
+    # Backfill size/sha256 and move oversized inline bodies out, one transaction per batch
+    moved = hashed = 0
+    last_id = 0
+    db = database.SessionLocal()
+    try:
+        while True:
+            rows = db.query(models.Content).filter(
+                models.Content.id > last_id, models.Content.sha256.is_(None)
+            ).order_by(models.Content.id).limit(batch).all()
+            if not rows:
+                break
+            for content in rows:
+                flag_modified(content, "data") # so before_update runs
+                moved += content.data is not None and len(content.data.encode()) > INLINE_MAX_BYTES
+                hashed += 1
+            last_id = rows[-1].id
+            db.commit()
+    finally:
+        db.close()
+    return {"rows_hashed": hashed, "bodies_moved": moved}
+
+
+if __name__ == "__main__":
+    # python -m app.content_store migrate
+    if sys.argv[1:] != ["migrate"]:
+        print("usage: python -m app.content_store migrate")
+        sys.exit(2)
+    from . import migrate
+
+    migrate.run()
+    print(migrate_inline())
+    print("Run `python -m app.archive compact` to return the freed pages to the filesystem.")
@@ -1,16 +1,93 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 import os
 
+from . import metrics
+
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./study_app.db")
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+# Storage profile (SQLite only). "production" enables WAL so readers don't block on writers,
+# and splits connections into writer pools of one plus a pool of read-only readers. Each process
+# has two writers, the sync engine's and the async engine's (and more processes add theirs):
+# each pool queues its own callers, and SQLite's write lock plus busy_timeout arbitrates between
+# pools. A transaction that reads before its first write can still get "database is locked"
+# without waiting, when another writer commits in between (WAL can't upgrade a stale snapshot).
+# Each pragma can be overridden with SQLITE_<NAME>, e.g. SQLITE_BUSY_TIMEOUT=10000.
+DB_PROFILE = os.getenv("DB_PROFILE", "default")
+SQLITE_PROFILES = {
+    "default": {},
+    "production": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000, # ms
+        "cache_size": -65536, # negative = KiB, i.e. 64 MiB per connection
+        "mmap_size": 268435456, # 256 MiB
+        "temp_store": "MEMORY",
+    },
+}
+
+def sqlite_pragmas(profile: str) -> dict:
+    pragmas = dict(SQLITE_PROFILES[profile])
+    for name in ("journal_mode", "synchronous", "busy_timeout", "cache_size", "mmap_size", "temp_store"):
+        override = os.getenv(f"SQLITE_{name.upper()}")
+        if override is not None:
+            pragmas[name] = override
+    return pragmas
+
+def is_sqlite_file(url: str) -> bool:
+    parsed = make_url(url)
+    return parsed.get_backend_name() == "sqlite" and parsed.database not in (None, "", ":memory:")
+
+def read_only_url(url: str) -> str:
+    # sqlite:///./app.db -> sqlite:///file:./app.db?mode=ro&uri=true
+    parsed = make_url(url)
+    return str(parsed.set(database=f"file:{parsed.database}", query={"mode": "ro", "uri": "true"}))
+
+def apply_pragmas(sync_engine, pragmas: dict):
+    if not pragmas:
+        return
+
+    @event.listens_for(sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+def engine_options(url: str, role: str) -> dict:
+    # role: "write" or "read"
+    if not (is_sqlite_file(url) and DB_PROFILE == "production"):
+        return {}
+    if role == "write":
+        # A single connection per engine: this engine's writers queue in the pool rather than on the file lock
+        return {"pool_size": 1, "max_overflow": 0, "pool_timeout": float(os.getenv("DB_WRITE_POOL_TIMEOUT", "30"))}
+    size = int(os.getenv("DB_READ_POOL_SIZE", str(os.cpu_count() or 1)))
+    return {"pool_size": size, "max_overflow": size}
+
+def create_sqlite_aware_engine(url: str, role: str = "write", **kwargs):
+    connect_args = {"check_same_thread": False} if make_url(url).get_backend_name() == "sqlite" else {}
+    engine = create_engine(url, connect_args=connect_args, **engine_options(url, role), **kwargs)
+    if make_url(url).get_backend_name() == "sqlite":
+        apply_pragmas(engine, sqlite_pragmas(DB_PROFILE))
+    metrics.instrument_engine(engine, role)
+    return engine
+
+def read_replica_url(url: str):
+    # Separate read-only connections only make sense for a SQLite file under the production profile
+    if is_sqlite_file(url) and DB_PROFILE == "production":
+        return read_only_url(url)
+    return None
+
+engine = create_sqlite_aware_engine(SQLALCHEMY_DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+_read_url = read_replica_url(SQLALCHEMY_DATABASE_URL)
+read_engine = create_sqlite_aware_engine(_read_url, role="read") if _read_url else engine
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
 Base = declarative_base()
 
 def get_db():
@@ -19,3 +96,98 @@ def get_db():
         yield db
     finally:
         db.close()
+
+def get_read_db():
+    # For endpoints that never write; served by the read-only pool when one is configured
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+# Async engine for routers running on the event loop (aiosqlite locally, asyncpg for Postgres).
+# Created on first use so scripts that only need the sync engine (seed_roles.py, seed_user.py)
+# don't require the async drivers.
+def to_async_url(url: str) -> str:
+    if url.startswith("sqlite:"):
+        return "sqlite+aiosqlite:" + url[len("sqlite:"):]
+    if url.startswith("postgres://"):
+        return "postgresql+asyncpg://" + url[len("postgres://"):]
+    if url.startswith("postgresql://") or url.startswith("postgresql+psycopg2://"):
+        return "postgresql+asyncpg://" + url.split("://", 1)[1]
+    return url
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", to_async_url(SQLALCHEMY_DATABASE_URL))
+
+async_engine = None
+AsyncSessionLocal = None
+async_read_engine = None
+AsyncReadSessionLocal = None
+
+def _create_async_engine(url: str, role: str):
+    from sqlalchemy.ext.asyncio import create_async_engine
+    engine = create_async_engine(url, **engine_options(url, role))
+    if make_url(url).get_backend_name() == "sqlite":
+        apply_pragmas(engine.sync_engine, sqlite_pragmas(DB_PROFILE))
+    metrics.instrument_engine(engine.sync_engine, f"async_{role}")
+    return engine
+
+def get_async_sessionmaker():
+    global async_engine, AsyncSessionLocal
+    if AsyncSessionLocal is None:
+        from sqlalchemy.ext.asyncio import async_sessionmaker
+        async_engine = _create_async_engine(ASYNC_DATABASE_URL, "write")
+        # expire_on_commit=False: attributes stay readable after commit without an implicit (sync) refresh
+        AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False, autoflush=False)
+    return AsyncSessionLocal
+
+def get_async_read_sessionmaker():
+    global async_read_engine, AsyncReadSessionLocal
+    if AsyncReadSessionLocal is None:
+        from sqlalchemy.ext.asyncio import async_sessionmaker
+        read_url = read_replica_url(ASYNC_DATABASE_URL)
+        if read_url is None:
+            AsyncReadSessionLocal = get_async_sessionmaker()
+            async_read_engine = async_engine
+        else:
+            async_read_engine = _create_async_engine(read_url, "read")
+            AsyncReadSessionLocal = async_sessionmaker(async_read_engine, expire_on_commit=False, autoflush=False)
+    return AsyncReadSessionLocal
+
+async def get_async_db():
+    async with get_async_sessionmaker()() as db:
+        yield db
+
+async def get_async_read_db():
+    async with get_async_read_sessionmaker()() as db:
+        yield db
+
+def sync_schema(metadata, bind=None):
+    # create_all only creates missing tables, so columns and indexes added to existing
+    # models are applied here with ALTER TABLE ADD COLUMN (new columns must be nullable or defaulted).
+    bind = bind or engine
+    # One connection throughout: the production profile's writer pool holds exactly one
+    with bind.begin() as conn:
+        metadata.create_all(bind=conn)
+        inspector = inspect(conn)
+        for table in metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=conn.dialect)
+                default = ""
+                if column.default is not None and column.default.is_scalar:
+                    default = f" DEFAULT {_sql_literal(column.default.arg)}"
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {column_type}{default}'))
+        # Likewise, indexes declared on tables that already existed
+        for table in metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
+
+def _sql_literal(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'" + str(value).replace("'", "''") + "'"
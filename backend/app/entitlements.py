@@ -0,0 +1,102 @@
+import os
+import threading
+import time
+from typing import FrozenSet, Optional
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from . import models, shared_state
+
+# "Which courses can this user open?" is answered once per user and cached in-process for
+# ENTITLEMENT_CACHE_TTL seconds. Enrollment inserts/deletes and role changes invalidate the
+# user's entry after commit; the invalidation is a shared-state version bump, so every
+# worker drops its copy (within SHARED_STATE_CACHE_SECONDS). Admins and owners can open
+# everything and are never cached.
+
+PRIVILEGED_ROLES = (models.UserRole.ADMIN, models.UserRole.OWNER)
+CACHE_TTL = float(os.getenv("ENTITLEMENT_CACHE_TTL", "300"))
+
+_cache = {} # user_id -> (expires_at, shared version, frozenset of course ids)
+_lock = threading.Lock()
+stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+
+def is_privileged(user: models.User) -> bool:
+    return user.role in PRIVILEGED_ROLES
+
+
+def cached_course_ids(user_id: int) -> Optional[FrozenSet[int]]:
+    # None when this process has no current entry for the user
+    entry = _cache.get(user_id)
+    if entry is None or entry[0] <= time.monotonic():
+        return None
+    if entry[1] != current_version(user_id):
+        return None
+    stats["hits"] += 1
+    return entry[2]
+
+
+def current_version(user_id: int) -> int:
+    return shared_state.get_state().cached_version(f"entitlements:{user_id}")
+
+
+def remember(user_id: int, course_ids, version: int) -> FrozenSet[int]:
+    # `version` must be read before the query: an invalidation landing in between then
+    # leaves the entry already outdated rather than hiding the change
+    course_ids = frozenset(course_ids)
+    if CACHE_TTL > 0:
+        with _lock:
+            _cache[user_id] = (time.monotonic() + CACHE_TTL, version, course_ids)
+    return course_ids
+
+
+def enrolled_course_ids(db: Session, user_id: int) -> FrozenSet[int]:
+    # Async callers: await db.run_sync(entitlements.enrolled_course_ids, user_id)
+    cached = cached_course_ids(user_id)
+    if cached is not None:
+        return cached
+    stats["misses"] += 1
+    version = current_version(user_id)
+    return remember(user_id, db.scalars(
+        select(models.Enrollment.course_id).where(models.Enrollment.user_id == user_id)
+    ), version)
+
+
+def can_access(db: Session, user: models.User, course_id: int) -> bool:
+    return is_privileged(user) or course_id in enrolled_course_ids(db, user.id)
+
+
+def invalidate(user_id: int):
+    with _lock:
+        _cache.pop(user_id, None)
+        stats["invalidations"] += 1
+    shared_state.get_state().bump(f"entitlements:{user_id}")
+
+
+def snapshot() -> dict:
+    return {**stats, "entries": len(_cache), "ttl_seconds": CACHE_TTL}
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_changed_users(session, flush_context):
+    changed = session.info.setdefault("entitlements_changed", set())
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, models.Enrollment):
+            changed.add(obj.user_id)
+    for obj in session.dirty:
+        if isinstance(obj, models.User) and inspect(obj).attrs.role.history.has_changes():
+            changed.add(obj.id)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session):
+    # Only once the change is visible to readers; invalidating at flush time would let a
+    # concurrent request re-cache the old state before the commit lands
+    for user_id in session.info.pop("entitlements_changed", ()):
+        invalidate(user_id)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_on_rollback(session, previous_transaction):
+    session.info.pop("entitlements_changed", None)
@@ -0,0 +1,235 @@
+import asyncio
+import codecs
+import csv
+import json
+import os
+from typing import AsyncIterator, Optional
+
+from pydantic import BaseModel, ValidationError, model_validator
+from sqlalchemy import insert, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from . import catalog, content_store, models, retrieval, rollups, schemas, search
+
+# Streaming bulk import for POST /admin/import. The request body is read chunk by chunk
+# and parsed into rows, which are validated as they arrive and inserted in batches with one
+# transaction each, so memory stays flat however large the file is. Rows are either
+#
+#     {"kind": "course", "ref": "algo", "title": ..., "description": ..., "price": 4900, "image_url": ...}
+#     {"kind": "content", "course_ref": "algo", "title": ..., "type": "text", "data": ...}
+#
+# as NDJSON, or the same fields as CSV columns (header row first, unused cells empty).
+# Content points at a course created earlier in the same import (course_ref) or at an
+# existing one (course_id). Bad rows are reported by line and skipped.
+
+BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "500"))
+MAX_BATCH_SIZE = 5000
+MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", "100")) # further errors are only counted
+MAX_LINE_BYTES = int(os.getenv("IMPORT_MAX_LINE_BYTES", str(1024 * 1024))) # UTF-8 encoded
+
+
+class CourseRow(schemas.CourseCreate):
+    ref: Optional[str] = None
+
+
+class ContentRow(BaseModel):
+    course_ref: Optional[str] = None
+    course_id: Optional[int] = None
+    title: str
+    type: str
+    data: str
+
+    @model_validator(mode="after")
+    def _one_course(self):
+        if (self.course_ref is None) == (self.course_id is None):
+            raise ValueError("exactly one of course_ref or course_id is required")
+        return self
+
+
+ROW_TYPES = {"course": CourseRow, "content": ContentRow}
+
+
+class RowError(Exception):
+    pass
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]):
+    # Yields (line_number, text) without ever holding more than one line plus one chunk.
+    # Lines are split on the raw bytes so the length limit counts bytes, not characters.
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = b""
+    number = 0
+    async for chunk in chunks:
+        *lines, pending = (pending + chunk).split(b"\n")
+        for line in lines:
+            if len(line) > MAX_LINE_BYTES:
+                raise RowError(f"Line {number + 1} is longer than {MAX_LINE_BYTES} bytes")
+            number += 1
+            yield number, decoder.decode(line).rstrip("\r")
+        if len(pending) > MAX_LINE_BYTES:
+            raise RowError(f"Line {number + 1} is longer than {MAX_LINE_BYTES} bytes")
+    pending = decoder.decode(pending, final=True)
+    if pending.strip():
+        yield number + 1, pending.rstrip("\r")
+
+
+async def iter_ndjson(chunks):
+    async for number, line in iter_lines(chunks):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError as e:
+            yield number, RowError(f"Invalid JSON: {e}")
+
+
+async def iter_csv(chunks):
+    header = None
+    record = start = None
+    async for number, line in iter_lines(chunks):
+        if record is None:
+            record, start = line, number
+        else:
+            record += "\n" + line
+        if record.count('"') % 2:
+            continue # a quoted cell carries on over the next line
+        text, number, record = record, start, None
+        if not text.strip():
+            continue
+        cells = next(csv.reader([text]))
+        if header is None:
+            header = [cell.strip() for cell in cells]
+            continue
+        if len(cells) != len(header):
+            yield number, RowError(f"Expected {len(header)} columns, got {len(cells)}")
+            continue
+        yield number, {key: value for key, value in zip(header, cells) if value != ""}
+
+
+def parse_row(raw) -> BaseModel:
+    if isinstance(raw, RowError):
+        raise raw
+    if not isinstance(raw, dict):
+        raise RowError("Row must be an object")
+    row_type = ROW_TYPES.get(raw.get("kind"))
+    if row_type is None:
+        raise RowError("kind must be 'course' or 'content'")
+    try:
+        return row_type.model_validate({key: value for key, value in raw.items() if key != "kind"})
+    except ValidationError as e:
+        raise RowError("; ".join(f"{'.'.join(map(str, err['loc'])) or 'row'}: {err['msg']}" for err in e.errors()))
+
+
+class ImportJob:
+    def __init__(self, batch_size: int = BATCH_SIZE):
+        self.batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        self.course_refs = {} # ref -> course id, for content later in the file
+        self.known_course_ids = set()
+        self.report = {"rows": 0, "courses_created": 0, "contents_created": 0, "batches": 0, "error_count": 0, "errors": []}
+
+    def error(self, line: int, message: str):
+        self.report["error_count"] += 1
+        if len(self.report["errors"]) < MAX_ERRORS:
+            self.report["errors"].append({"line": line, "error": message})
+
+    def insert_courses(self, db: Session, batch: list) -> tuple:
+        # Sync DB half, run through AsyncSession.run_sync. Courses go first so content in the
+        # same batch can reference them. Returns the content values to insert.
+        courses = [(line, row) for line, row in batch if isinstance(row, CourseRow)]
+        if courses:
+            ids = db.scalars(
+                insert(models.Course).returning(models.Course.id, sort_by_parameter_order=True),
+                [row.model_dump(exclude={"ref"}) for _, row in courses],
+            ).all()
+            for (_, row), course_id in zip(courses, ids):
+                self.known_course_ids.add(course_id)
+                if row.ref is not None:
+                    self.course_refs[row.ref] = course_id
+            rollups.course_created(db, len(ids))
+
+        wanted = {row.course_id for _, row in batch if isinstance(row, ContentRow) and row.course_id is not None}
+        missing = wanted - self.known_course_ids
+        if missing:
+            self.known_course_ids.update(db.scalars(select(models.Course.id).where(models.Course.id.in_(missing))))
+
+        contents, failed = [], []
+        for line, row in batch:
+            if not isinstance(row, ContentRow):
+                continue
+            course_id = self.course_refs.get(row.course_ref) if row.course_ref is not None else row.course_id
+            if course_id is None or course_id not in self.known_course_ids:
+                failed.append((line, f"Unknown course_ref '{row.course_ref}'" if row.course_ref is not None else f"Course {row.course_id} not found"))
+                continue
+            contents.append({"course_id": course_id, "title": row.title, "type": row.type, "data": row.data})
+        return contents, len(courses), failed
+
+    def insert_contents(self, db: Session, contents: list, bodies: list) -> list:
+        # Takes values already through content_store.prepare; returns the Content rows for indexing
+        if not contents:
+            return []
+        ids = db.scalars(insert(models.Content).returning(models.Content.id, sort_by_parameter_order=True), contents).all()
+        contents = [models.Content(id=content_id, **values) for content_id, values in zip(ids, contents)]
+        search.index_contents(db, contents, bodies)
+        return contents
+
+    async def _commit(self, db: AsyncSession, batch: list):
+        # Ref/id bookkeeping is rolled back along with the transaction if it fails
+        refs, known = dict(self.course_refs), set(self.known_course_ids)
+        try:
+            contents, course_count, failed = await db.run_sync(self.insert_courses, batch)
+            bodies = [values["data"] for values in contents]
+            # Hashing and blob writes happen off the event loop
+            contents = await asyncio.to_thread(lambda: [content_store.prepare(values) for values in contents])
+            contents = await db.run_sync(self.insert_contents, contents, bodies)
+            await db.commit()
+            return contents, course_count, failed
+        except SQLAlchemyError:
+            await db.rollback()
+            self.course_refs, self.known_course_ids = refs, known
+            raise
+
+    async def flush(self, db: AsyncSession, batch: list):
+        if not batch:
+            return
+        try:
+            results = [await self._commit(db, batch)]
+        except SQLAlchemyError:
+            # One bad row shouldn't sink the batch: retry row by row to find it
+            results = []
+            for line, row in batch:
+                try:
+                    results.append(await self._commit(db, [(line, row)]))
+                except SQLAlchemyError as e:
+                    self.error(line, f"Database error: {getattr(e, 'orig', None) or e}")
+        self.report["batches"] += 1
+        imported = []
+        for contents, course_count, failed in results:
+            imported.extend(contents)
+            self.report["courses_created"] += course_count
+            self.report["contents_created"] += len(contents)
+            for line, message in failed:
+                self.error(line, message)
+        if any(course_count for _, course_count, _ in results):
+            catalog.invalidate()
+        # Chunking and the index append (file I/O under a lock) run off the event loop
+        await asyncio.to_thread(lambda: retrieval.get_index().add_contents(imported))
+
+    async def run(self, db: AsyncSession, rows) -> dict:
+        batch = []
+        try:
+            async for line, raw in rows:
+                self.report["rows"] += 1
+                try:
+                    batch.append((line, parse_row(raw)))
+                except RowError as e:
+                    self.error(line, str(e))
+                if len(batch) >= self.batch_size:
+                    await self.flush(db, batch)
+                    batch = []
+        except RowError as e: # unrecoverable framing problem, e.g. an oversized line
+            self.error(self.report["rows"] + 1, str(e))
+            self.report["aborted"] = True
+        await self.flush(db, batch)
+        return self.report
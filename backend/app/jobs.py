@@ -0,0 +1,331 @@
+import asyncio
+import importlib
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from typing import Optional
+
+from . import shared_state
+
+logger = logging.getLogger(__name__)
+
+# Durable background jobs, kept in their own SQLite file so they survive restarts and any
+# worker process on the host can pick them up (WAL mode, so not across hosts or network
+# volumes). POST /llm/chat?mode=async stores the user's turn, enqueues a "chat_reply" job
+# and answers 202 with the job id; the client then polls (or long-polls) GET /llm/jobs/{id}.
+#
+# A worker claims the highest-priority job that is due and holds a lease on it, renewed
+# while the handler runs. A worker that dies lets its lease lapse and the job is claimed
+# again; failures are retried with backoff until JOB_MAX_ATTEMPTS. Delivery is therefore
+# at-least-once. Workers run in the API process (JOB_WORKERS, default 1) and/or on their own:
+#
+#     python -m app.jobs worker [--concurrency N]
+#     python -m app.jobs stats
+
+LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "5"))
+POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))
+KEEP_FINISHED_SECONDS = float(os.getenv("JOB_KEEP_FINISHED_SECONDS", str(24 * 3600)))
+
+# kind -> "module:function"; imported on first use so the worker CLI needs no app import
+HANDLERS = {
+    "chat_reply": "app.routers.llm:run_chat_job",
+}
+# Called with (job, error) once a job has failed for good, before it is marked failed
+FAILURE_HANDLERS = {
+    "chat_reply": "app.routers.llm:chat_job_failed",
+}
+
+FINISHED = ("done", "failed")
+
+
+class JobQueue:
+    PURGE_EVERY = 500 # finished jobs are dropped after KEEP_FINISHED_SECONDS
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        self._wakeup = None # (loop, asyncio.Event) of in-process workers, so they start at once
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, payload TEXT NOT NULL,"
+            " user_id INTEGER, priority INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0, max_attempts INTEGER NOT NULL,"
+            " available_at REAL NOT NULL, lease_owner TEXT, lease_expires_at REAL,"
+            " result TEXT, error TEXT, created_at REAL NOT NULL, finished_at REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_jobs_claim ON jobs (status, priority DESC, available_at, id)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # Same arrangement as shared_state.SQLiteState: one connection per thread and process
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _write(self, fn):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self.purge_finished()
+        return result
+
+    def enqueue(self, kind: str, payload: dict, user_id: Optional[int] = None, priority: int = 0,
+                max_attempts: int = MAX_ATTEMPTS, delay: float = 0) -> int:
+        now = time.time()
+        job_id = self._write(lambda conn: conn.execute(
+            "INSERT INTO jobs (kind, payload, user_id, priority, status, max_attempts, available_at, created_at)"
+            " VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+            (kind, json.dumps(payload), user_id, priority, max_attempts, now + delay, now),
+        ).lastrowid)
+        self.notify()
+        return job_id
+
+    def notify(self):
+        # Safe from any thread; enqueue may run in the threadpool
+        if self._wakeup is not None:
+            loop, event = self._wakeup
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError: # the workers' loop has closed
+                self._wakeup = None
+
+    def claim(self, worker: str, lease_seconds: float = LEASE_SECONDS) -> Optional[dict]:
+        # Highest priority first, then oldest. A running job whose lease lapsed is up for
+        # grabs again; if that was its last attempt, the claimer only runs its failure
+        # handler (attempts > max_attempts, see run_job).
+        def apply(conn):
+            now = time.time()
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE (status = 'queued' AND available_at <= ?)"
+                " OR (status = 'running' AND lease_expires_at <= ?)"
+                " ORDER BY priority DESC, available_at, id LIMIT 1",
+                (now, now),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_owner = ?,"
+                " lease_expires_at = ? WHERE id = ?",
+                (worker, now + lease_seconds, row["id"]),
+            )
+            return self._row(conn, row["id"])
+        return self._write(apply)
+
+    def extend(self, job_id: int, worker: str, lease_seconds: float = LEASE_SECONDS) -> bool:
+        # Heartbeat. False means the lease was lost and another worker may own the job now.
+        return self._write(lambda conn: conn.execute(
+            "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND lease_owner = ? AND status = 'running'",
+            (time.time() + lease_seconds, job_id, worker),
+        ).rowcount == 1)
+
+    def complete(self, job_id: int, worker: str, result) -> bool:
+        return self._write(lambda conn: conn.execute(
+            "UPDATE jobs SET status = 'done', result = ?, error = NULL, lease_owner = NULL, finished_at = ?"
+            " WHERE id = ? AND lease_owner = ? AND status = 'running'",
+            (json.dumps(result), time.time(), job_id, worker),
+        ).rowcount == 1)
+
+    def fail(self, job_id: int, worker: str, error: str, retry_after: Optional[float] = None) -> str:
+        # Back to the queue with exponential backoff (or the error's own hint), or failed for
+        # good once attempts run out. Returns the job's new status.
+        def apply(conn):
+            job = self._row(conn, job_id)
+            if job is None or job["lease_owner"] != worker or job["status"] != "running":
+                return job["status"] if job else "missing"
+            now = time.time()
+            if job["attempts"] >= job["max_attempts"]:
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, lease_owner = NULL, finished_at = ? WHERE id = ?",
+                    (error, now, job_id),
+                )
+                return "failed"
+            delay = retry_after if retry_after is not None else RETRY_BASE_SECONDS * 2 ** (job["attempts"] - 1)
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', error = ?, lease_owner = NULL, available_at = ? WHERE id = ?",
+                (error, now + delay * random.uniform(1, 1.25), job_id),
+            )
+            return "queued"
+        return self._write(apply)
+
+    def get(self, job_id: int) -> Optional[dict]:
+        return self._row(self._connect(), job_id)
+
+    def _row(self, conn, job_id: int) -> Optional[dict]:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return job
+
+    async def wait(self, job_id: int, timeout: float) -> Optional[dict]:
+        # Long-poll: the job as soon as it finishes, or as it stands when the timeout runs out
+        deadline = time.monotonic() + timeout
+        delay = 0.05
+        while True:
+            job = await asyncio.to_thread(self.get, job_id)
+            if job is None or job["status"] in FINISHED or time.monotonic() >= deadline:
+                return job
+            await asyncio.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+            delay = min(delay * 2, 0.5)
+
+    def stats(self) -> dict:
+        rows = self._connect().execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        counts = {status: 0 for status in ("queued", "running", *FINISHED)}
+        counts.update({row["status"]: row["n"] for row in rows})
+        return counts
+
+    def purge_finished(self, older_than: float = KEEP_FINISHED_SECONDS) -> int:
+        return self._connect().execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at <= ?", (time.time() - older_than,)
+        ).rowcount
+
+
+def create_queue(url: Optional[str] = None) -> JobQueue:
+    url = url or os.getenv("JOB_QUEUE_URL", "sqlite:///./job_queue.db")
+    if url.startswith("sqlite:///"):
+        return JobQueue(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported JOB_QUEUE_URL '{url}'")
+
+
+_queue: Optional[JobQueue] = None
+_queue_lock = threading.Lock()
+
+
+def get_queue() -> JobQueue:
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = create_queue()
+    return _queue
+
+
+def set_queue(queue: Optional[JobQueue]):
+    global _queue
+    _queue = queue
+
+
+class RetryableJobError(Exception):
+    # Raise from a handler to ask for another attempt after `retry_after` seconds
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def handler_for(kind: str, handlers: dict = None):
+    target = (HANDLERS if handlers is None else handlers).get(kind)
+    if target is None:
+        return None
+    module_name, _, function = target.partition(":")
+    return getattr(importlib.import_module(module_name), function)
+
+
+async def give_up(queue: JobQueue, job: dict, worker: str, error: str) -> str:
+    on_failure = handler_for(job["kind"], FAILURE_HANDLERS)
+    if on_failure is not None:
+        try:
+            await on_failure(job, error)
+        except Exception:
+            logger.exception("Failure handler for job %s raised", job["id"])
+    return await asyncio.to_thread(queue.fail, job["id"], worker, error)
+
+
+async def run_job(queue: JobQueue, job: dict, worker: str):
+    # Renew the lease every third of its length while the handler runs
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(LEASE_SECONDS / 3)
+            if not await asyncio.to_thread(queue.extend, job["id"], worker):
+                logger.warning("Lost the lease on job %s", job["id"])
+                return
+
+    renewing = asyncio.create_task(heartbeat())
+    try:
+        if job["attempts"] > job["max_attempts"]: # the last attempt's worker died
+            await give_up(queue, job, worker, "Lease expired after the last attempt")
+            return
+        result = await handler_for(job["kind"])(job)
+    except Exception as e:
+        error = str(e) or type(e).__name__
+        if job["attempts"] >= job["max_attempts"]:
+            status = await give_up(queue, job, worker, error)
+        else:
+            retry_after = e.retry_after if isinstance(e, RetryableJobError) else None
+            status = await asyncio.to_thread(queue.fail, job["id"], worker, error, retry_after)
+        logger.warning("Job %s (%s) attempt %s failed, now %s: %s", job["id"], job["kind"], job["attempts"], status, e)
+    else:
+        if not await asyncio.to_thread(queue.complete, job["id"], worker, result):
+            logger.warning("Job %s finished after its lease was lost; result dropped", job["id"])
+    finally:
+        renewing.cancel()
+
+
+async def run_worker(queue: JobQueue, concurrency: int = 1, stop: Optional[asyncio.Event] = None):
+    # `concurrency` jobs at a time in this process; every slot claims independently
+    stop = stop or asyncio.Event()
+    wakeup = asyncio.Event()
+    queue._wakeup = (asyncio.get_running_loop(), wakeup)
+
+    async def slot(index: int):
+        worker = f"{shared_state.holder_id()}:{index}:{uuid.uuid4().hex[:6]}"
+        while not stop.is_set():
+            job = await asyncio.to_thread(queue.claim, worker)
+            if job is not None:
+                await run_job(queue, job, worker)
+                continue
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(), POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    await asyncio.gather(*(slot(i) for i in range(concurrency)))
+
+
+async def drain(queue: JobQueue, worker: str = "drain") -> int:
+    # Run every job that is due, one at a time, and return how many ran (tests, scripts)
+    count = 0
+    while (job := await asyncio.to_thread(queue.claim, worker)) is not None:
+        await run_job(queue, job, worker)
+        count += 1
+    return count
+
+
+if __name__ == "__main__":
+    # python -m app.jobs worker [--concurrency N] | stats
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == "worker":
+        from . import migrate
+
+        logging.basicConfig(level=logging.INFO)
+        migrate.run()
+        concurrency = int(sys.argv[3]) if sys.argv[2:3] == ["--concurrency"] else int(os.getenv("JOB_WORKERS", "4"))
+        asyncio.run(run_worker(get_queue(), concurrency))
+    elif command == "stats":
+        print(json.dumps(get_queue().stats(), indent=2))
+    else:
+        print("usage: python -m app.jobs worker [--concurrency N] | stats")
+        sys.exit(2)
@@ -0,0 +1,202 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+from . import shared_state
+
+_WHITESPACE = re.compile(r"\s+")
+_PUNCTUATION = re.compile(r"[^\w\s']")
+
+
+def normalise(text: str) -> str:
+    # "Explain  Big-O?" and "explain big o" should share an entry
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = _PUNCTUATION.sub(" ", text)
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def cache_key(history: list, window: int = 3) -> str:
+    # history[0] carries the system prompt (and any injected context); the rest is the
+    # conversation, of which only the trailing `window` entries take part in the key.
+    prompt = history[:1] + history[max(1, len(history) - window):]
+    normalised = [[entry["role"], normalise(" ".join(entry["parts"]))] for entry in prompt]
+    return hashlib.sha256(json.dumps(normalised).encode()).hexdigest()
+
+
+class SQLiteCacheBackend:
+    # Shared second-level cache. A local sqlite file stands in for a shared store,
+    # so multiple workers on one host see each other's entries. Every PURGE_EVERY writes
+    # expired rows are dropped and the oldest are evicted until the table fits max_bytes.
+    PURGE_EVERY = 100
+
+    def __init__(self, path: str, max_bytes: int = 64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._writes = 0
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.commit()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[str]:
+        row = self._connect().execute(
+            "SELECT value FROM llm_cache WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl: float):
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, time.time() + ttl),
+        )
+        conn.commit()
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self.purge_expired()
+            self.enforce_size()
+
+    def purge_expired(self) -> int:
+        conn = self._connect()
+        deleted = conn.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (time.time(),)).rowcount
+        conn.commit()
+        return deleted
+
+    def enforce_size(self) -> int:
+        # Every entry shares the same TTL, so the earliest expiry is the oldest write
+        conn = self._connect()
+        deleted = conn.execute(
+            "DELETE FROM llm_cache WHERE key IN (SELECT key FROM ("
+            " SELECT key, SUM(length(key) + length(CAST(value AS BLOB))) OVER (ORDER BY expires_at DESC, rowid DESC) AS running"
+            " FROM llm_cache) WHERE running > ?)",
+            (self.max_bytes,),
+        ).rowcount
+        conn.commit()
+        return deleted
+
+
+class ResponseCache:
+    # In-process LRU bounded by entry count and approximate memory, with per-entry TTL.
+    def __init__(self, ttl: float = 3600, max_entries: int = 1024, max_bytes: int = 16 * 1024 * 1024,
+                 backend: Optional[SQLiteCacheBackend] = None, window: int = 3):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self.window = window
+        self.size_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "shared_hits": 0, "evictions": 0, "expirations": 0}
+
+    def key(self, history: list) -> str:
+        return cache_key(history, self.window)
+
+    def _get_local(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at, size = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.size_bytes -= size
+                self.stats["expirations"] += 1
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _set_local(self, key: str, value: str):
+        size = len(key) + len(value.encode())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size_bytes -= old[2]
+            self._entries[key] = (value, time.monotonic() + self.ttl, size)
+            self.size_bytes += size
+            while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.size_bytes -= evicted_size
+                self.stats["evictions"] += 1
+
+    async def get(self, key: str) -> Optional[str]:
+        value = self._get_local(key)
+        if value is None and self.backend is not None:
+            value = await asyncio.to_thread(self.backend.get, key)
+            if value is not None:
+                self.stats["shared_hits"] += 1
+                self._set_local(key, value)
+        self.stats["hits" if value is not None else "misses"] += 1
+        return value
+
+    async def set(self, key: str, value: str):
+        self._set_local(key, value)
+        if self.backend is not None:
+            await asyncio.to_thread(self.backend.set, key, value, self.ttl)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def snapshot(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "size_bytes": self.size_bytes,
+            "hit_ratio": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+            "shared_backend": self.backend.path if self.backend else None,
+        }
+
+
+_cache: Optional[ResponseCache] = None
+
+
+def get_cache() -> Optional[ResponseCache]:
+    # LLM_CACHE_ENABLED=0 turns caching off entirely. The shared tier is LLM_CACHE_SQLITE_PATH
+    # when set (capped at LLM_CACHE_SHARED_MAX_BYTES), otherwise the shared-state backend
+    # when it spans processes.
+    global _cache
+    if os.getenv("LLM_CACHE_ENABLED", "1") == "0":
+        return None
+    if _cache is None:
+        shared_path = os.getenv("LLM_CACHE_SQLITE_PATH")
+        state = shared_state.get_state()
+        backend = (
+            SQLiteCacheBackend(shared_path, int(os.getenv("LLM_CACHE_SHARED_MAX_BYTES", str(64 * 1024 * 1024))))
+            if shared_path else (state if state.shared else None)
+        )
+        _cache = ResponseCache(
+            ttl=float(os.getenv("LLM_CACHE_TTL_SECONDS", "3600")),
+            max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1024")),
+            max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+            backend=backend,
+            window=int(os.getenv("LLM_CACHE_HISTORY_WINDOW", "3")),
+        )
+    return _cache
+
+
+def set_cache(cache: Optional[ResponseCache]):
+    global _cache
+    _cache = cache
@@ -0,0 +1,357 @@
+import asyncio
+import os
+import random
+import re
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional
+
+from . import metrics, shared_state
+
+EMPTY_RESPONSE_TEXT = "I apologize, but I couldn't generate a response to that. Please try rephrasing your question."
+
+
+class LLMError(Exception):
+    pass
+
+
+class LLMRateLimitError(LLMError):
+    # Raised by providers on 429 / quota errors. retry_after is the server's hint in seconds, if any.
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMBusyError(LLMError):
+    # Raised when the per-process queue is full so callers can fail fast with a 503.
+    def __init__(self, message: str = "LLM service is busy, please retry shortly", retry_after: float = 5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+_RETRY_HINT_PATTERNS = [
+    re.compile(r"retry in ([\d.]+)\s*s", re.IGNORECASE),
+    re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)", re.IGNORECASE),
+    re.compile(r"retry-after:?\s*([\d.]+)", re.IGNORECASE),
+]
+
+
+def parse_retry_after(error_text: str) -> Optional[float]:
+    for pattern in _RETRY_HINT_PATTERNS:
+        match = pattern.search(error_text)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token is close enough for budgeting without a tokenizer dependency
+    return len(text) // 4 + 1
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    error_str = str(error)
+    return "429" in error_str or "ResourceExhausted" in type(error).__name__ or "quota" in error_str.lower()
+
+
+class LLMProvider:
+    name = "base"
+
+    async def generate(self, history: list) -> str:
+        raise NotImplementedError
+
+    async def stream(self, history: list):
+        # Providers without native streaming emit the whole completion as one chunk
+        yield await self.generate(history)
+
+    def count_tokens(self, history: list, completion: str, usage=None):
+        # Prefer the provider's own usage report; fall back to the character estimate
+        prompt_tokens = getattr(usage, "prompt_token_count", None)
+        completion_tokens = getattr(usage, "candidates_token_count", None)
+        if prompt_tokens is None:
+            prompt_tokens = sum(estimate_tokens(part) for entry in history for part in entry["parts"])
+        if completion_tokens is None:
+            completion_tokens = estimate_tokens(completion)
+        metrics.LLM_TOKENS.inc(prompt_tokens, provider=self.name, kind="prompt")
+        metrics.LLM_TOKENS.inc(completion_tokens, provider=self.name, kind="completion")
+
+
+class GeminiProvider(LLMProvider):
+    name = "gemini"
+
+    def __init__(self, api_key: str, model_name: str = "gemini-flash-latest"):
+        # Imported here: the SDK (grpc, protobuf) is a large share of cold start and the stub never needs it
+        import google.generativeai as genai
+
+        genai.configure(api_key=api_key)
+        self.model = genai.GenerativeModel(model_name)
+
+    async def generate(self, history: list) -> str:
+        try:
+            # generate_content_async runs on the grpc aio channel, so the event loop stays free
+            response = await self.model.generate_content_async(history)
+        except Exception as e:
+            if is_rate_limit_error(e):
+                raise LLMRateLimitError(str(e), retry_after=parse_retry_after(str(e))) from e
+            raise
+        text = response.text if response.candidates and response.candidates[0].content.parts else EMPTY_RESPONSE_TEXT
+        self.count_tokens(history, text, getattr(response, "usage_metadata", None))
+        return text
+
+    async def stream(self, history: list):
+        try:
+            response = await self.model.generate_content_async(history, stream=True)
+            emitted = []
+            usage = None
+            async for chunk in response:
+                # Usage is cumulative; the last chunk carries the totals
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                if chunk.candidates and chunk.candidates[0].content.parts:
+                    emitted.append(chunk.text)
+                    yield chunk.text
+        except Exception as e:
+            if is_rate_limit_error(e):
+                raise LLMRateLimitError(str(e), retry_after=parse_retry_after(str(e))) from e
+            raise
+        if not emitted:
+            yield EMPTY_RESPONSE_TEXT
+        self.count_tokens(history, "".join(emitted) or EMPTY_RESPONSE_TEXT, usage)
+
+
+class StubProvider(LLMProvider):
+    # Offline provider for local development and load tests.
+    # latency simulates upstream generation time, rate_limit_ratio injects 429s.
+    name = "stub"
+
+    def __init__(self, latency: float = 0.0, rate_limit_ratio: float = 0.0, retry_after: Optional[float] = None):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+
+    async def generate(self, history: list) -> str:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.rate_limit_ratio and random.random() < self.rate_limit_ratio:
+            raise LLMRateLimitError("429 stub rate limit", retry_after=self.retry_after)
+        last_msg = history[-1]["parts"][0]
+        text = f"Mock response: I received your message '{last_msg}'. (Set LLM_API_KEY to get real responses)"
+        self.count_tokens(history, text)
+        return text
+
+    async def stream(self, history: list):
+        text = await self.generate(history)
+        for word in re.findall(r"\S+\s*", text):
+            yield word
+
+
+class ConcurrencyLimiter:
+    # Bounds in-flight upstream calls per process. Once max_queue callers are already
+    # waiting for a slot, new callers are rejected immediately instead of piling up.
+    # With global_max_concurrency set, each call also needs a lease from shared state, so
+    # the upstream budget holds however many workers share that state.
+    def __init__(self, max_concurrency: int, max_queue: int, global_max_concurrency: int = 0,
+                 global_wait: float = 10.0, lease_seconds: float = 120.0):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.global_max_concurrency = global_max_concurrency
+        self.global_wait = global_wait
+        self.lease_seconds = lease_seconds
+        self.in_flight = 0
+        self.waiting = 0
+        self._semaphore = None
+        self._loop = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+        return self._semaphore
+
+    def is_saturated(self) -> bool:
+        return self.in_flight >= self.max_concurrency and self.waiting >= self.max_queue
+
+    @asynccontextmanager
+    async def slot(self):
+        semaphore = self._get_semaphore()
+        if semaphore.locked() and self.waiting >= self.max_queue:
+            raise LLMBusyError()
+        self.waiting += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            lease = await self._acquire_global()
+        except BaseException:
+            semaphore.release()
+            raise
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            # Local slot first: a second cancellation can interrupt the await below
+            self.in_flight -= 1
+            semaphore.release()
+            if lease:
+                # Shielded, so the lease is returned even if this await is cancelled
+                await asyncio.shield(asyncio.to_thread(shared_state.get_state().release, "llm", lease))
+
+    async def _acquire_global(self) -> Optional[str]:
+        if not self.global_max_concurrency:
+            return None
+        state = shared_state.get_state()
+        holder = f"{shared_state.holder_id()}:{uuid.uuid4().hex[:8]}"
+        deadline = time.monotonic() + self.global_wait
+        delay = 0.05
+        while not await asyncio.to_thread(state.acquire, "llm", holder, self.global_max_concurrency, self.lease_seconds):
+            if time.monotonic() >= deadline:
+                raise LLMBusyError()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1.0)
+        return holder
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None, base: float = 2.0, cap: float = 30.0) -> float:
+    # Honour the server hint when there is one, plus a little jitter so retries don't align.
+    # Otherwise use "full jitter" exponential backoff.
+    if retry_after is not None:
+        return min(cap, retry_after) + random.uniform(0, 1)
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+async def generate_with_retry(provider: LLMProvider, history: list, max_retries: int = 3,
+                              base_delay: float = 2.0, max_delay: float = 30.0) -> str:
+    # max_retries counts attempts; 0 or less (e.g. LLM_MAX_RETRIES=0) still makes one
+    attempts = max(1, max_retries)
+    for attempt in range(attempts):
+        try:
+            return await provider.generate(history)
+        except LLMRateLimitError as e:
+            if attempt >= attempts - 1:
+                raise
+            metrics.LLM_RETRIES.inc(provider=provider.name)
+            await asyncio.sleep(backoff_delay(attempt, e.retry_after, base_delay, max_delay))
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, default))
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, default))
+
+
+_provider: Optional[LLMProvider] = None
+_limiter: Optional[ConcurrencyLimiter] = None
+
+
+def create_provider() -> LLMProvider:
+    # LLM_PROVIDER=gemini|stub. Without an explicit choice, fall back to the stub when no key is set.
+    api_key = os.getenv("LLM_API_KEY")
+    provider_name = os.getenv("LLM_PROVIDER", "gemini" if api_key else "stub").lower()
+    if provider_name == "stub":
+        return StubProvider(
+            latency=_env_float("LLM_STUB_LATENCY_MS", 0) / 1000,
+            rate_limit_ratio=_env_float("LLM_STUB_RATE_LIMIT_RATIO", 0),
+        )
+    if provider_name == "gemini":
+        if not api_key:
+            raise LLMError("LLM_API_KEY must be set to use the gemini provider")
+        return GeminiProvider(api_key, os.getenv("LLM_MODEL", "gemini-flash-latest"))
+    raise LLMError(f"Unknown LLM provider '{provider_name}'")
+
+
+def get_provider() -> LLMProvider:
+    global _provider
+    if _provider is None:
+        _provider = create_provider()
+    return _provider
+
+
+def set_provider(provider: Optional[LLMProvider]):
+    # Swap the process-wide provider (tests, benchmarks). None re-reads the environment on next use.
+    global _provider
+    _provider = provider
+
+
+def get_limiter() -> ConcurrencyLimiter:
+    global _limiter
+    if _limiter is None:
+        _limiter = ConcurrencyLimiter(
+            max_concurrency=_env_int("LLM_MAX_CONCURRENCY", 8),
+            max_queue=_env_int("LLM_MAX_QUEUE", 32),
+            global_max_concurrency=_env_int("LLM_GLOBAL_MAX_CONCURRENCY", 0),
+            global_wait=_env_float("LLM_GLOBAL_WAIT_SECONDS", 10),
+            lease_seconds=_env_float("LLM_LEASE_SECONDS", 120),
+        )
+    return _limiter
+
+
+def set_limiter(limiter: Optional[ConcurrencyLimiter]):
+    global _limiter
+    _limiter = limiter
+
+
+LLM_IN_FLIGHT = metrics.Gauge("llm_requests_in_flight", "LLM calls holding a concurrency slot.",
+                              function=lambda: get_limiter().in_flight)
+LLM_QUEUED = metrics.Gauge("llm_requests_queued", "LLM calls waiting for a concurrency slot.",
+                           function=lambda: get_limiter().waiting)
+
+
+@contextmanager
+def _observe(provider: LLMProvider, operation: str):
+    # Time spent holding the slot (upstream calls plus retry sleeps), labelled by outcome
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    except LLMRateLimitError:
+        outcome = "rate_limited"
+        raise
+    except (GeneratorExit, asyncio.CancelledError):
+        outcome = "cancelled"
+        raise
+    finally:
+        metrics.LLM_DURATION.observe(time.perf_counter() - started, provider=provider.name,
+                                     operation=operation, outcome=outcome)
+
+
+async def generate(history: list) -> str:
+    # The slot is held across retries so a rate-limited upstream throttles new callers too.
+    async with get_limiter().slot():
+        provider = get_provider()
+        with _observe(provider, "generate"):
+            return await generate_with_retry(
+                provider,
+                history,
+                max_retries=_env_int("LLM_MAX_RETRIES", 3),
+                base_delay=_env_float("LLM_RETRY_BASE_SECONDS", 2),
+                max_delay=_env_float("LLM_RETRY_MAX_SECONDS", 30),
+            )
+
+
+async def stream(history: list):
+    # Rate limits are only retried before the first chunk; once text has reached
+    # the client we can't transparently restart the generation.
+    async with get_limiter().slot():
+        provider = get_provider()
+        attempts = max(1, _env_int("LLM_MAX_RETRIES", 3))
+        with _observe(provider, "stream"):
+            for attempt in range(attempts):
+                emitted = False
+                try:
+                    async for chunk in provider.stream(history):
+                        emitted = True
+                        yield chunk
+                    return
+                except LLMRateLimitError as e:
+                    if emitted or attempt >= attempts - 1:
+                        raise
+                    metrics.LLM_RETRIES.inc(provider=provider.name)
+                    await asyncio.sleep(backoff_delay(
+                        attempt, e.retry_after,
+                        _env_float("LLM_RETRY_BASE_SECONDS", 2), _env_float("LLM_RETRY_MAX_SECONDS", 30),
+                    ))
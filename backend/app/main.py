@@ -1,3 +1,7 @@
+from . import startup # first, so its clock covers the imports below
+
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from dotenv import load_dotenv
 import os
@@ -7,14 +11,60 @@ if not os.getenv("LLM_API_KEY"):
      load_dotenv() # Fallback to default search
 
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.middleware.cors import CORSMiddleware
-from .routers import auth, llm, courses, admin, analytics, notes
-from . import models, database
+from fastapi.responses import JSONResponse, PlainTextResponse
+from sqlalchemy import text
+from .routers import auth, llm, courses, admin, analytics, notes, search as search_router
+from . import models, database, seed, pagination, retrieval, rollups, metrics, archive, responses, migrate, jobs
 
-# Create tables
-models.Base.metadata.create_all(bind=database.engine)
+startup.mark("imports")
 
-app = FastAPI(title="Study App API", description="Backend for the Full Stack Study Application")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Production runs `python -m app.migrate` as an init container and sets MIGRATE_ON_STARTUP=0;
+    # locally each start checks the schema fingerprint (cheap when nothing changed)
+    if os.getenv("MIGRATE_ON_STARTUP", "1") == "1":
+        migrate.run()
+        startup.mark("migrate")
+    # Workers booting together take turns here, so only the first one seeds and builds the index
+    with migrate.migration_lock(database.engine):
+        db = database.SessionLocal()
+        try:
+            # Before seeding, so a pre-rollup database gets its counters from the raw tables
+            rollups.backfill_if_empty(db)
+            startup.mark("rollups")
+            # Demo catalogue is seeded once at startup instead of on every GET /courses
+            seeded = os.getenv("SEED_DEMO_DATA", "1") == "1" and seed.seed_demo_courses(db)
+            startup.mark("seed")
+            retrieval.ensure_built(db, force=seeded)
+            startup.mark("retrieval_index")
+        finally:
+            db.close()
+    startup.finished()
+    # Optional in-process archival + VACUUM loop; otherwise run `python -m app.archive run` from cron
+    interval = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "0"))
+    maintenance = asyncio.create_task(archive.periodic_maintenance(interval)) if interval > 0 else None
+    # In-process job workers for /llm/chat?mode=async; JOB_WORKERS=0 leaves the queue to
+    # `python -m app.jobs worker` processes
+    job_workers = int(os.getenv("JOB_WORKERS", "1"))
+    job_stop = asyncio.Event()
+    worker_pool = asyncio.create_task(jobs.run_worker(jobs.get_queue(), job_workers, job_stop)) if job_workers > 0 else None
+    yield
+    if maintenance:
+        maintenance.cancel()
+    if worker_pool:
+        # Let running jobs finish; anything cut off is claimed again once its lease lapses
+        job_stop.set()
+        try:
+            await asyncio.wait_for(worker_pool, float(os.getenv("JOB_SHUTDOWN_SECONDS", "30")))
+        except asyncio.TimeoutError:
+            pass
+
+app = FastAPI(
+    title="Study App API",
+    description="Backend for the Full Stack Study Application",
+    lifespan=lifespan,
+    default_response_class=responses.FastJSONResponse,
+)
 
 # CORS Setup
 origins = [
@@ -22,13 +72,19 @@ origins = [
     "http://localhost:3000",
 ]
 
+# Innermost: compresses the final body, skips SSE streams and small payloads
+app.add_middleware(responses.CompressionMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[pagination.NEXT_CURSOR_HEADER],
 )
+# Outermost, so the timings include CORS handling and error responses
+app.add_middleware(metrics.MetricsMiddleware)
 
 app.include_router(auth.router)
 app.include_router(llm.router)
@@ -36,7 +92,27 @@ app.include_router(courses.router)
 app.include_router(admin.router)
 app.include_router(analytics.router)
 app.include_router(notes.router)
+app.include_router(search_router.router)
 
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the Study App API"}
+
+@app.get("/health", include_in_schema=False)
+def health():
+    # Liveness: the process is serving requests
+    return {"status": "ok"}
+
+@app.get("/ready", include_in_schema=False)
+def ready():
+    # Readiness: lifespan finished and the database answers
+    if not startup.ready:
+        return JSONResponse({"status": "starting", **startup.report()}, status_code=503)
+    with database.engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+    return {"status": "ready", **startup.report()}
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    # Prometheus text exposition format; scraped per pod (see k8s/backend.yaml)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,347 @@
+import atexit
+import contextvars
+import json
+import os
+import threading
+import time
+
+from sqlalchemy import event
+
+from . import profiling
+
+try:
+    import fcntl
+except ImportError: # Windows dev machines: no cross-process lock
+    fcntl = None
+
+# In-process metrics rendered in the Prometheus text exposition format on GET /metrics.
+# Each worker process keeps its own registry. With several workers behind one port
+# (gunicorn), METRICS_MULTIPROC_DIR is set and every process writes a snapshot of its registry
+# there every METRICS_FLUSH_SECONDS and at exit; /metrics then serves the sum over all
+# snapshots. Counters and histograms of exited workers (max_requests recycling) are folded
+# into one archive file, so totals never go backwards; their gauges are dropped.
+
+MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR")
+FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "5"))
+DEAD_FILE = "dead.json"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+REGISTRY = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple, extra: tuple = ()) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {key: _copy(value) for key, value in self._values.items()}
+
+    def merge(self, total: dict, key: tuple, value):
+        total[key] = total.get(key, 0) + value
+
+    def render(self, values: dict = None) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for key, value in sorted((self.snapshot() if values is None else values).items()):
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f"{self.name}{self._labels(key)} {value}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self._function = function # read at scrape time instead of being pushed
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def snapshot(self) -> dict:
+        if self._function is not None:
+            with self._lock:
+                self._values[()] = self._function()
+        return super().snapshot()
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def count(self, **labels) -> int:
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def merge(self, total: dict, key: tuple, value):
+        if key not in total:
+            total[key] = [[0] * len(self.buckets), 0.0, 0]
+        state = total[key]
+        state[0] = [a + b for a, b in zip(state[0], value[0])]
+        state[1] += value[1]
+        state[2] += value[2]
+
+    def _samples(self, key, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{self._labels(key, (('le', bound),))} {cumulative}")
+        lines.append(f"{self.name}_bucket{self._labels(key, (('le', '+Inf'),))} {count}")
+        lines.append(f"{self.name}_sum{self._labels(key)} {total}")
+        lines.append(f"{self.name}_count{self._labels(key)} {count}")
+        return lines
+
+
+def _copy(value):
+    return [list(value[0]), value[1], value[2]] if isinstance(value, list) else value
+
+
+def render() -> str:
+    if MULTIPROC_DIR:
+        write_snapshot()
+        merged = collect(MULTIPROC_DIR)
+        return "\n".join(line for metric in REGISTRY for line in metric.render(merged.get(metric.name, {}))) + "\n"
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+def _encode(metrics: dict) -> dict:
+    return {name: [[list(key), value] for key, value in values.items()] for name, values in metrics.items()}
+
+
+def _decode(raw: dict) -> dict:
+    return {name: {tuple(key): value for key, value in items} for name, items in raw.items()}
+
+
+def write_snapshot(directory: str = None):
+    directory = directory or MULTIPROC_DIR
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    data = _encode({metric.name: metric.snapshot() for metric in REGISTRY})
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path) # readers never see a half-written snapshot
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect(directory: str) -> dict:
+    # Sum of every live worker's snapshot plus the archive of exited ones
+    by_name = {metric.name: metric for metric in REGISTRY}
+    merged = {}
+
+    def add(snapshot: dict, totals: dict, gauges: bool):
+        for name, values in snapshot.items():
+            metric = by_name.get(name)
+            if metric is None or (metric.type == "gauge" and not gauges):
+                continue
+            for key, value in values.items():
+                metric.merge(totals.setdefault(name, {}), key, value)
+
+    with open(os.path.join(directory, ".lock"), "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX) # one scrape at a time folds exited workers in
+        dead_path = os.path.join(directory, DEAD_FILE)
+        dead = {}
+        if os.path.exists(dead_path):
+            with open(dead_path) as f:
+                dead = _decode(json.load(f))
+        folded = False
+        for filename in os.listdir(directory):
+            stem, ext = os.path.splitext(filename)
+            if ext != ".json" or not stem.isdigit():
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                with open(path) as f:
+                    snapshot = _decode(json.load(f))
+            except (OSError, ValueError):
+                continue
+            if _alive(int(stem)):
+                add(snapshot, merged, gauges=True)
+            else:
+                add(snapshot, dead, gauges=False)
+                os.remove(path)
+                folded = True
+        if folded:
+            with open(dead_path + ".tmp", "w") as f:
+                json.dump(_encode(dead), f)
+            os.replace(dead_path + ".tmp", dead_path)
+    add(dead, merged, gauges=False)
+    return merged
+
+
+_flusher_pid = None
+
+
+def start_flusher():
+    # Once per process (forked workers start their own); a no-op outside multiprocess mode
+    global _flusher_pid
+    if not MULTIPROC_DIR or _flusher_pid == os.getpid():
+        return
+    _flusher_pid = os.getpid()
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+    def loop():
+        while True:
+            time.sleep(FLUSH_SECONDS)
+            write_snapshot()
+
+    threading.Thread(target=loop, name="metrics-flush", daemon=True).start()
+    atexit.register(write_snapshot)
+
+
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests by route template and status.", ("method", "route", "status"))
+HTTP_DURATION = Histogram("http_request_duration_seconds", "Time until the response body was fully sent.", ("method", "route"))
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "Requests currently being served.")
+HTTP_DB_QUERIES = Histogram("http_request_db_queries", "SQL statements executed per request.", ("route",), COUNT_BUCKETS)
+HTTP_DB_SECONDS = Histogram("http_request_db_seconds", "Time spent in SQL per request.", ("route",))
+
+DB_QUERIES = Counter("db_queries_total", "SQL statements executed.", ("engine",))
+DB_QUERY_DURATION = Histogram("db_query_duration_seconds", "SQL statement execution time.", ("engine",))
+
+LLM_DURATION = Histogram("llm_request_duration_seconds", "Upstream LLM call time, including retries.", ("provider", "operation", "outcome"))
+LLM_RETRIES = Counter("llm_retries_total", "LLM calls retried after a rate limit.", ("provider",))
+LLM_TOKENS = Counter("llm_tokens_total", "LLM tokens (provider-reported, otherwise estimated).", ("provider", "kind"))
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+# The stats object is shared by reference, so threadpool (sync) handlers and greenlet-run
+# async sessions both add to the request that started them
+_request_stats = contextvars.ContextVar("request_stats", default=None)
+
+
+def current_request_stats():
+    return _request_stats.get()
+
+
+def instrument_engine(sync_engine, role: str):
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        DB_QUERIES.inc(engine=role)
+        DB_QUERY_DURATION.observe(elapsed, engine=role)
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += elapsed
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware (not BaseHTTPMiddleware) so streaming responses are timed to
+    # their last chunk and the request contextvar is visible to the endpoint
+    def __init__(self, app):
+        self.app = app
+        start_flusher()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        status = 500
+        started = time.perf_counter()
+        wall_started = time.time()
+        HTTP_IN_FLIGHT.inc()
+        profiling.get_profiler() # starts the sampler on first use when enabled
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            HTTP_IN_FLIGHT.dec()
+            # Route templates keep label cardinality bounded ("/notes/{note_id}", not "/notes/42")
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            HTTP_REQUESTS.inc(method=method, route=route, status=status)
+            HTTP_DURATION.observe(elapsed, method=method, route=route)
+            HTTP_DB_QUERIES.observe(stats.queries, route=route)
+            HTTP_DB_SECONDS.observe(stats.db_seconds, route=route)
+            _request_stats.reset(token)
+            await profiling.request_finished(method, route, wall_started, elapsed)
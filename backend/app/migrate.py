@@ -0,0 +1,142 @@
+import contextlib
+import datetime
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from . import database, models, search
+
+logger = logging.getLogger(__name__)
+
+# Schema changes run here rather than at import time: once per deploy via
+# `python -m app.migrate` (the k8s init container) or from the app lifespan when
+# MIGRATE_ON_STARTUP=1. A lock serialises workers/pods starting together, and a fingerprint
+# of the declared schema lets every later start skip the DDL inspection entirely.
+
+try:
+    import fcntl
+except ImportError: # Windows dev machines: no cross-process lock
+    fcntl = None
+
+STATE_TABLE = "schema_state"
+PG_LOCK_ID = 0x5354_5544 # arbitrary, shared by every process migrating this database
+
+
+def fingerprint(metadata) -> str:
+    parts = []
+    for table in metadata.sorted_tables:
+        parts.append(table.name)
+        parts.extend(f"{column.name}:{column.type}" for column in table.columns)
+        parts.extend(sorted(f"ix:{index.name}" for index in table.indexes))
+        if table.kwargs.get("sqlite_autoincrement"):
+            parts.append("autoincrement")
+    parts.append(f"fts:{search.FTS_TABLE}")
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()[:16]
+
+
+def lock_path(engine: Engine) -> str:
+    configured = os.getenv("MIGRATION_LOCK_PATH")
+    if configured:
+        return configured
+    database_path = engine.url.database
+    if engine.dialect.name == "sqlite" and database_path and database_path != ":memory:":
+        return database_path + ".migrate.lock"
+    return os.path.join(tempfile.gettempdir(), "study_app.migrate.lock")
+
+
+@contextlib.contextmanager
+def migration_lock(engine: Engine):
+    if engine.dialect.name == "postgresql":
+        # Pods don't share a filesystem; the database itself is the lock
+        with engine.connect() as conn:
+            conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": PG_LOCK_ID})
+            try:
+                yield
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": PG_LOCK_ID})
+        return
+    with open(lock_path(engine), "a") as handle:
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def applied_fingerprint(engine: Engine):
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {STATE_TABLE} (id INTEGER PRIMARY KEY, fingerprint VARCHAR, migrated_at VARCHAR)"))
+        return conn.execute(text(f"SELECT fingerprint FROM {STATE_TABLE} WHERE id = 1")).scalar()
+
+
+def ensure_sqlite_autoincrement(engine: Engine, metadata):
+    # SQLite can't add AUTOINCREMENT to an existing table, so tables created without it are
+    # rebuilt. The id sequence starts past every id still in use, archived chat messages
+    # included, so an id freed by archival is never handed out again.
+    if engine.dialect.name != "sqlite":
+        return
+    from . import archive
+    for table in metadata.sorted_tables:
+        if not table.kwargs.get("sqlite_autoincrement"):
+            continue
+        with engine.begin() as conn:
+            sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                               {"name": table.name}).scalar()
+            if sql is None or "AUTOINCREMENT" in sql.upper():
+                continue
+            old = f"{table.name}__rebuild"
+            conn.exec_driver_sql(f'ALTER TABLE "{table.name}" RENAME TO "{old}"')
+            for index in table.indexes: # still attached to the renamed table
+                conn.exec_driver_sql(f'DROP INDEX IF EXISTS "{index.name}"')
+            table.create(conn)
+            columns = ", ".join(f'"{column.name}"' for column in table.columns)
+            conn.exec_driver_sql(f'INSERT INTO "{table.name}" ({columns}) SELECT {columns} FROM "{old}"')
+            conn.exec_driver_sql(f'DROP TABLE "{old}"')
+            top = conn.exec_driver_sql(f'SELECT max(id) FROM "{table.name}"').scalar() or 0
+            if table.name == models.ChatMessage.__tablename__:
+                for codec, payload in conn.execute(text("SELECT codec, payload FROM chat_archives")):
+                    ids = [row["id"] for row in json.loads(archive.decompress(codec, payload))]
+                    top = max([top, *ids])
+            conn.execute(text("DELETE FROM sqlite_sequence WHERE name = :name"), {"name": table.name})
+            conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)"), {"name": table.name, "seq": top})
+            logger.info("Rebuilt %s with AUTOINCREMENT (next id %s)", table.name, top + 1)
+
+
+def run(engine: Engine = None, force: bool = False) -> bool:
+    # Returns True when DDL was applied, False when the schema was already current
+    engine = engine or database.engine
+    expected = fingerprint(models.Base.metadata)
+    if not force and applied_fingerprint(engine) == expected:
+        return False
+    with migration_lock(engine):
+        # Another worker may have finished while we waited for the lock
+        if not force and applied_fingerprint(engine) == expected:
+            return False
+        database.sync_schema(models.Base.metadata, bind=engine)
+        ensure_sqlite_autoincrement(engine, models.Base.metadata)
+        search.ensure_index(engine)
+        with engine.begin() as conn:
+            conn.execute(text(f"DELETE FROM {STATE_TABLE}"))
+            conn.execute(
+                text(f"INSERT INTO {STATE_TABLE} (id, fingerprint, migrated_at) VALUES (1, :fingerprint, :at)"),
+                {"fingerprint": expected, "at": datetime.datetime.utcnow().isoformat()},
+            )
+    logger.info("Database schema migrated to %s", expected)
+    return True
+
+
+if __name__ == "__main__":
+    # python -m app.migrate [--force]
+    if sys.argv[1:] not in ([], ["--force"]):
+        print("usage: python -m app.migrate [--force]")
+        sys.exit(2)
+    applied = run(force=sys.argv[1:] == ["--force"])
+    print("Database schema updated." if applied else "Database schema already current.")
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, Text, Enum
+from sqlalchemy import BigInteger, Boolean, Column, ForeignKey, Integer, LargeBinary, String, DateTime, Text, Enum, Index, and_, func, select
 from sqlalchemy.orm import relationship
 from .database import Base
 import datetime
@@ -18,6 +18,8 @@ class User(Base):
     hashed_password = Column(String)
     is_active = Column(Boolean, default=True)
     role = Column(String, default=UserRole.STUDENT)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    note_seq = Column(Integer, default=0) # Last change sequence handed out to this user's notes (see routers/notes.py)
 
     study_sessions = relationship("StudySession", back_populates="owner")
     notes = relationship("Note", back_populates="owner")
@@ -29,9 +31,19 @@ class StudySession(Base):
     user_id = Column(Integer, ForeignKey("users.id"))
     topic = Column(String, index=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    cache_opt_out = Column(Boolean, default=False) # Never serve cached LLM replies in this session
+    summary = Column(Text, nullable=True) # Rolling summary of turns that fell out of the context window
+    summary_upto_id = Column(Integer, nullable=True) # Last ChatMessage.id folded into summary
+    archived_at = Column(DateTime, nullable=True) # Messages moved to chat_archives (see app/archive.py)
 
     owner = relationship("User", back_populates="study_sessions")
-    messages = relationship("ChatMessage", back_populates="session")
+    # Never loaded implicitly: history is read in pages (GET /llm/sessions/{id}/messages)
+    messages = relationship("ChatMessage", back_populates="session", lazy="raise")
+
+    __table_args__ = (
+        # Per-user session listings, newest first by id
+        Index("ix_study_sessions_user_id_id", "user_id", "id"),
+    )
 
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
@@ -41,9 +53,50 @@ class ChatMessage(Base):
     role = Column(String) # "user" or "ai"
     content = Column(Text)
     timestamp = Column(DateTime, default=datetime.datetime.utcnow)
+    job_id = Column(Integer, nullable=True) # Reply written by this background job (app/jobs.py), so a retry can't add a second one
 
     session = relationship("StudySession", back_populates="messages")
 
+    __table_args__ = (
+        # Newest-first history reads: WHERE session_id = ? ORDER BY id DESC
+        Index("ix_chat_messages_session_id_id", "session_id", "id"),
+        Index("ix_chat_messages_job_id", "job_id", unique=True),
+        # Ids are never reused: archived sessions are restored with their original ids
+        {"sqlite_autoincrement": True},
+    )
+
+class ChatArchive(Base):
+    # Cold storage: all messages of an inactive session as one compressed JSON blob
+    __tablename__ = "chat_archives"
+
+    session_id = Column(Integer, ForeignKey("study_sessions.id"), primary_key=True)
+    codec = Column(String) # "zstd" or "gzip"
+    payload = Column(LargeBinary)
+    message_count = Column(Integer)
+    raw_bytes = Column(Integer)
+    archived_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class MaintenanceRun(Base):
+    # One row per archival/compaction run (app/archive.py), whichever process or cron job ran it
+    __tablename__ = "maintenance_runs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    finished_at = Column(DateTime, default=datetime.datetime.utcnow)
+    report = Column(Text) # JSON, as returned by archive.run_maintenance
+
+# Newest message of a session, for listings: selectinload(StudySession.last_message) fetches
+# one row per session in a single extra query (max(id) is served by ix_chat_messages_session_id_id)
+_last_message_id = select(func.max(ChatMessage.id)).where(
+    ChatMessage.session_id == StudySession.id
+).correlate_except(ChatMessage).scalar_subquery()
+StudySession.last_message = relationship(
+    ChatMessage,
+    primaryjoin=and_(ChatMessage.session_id == StudySession.id, ChatMessage.id == _last_message_id),
+    viewonly=True,
+    uselist=False,
+    lazy="raise",
+)
+
 class Course(Base):
     __tablename__ = "courses"
 
@@ -59,10 +112,13 @@ class Content(Base):
     __tablename__ = "contents"
 
     id = Column(Integer, primary_key=True, index=True)
-    course_id = Column(Integer, ForeignKey("courses.id"))
+    course_id = Column(Integer, ForeignKey("courses.id"), index=True)
     title = Column(String)
     type = Column(String) # "video", "note"
-    data = Column(Text) # URL or text content
+    data = Column(Text) # URL or text content; NULL when the body is in the blob store
+    blob_key = Column(String) # see content_store
+    size = Column(Integer) # body size in bytes
+    sha256 = Column(String(64))
 
     course = relationship("Course", back_populates="contents")
 
@@ -82,6 +138,48 @@ class Note(Base):
     content = Column(Text)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    version = Column(Integer, default=1) # Bumped on every write; sync mutations must name the version they edited
+    change_seq = Column(Integer, default=0) # User's note_seq at the last write
+    client_id = Column(String, nullable=True) # Offline-created notes: the client's id, so replayed creates are idempotent
 
     owner = relationship("User", back_populates="notes")
 
+    __table_args__ = (
+        # Per-user listings in (updated_at, id) keyset order
+        Index("ix_notes_user_id_updated_at_id", "user_id", "updated_at", "id"),
+        Index("ix_notes_user_id_change_seq_id", "user_id", "change_seq", "id"),
+        Index("ix_notes_user_id_client_id", "user_id", "client_id", unique=True),
+    )
+
+class NoteTombstone(Base):
+    # Left behind by deleted notes so /notes/sync can tell clients what to drop
+    __tablename__ = "note_tombstones"
+
+    note_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    change_seq = Column(Integer)
+    deleted_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_note_tombstones_user_id_change_seq", "user_id", "change_seq", "note_id"),
+    )
+
+
+class AnalyticsCounter(Base):
+    # Running totals for the dashboard, updated in the same transaction as the source row
+    __tablename__ = "analytics_counters"
+
+    name = Column(String, primary_key=True)
+    value = Column(BigInteger, default=0)
+
+class AnalyticsBucket(Base):
+    # Hourly/daily rollups; `total` is metric specific (revenue cents, latency ms)
+    __tablename__ = "analytics_buckets"
+
+    # Key order serves range reads: WHERE granularity = ? AND metric = ? AND bucket_start BETWEEN ...
+    granularity = Column(String, primary_key=True) # "hour" or "day"
+    metric = Column(String, primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    dimension = Column(String, primary_key=True, default="") # e.g. course id for enrollments
+    count = Column(BigInteger, default=0)
+    total = Column(BigInteger, default=0)
@@ -0,0 +1,84 @@
+import base64
+import datetime
+import json
+from typing import Iterable, List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import tuple_
+
+from .responses import FastJSONResponse
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+
+# Listings return a plain JSON array (so existing clients keep working) and advertise the
+# next page in headers; clients pass the X-Next-Cursor value back as ?cursor=. Listings that
+# predate pagination (GET /courses, GET /notes) return everything when called without limit
+# or cursor; the chat session and message listings were paginated from the start and always
+# return pages of DEFAULT_LIMIT.
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(values: list) -> str:
+    encoded = [v.isoformat() if isinstance(v, datetime.datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(encoded).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str], types: tuple) -> Optional[list]:
+    # types: python type per sort key, e.g. (datetime.datetime, int)
+    if not cursor:
+        return None
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if len(raw) != len(types):
+            raise ValueError
+        return [
+            datetime.datetime.fromisoformat(value) if kind is datetime.datetime else kind(value)
+            for value, kind in zip(raw, types)
+        ]
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def after(columns: list, values: Optional[list], descending: bool = False):
+    # Keyset predicate: rows strictly after the cursor in (col1, col2, ...) order
+    if values is None:
+        return None
+    key = tuple_(*columns)
+    return key < tuple_(*values) if descending else key > tuple_(*values)
+
+
+def parse_fields(fields: Optional[str], allowed: Iterable[str]) -> Optional[List[str]]:
+    if not fields:
+        return None
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = sorted(set(requested) - set(allowed))
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return requested
+
+
+def clamp_limit(limit: Optional[int]) -> int:
+    if limit is None:
+        return DEFAULT_LIMIT
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def page_headers(next_values: Optional[list]) -> dict:
+    return {NEXT_CURSOR_HEADER: encode_cursor(next_values)} if next_values is not None else {}
+
+
+def split_page(rows: list, limit: int, sort_key) -> tuple:
+    # Queries fetch limit + 1 rows; the extra row only tells us whether there is a next page
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, sort_key(rows[-1])
+    return rows, None
+
+
+def projected_response(rows: list, fields: Iterable[str], headers: dict) -> FastJSONResponse:
+    # Returning a Response bypasses response_model: no per-row pydantic validation or
+    # jsonable_encoder pass. Used for sparse fields and for full rows of hot listings, whose
+    # columns already have the schema's types.
+    payload = [{field: getattr(row, field) for field in fields} for row in rows]
+    return FastJSONResponse(content=payload, headers=headers)
@@ -0,0 +1,112 @@
+import asyncio
+import collections
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Opt-in sampling profiler for slow requests. Enable with PROFILE_SLOW_REQUEST_MS=<threshold>.
+#
+# A daemon thread snapshots every thread's Python stack each PROFILE_INTERVAL_MS into a ring
+# buffer. When a request takes longer than the threshold, the samples taken during its
+# lifetime are aggregated into the "folded" format (frame;frame;frame count) read by
+# flamegraph.pl and speedscope, and written to PROFILE_DIR. Samples are process-wide, so
+# concurrent requests show up too; the root frame is the thread name to tell them apart.
+
+# Leaf frames of threads that are parked rather than working
+IDLE_LEAVES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+}
+
+
+def threshold_ms():
+    value = os.getenv("PROFILE_SLOW_REQUEST_MS")
+    return float(value) if value else None
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float, max_samples: int, out_dir: str):
+        self.interval = interval
+        self.out_dir = out_dir
+        self.samples = collections.deque(maxlen=max_samples) # (timestamp, folded stack)
+        self.profiles_written = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="slow-request-profiler", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            now = time.time()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = self._fold(frame)
+                if stack is not None:
+                    self.samples.append((now, f"{names.get(thread_id, thread_id)};{stack}"))
+            time.sleep(self.interval)
+
+    @staticmethod
+    def _fold(frame):
+        code = frame.f_code
+        if (os.path.basename(code.co_filename), code.co_name) in IDLE_LEAVES:
+            return None
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        frames.reverse()
+        return ";".join(frames)
+
+    def collect(self, started: float, ended: float) -> collections.Counter:
+        return collections.Counter(stack for at, stack in list(self.samples) if started <= at <= ended)
+
+    def dump(self, method: str, route: str, started: float, elapsed: float):
+        stacks = self.collect(started, started + elapsed)
+        if not stacks:
+            return None
+        os.makedirs(self.out_dir, exist_ok=True)
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+        path = os.path.join(self.out_dir, f"{time.strftime('%Y%m%dT%H%M%S')}-{method}-{slug}-{int(elapsed * 1000)}ms.folded")
+        with open(path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        self.profiles_written += 1
+        logger.warning("Slow request %s %s took %.0f ms, profile written to %s", method, route, elapsed * 1000, path)
+        return path
+
+
+_profiler = None
+
+
+def get_profiler():
+    global _profiler
+    if _profiler is None and threshold_ms() is not None:
+        _profiler = SamplingProfiler(
+            interval=float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000,
+            max_samples=int(os.getenv("PROFILE_MAX_SAMPLES", "200000")),
+            out_dir=os.getenv("PROFILE_DIR", "./profiles"),
+        )
+        _profiler.start()
+    return _profiler
+
+
+async def request_finished(method: str, route: str, started: float, elapsed: float):
+    profiler = get_profiler()
+    if profiler is None or elapsed * 1000 < threshold_ms():
+        return None
+    # Aggregating and writing the profile is file I/O; keep it off the event loop
+    return await asyncio.to_thread(profiler.dump, method, route, started, elapsed)
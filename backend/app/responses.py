@@ -0,0 +1,174 @@
+import datetime
+import decimal
+import enum
+import gzip
+import json
+import os
+import uuid
+
+import anyio
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+# orjson serialises the large text bodies of notes and chat histories several times faster
+# than json + jsonable_encoder; without it we fall back to the stdlib. Brotli is used for
+# compression when installed, gzip otherwise.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _default(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (uuid.UUID, bytes)):
+        return str(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    # App-wide default_response_class. Endpoints that still go through response_model get the
+    # faster encoder; hot listings skip validation entirely via pagination.projected_response.
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def parse_byte_range(header: str, size: int):
+    # Single "bytes=" range -> (start, end) inclusive. None means serve the whole body (no
+    # usable range: other units, several ranges); ValueError means 416 Range Not Satisfiable.
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    if not dash:
+        return None
+    try:
+        if first == "":
+            start, end = max(0, size - int(last)), size - 1 # suffix: the last N bytes
+            if int(last) == 0:
+                raise ValueError
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        raise ValueError(f"Unsatisfiable range {header!r}")
+    if start > end or start >= size:
+        raise ValueError(f"Unsatisfiable range {header!r}")
+    return start, end
+
+
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+# Bodies this large are compressed on a worker thread; smaller ones aren't worth the hop
+COMPRESSION_THREAD_MIN_BYTES = int(os.getenv("COMPRESSION_THREAD_MIN_BYTES", str(64 * 1024)))
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript", "image/svg+xml")
+
+
+def choose_encoding(accept_encoding: str):
+    accepted = {
+        part.split(";")[0].strip().lower()
+        for part in accept_encoding.split(",")
+        if not part.strip().endswith(";q=0")
+    }
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4")))
+    return gzip.compress(body, compresslevel=int(os.getenv("COMPRESSION_GZIP_LEVEL", "6")))
+
+
+class CompressionMiddleware:
+    """Compress single-message responses of COMPRESSION_MIN_BYTES or more.
+
+    Streaming responses (SSE chat, anything sent in several body messages) pass through
+    untouched so tokens aren't held back in a compression buffer.
+    """
+
+    def __init__(self, app, minimum_size: int = None):
+        self.app = app
+        self.minimum_size = COMPRESSION_MIN_BYTES if minimum_size is None else minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict((k.decode().lower(), v.decode()) for k, v in scope["headers"])
+        encoding = choose_encoding(headers.get("accept-encoding", ""))
+        if encoding is None or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            # First body message: decide once we know whether this is the whole response
+            response_headers = dict((k.decode().lower(), v.decode()) for k, v in start["headers"])
+            body = message.get("body", b"")
+            compressible = (
+                start["status"] == 200 # never re-encode partial (206) responses
+                and not message.get("more_body", False)
+                and len(body) >= self.minimum_size
+                and "content-encoding" not in response_headers
+                and response_headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+            )
+            if not compressible:
+                passthrough = True
+                await send(start)
+                await send(message)
+                return
+            if len(body) >= COMPRESSION_THREAD_MIN_BYTES:
+                compressed = await anyio.to_thread.run_sync(compress, body, encoding)
+            else:
+                compressed = compress(body, encoding)
+            new_headers = [(k, v) for k, v in start["headers"] if k.lower() not in (b"content-length", b"etag", b"vary")]
+            vary = response_headers.get("vary")
+            new_headers += [
+                (b"content-encoding", encoding.encode()),
+                (b"content-length", str(len(compressed)).encode()),
+                (b"vary", (f"{vary}, Accept-Encoding" if vary else "Accept-Encoding").encode()),
+            ]
+            etag = response_headers.get("etag")
+            if etag:
+                # Different bytes, same representation: downgrade to a weak validator
+                new_headers.append((b"etag", (etag if etag.startswith("W/") else "W/" + etag).encode()))
+            await send({**start, "headers": new_headers})
+            await send({"type": "http.response.body", "body": compressed})
+            passthrough = True
+
+        await self.app(scope, receive, send_compressed)
+        if start is not None and not passthrough:
+            # No body message was ever sent (e.g. 204); flush the headers we held back
+            await send(start)
@@ -0,0 +1,394 @@
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import shutil
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterable, List, Optional
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from . import content_store, database, models, shared_state
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError: # Windows dev machines: no cross-process lock
+    fcntl = None
+
+# Local BM25 retrieval over course Content, used to ground chat answers without extra API calls.
+#
+# Layout under RETRIEVAL_INDEX_DIR:
+#   base/    immutable segment built from the database; numpy arrays opened with mmap_mode="r"
+#            (term-major postings: ptr/doc/weight) plus chunk texts addressed by byte offsets
+#   delta.jsonl  chunks added since the base was built (add_content), replayed at startup
+# Once the delta grows past RETRIEVAL_COMPACT_THRESHOLD chunks the base is rebuilt in a
+# background thread and swapped in atomically.
+#
+# Every worker process shares the directory. `.lock` (flock) covers delta appends, loads and
+# the swap; `.build.lock` lets one rebuild run at a time, so the delta offset a rebuild
+# starts from stays valid until it swaps.
+
+K1 = 1.5
+B = 0.75
+SKIPPED_TYPES = {"video"} # video rows hold a URL, nothing to retrieve
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have how i in is it its of on or so that the "
+    "this to was what were when which will with you your".split()
+)
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN.findall(text.lower()) if len(t) > 1 and t not in STOPWORDS]
+
+
+def chunk_text(text: str, chunk_words: int = 120, overlap: int = 30) -> List[str]:
+    words = text.split()
+    step = max(1, chunk_words - overlap)
+    chunks = []
+    for start in range(0, len(words), step):
+        chunks.append(" ".join(words[start:start + chunk_words]))
+        if start + chunk_words >= len(words):
+            break
+    return chunks
+
+
+def content_chunks(content: models.Content) -> List[dict]:
+    if content.type in SKIPPED_TYPES or not (content.data or content.blob_key):
+        return []
+    return [
+        {"course_id": content.course_id, "content_id": content.id, "title": content.title, "text": chunk}
+        for chunk in chunk_text(content_store.body_text(content),
+                                int(os.getenv("RETRIEVAL_CHUNK_WORDS", "120")),
+                                int(os.getenv("RETRIEVAL_CHUNK_OVERLAP", "30")))
+    ]
+
+
+def _saturation(tf, length, avgdl):
+    return tf * (K1 + 1) / (tf + K1 * (1 - B + B * length / avgdl))
+
+
+@contextmanager
+def _flock(path: str, shared: bool = False, wait: bool = True):
+    # Yields False instead of waiting when wait=False and the lock is taken
+    if fcntl is None:
+        yield True
+        return
+    mode = (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if wait else fcntl.LOCK_NB)
+    with open(path, "a") as f:
+        try:
+            fcntl.flock(f, mode)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def idf(n_docs: int, df) -> float:
+    return np.log1p((n_docs - df + 0.5) / (df + 0.5))
+
+
+class Segment:
+    """Immutable, memory-mapped BM25 segment."""
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(path, "vocab.json")) as f:
+            self.vocab = json.load(f)
+        load = lambda name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        self.df = load("df")
+        self.ptr = load("postings_ptr")
+        self.doc = load("postings_doc")
+        self.weight = load("postings_weight")
+        self.chunk_course = load("chunk_course")
+        self.chunk_offsets = load("chunk_offsets")
+        self._text_file = open(os.path.join(path, "chunks.jsonl"), "rb")
+        size = os.fstat(self._text_file.fileno()).st_size
+        self._texts = mmap.mmap(self._text_file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    @property
+    def n_chunks(self) -> int:
+        return self.meta["n_chunks"]
+
+    @property
+    def total_length(self) -> int:
+        return self.meta["total_length"]
+
+    def term_df(self, term: str) -> int:
+        term_id = self.vocab.get(term)
+        return int(self.df[term_id]) if term_id is not None else 0
+
+    def chunk(self, index: int) -> dict:
+        return json.loads(self._texts[self.chunk_offsets[index]:self.chunk_offsets[index + 1]])
+
+    def score(self, idfs: dict, allowed_courses: np.ndarray, k: int):
+        if not self.n_chunks:
+            return []
+        scores = np.zeros(self.n_chunks, dtype=np.float32)
+        for term, term_idf in idfs.items():
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                continue
+            start, end = self.ptr[term_id], self.ptr[term_id + 1]
+            # Each doc appears at most once per term, so fancy-index += is safe here
+            scores[self.doc[start:end]] += term_idf * self.weight[start:end]
+        scores[~np.isin(self.chunk_course, allowed_courses)] = 0
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k)[:k]]
+        return [(float(scores[i]), self.chunk(int(i))) for i in candidates]
+
+    @staticmethod
+    def build(path: str, chunks: Iterable[dict]):
+        os.makedirs(path)
+        postings = {} # term -> list of (doc, tf)
+        lengths = []
+        courses = []
+        offsets = [0]
+        with open(os.path.join(path, "chunks.jsonl"), "wb") as text_file:
+            for doc_id, chunk in enumerate(chunks):
+                tokens = tokenize(chunk["title"] + " " + chunk["text"])
+                for term, tf in Counter(tokens).items():
+                    postings.setdefault(term, []).append((doc_id, tf))
+                lengths.append(len(tokens))
+                courses.append(chunk["course_id"])
+                line = json.dumps(chunk).encode()
+                text_file.write(line)
+                offsets.append(offsets[-1] + len(line))
+
+        n_chunks = len(lengths)
+        total_length = int(sum(lengths))
+        avgdl = total_length / n_chunks if n_chunks else 1.0
+        lengths = np.asarray(lengths, dtype=np.float32)
+        vocab = {term: i for i, term in enumerate(sorted(postings))}
+        ptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        df = np.zeros(len(vocab), dtype=np.int32)
+        docs, weights = [], []
+        for term, term_id in vocab.items():
+            entries = postings[term]
+            doc_ids = np.fromiter((d for d, _ in entries), dtype=np.int32, count=len(entries))
+            tfs = np.fromiter((tf for _, tf in entries), dtype=np.float32, count=len(entries))
+            docs.append(doc_ids)
+            weights.append(_saturation(tfs, lengths[doc_ids], avgdl).astype(np.float32))
+            df[term_id] = len(entries)
+            ptr[term_id + 1] = ptr[term_id] + len(entries)
+
+        save = lambda name, array: np.save(os.path.join(path, f"{name}.npy"), array)
+        save("df", df)
+        save("postings_ptr", ptr)
+        save("postings_doc", np.concatenate(docs) if docs else np.zeros(0, dtype=np.int32))
+        save("postings_weight", np.concatenate(weights) if weights else np.zeros(0, dtype=np.float32))
+        save("chunk_course", np.asarray(courses, dtype=np.int32))
+        save("chunk_offsets", np.asarray(offsets, dtype=np.int64))
+        with open(os.path.join(path, "vocab.json"), "w") as f:
+            json.dump(vocab, f)
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"n_chunks": n_chunks, "total_length": total_length, "avgdl": avgdl}, f)
+
+
+class RetrievalIndex:
+    def __init__(self, path: str, version: int = 0):
+        self.path = path
+        self.version = version # shared "retrieval" version this instance loaded
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._compacting = False
+        with _flock(self.lock_path, shared=True): # base and delta from the same swap
+            self._load()
+
+    def _load(self):
+        base_path = os.path.join(self.path, "base")
+        self.base = Segment(base_path) if os.path.exists(os.path.join(base_path, "meta.json")) else None
+        self.delta = []
+        self.delta_df = Counter()
+        self.delta_length = 0
+        self._load_delta()
+
+    @property
+    def delta_path(self) -> str:
+        return os.path.join(self.path, "delta.jsonl")
+
+    @property
+    def lock_path(self) -> str:
+        return os.path.join(self.path, ".lock")
+
+    def _load_delta(self):
+        if not os.path.exists(self.delta_path):
+            return
+        with open(self.delta_path) as f:
+            for line in f:
+                if line.strip():
+                    self._add_to_delta(json.loads(line))
+
+    def _add_to_delta(self, chunk: dict):
+        tf = Counter(tokenize(chunk["title"] + " " + chunk["text"]))
+        self.delta.append((chunk, tf, sum(tf.values())))
+        self.delta_df.update(tf.keys())
+        self.delta_length += sum(tf.values())
+
+    def add_content(self, content: models.Content):
+        self.add_contents([content])
+
+    def add_contents(self, contents: Iterable[models.Content]):
+        # One append, one lock and one shared version bump per batch (bulk imports)
+        chunks = [chunk for content in contents for chunk in content_chunks(content)]
+        if not chunks:
+            return
+        with self._lock, _flock(self.lock_path):
+            with open(self.delta_path, "a") as f:
+                f.write("".join(json.dumps(chunk) + "\n" for chunk in chunks))
+            for chunk in chunks:
+                self._add_to_delta(chunk)
+            needs_compaction = len(self.delta) >= int(os.getenv("RETRIEVAL_COMPACT_THRESHOLD", "500"))
+        shared_state.get_state().bump("retrieval")
+        if needs_compaction:
+            self.compact_in_background()
+
+    def search(self, query: str, course_ids: Iterable[int], k: int = 3) -> List[dict]:
+        terms = set(tokenize(query))
+        allowed = np.asarray(sorted(set(course_ids)), dtype=np.int32)
+        if not terms or not len(allowed):
+            return []
+        base, delta = self.base, list(self.delta)
+        n_docs = (base.n_chunks if base else 0) + len(delta)
+        if not n_docs:
+            return []
+        idfs = {t: float(idf(n_docs, (base.term_df(t) if base else 0) + self.delta_df[t])) for t in terms}
+        results = base.score(idfs, allowed, k) if base else []
+
+        allowed_set = set(allowed.tolist())
+        avgdl = ((base.total_length if base else 0) + self.delta_length) / n_docs or 1.0
+        for chunk, tf, length in delta:
+            if chunk["course_id"] not in allowed_set:
+                continue
+            score = sum(term_idf * _saturation(tf[t], length, avgdl) for t, term_idf in idfs.items() if tf[t])
+            if score > 0:
+                results.append((score, chunk))
+        results.sort(key=lambda item: item[0], reverse=True)
+        return [{**chunk, "score": round(score, 4)} for score, chunk in results[:k]]
+
+    def rebuild(self, db: Session, wait: bool = True) -> bool:
+        # Build a fresh base from the database next to the live one, then swap directories.
+        # Returns False without doing anything when wait=False and another rebuild is running.
+        with _flock(os.path.join(self.path, ".build.lock"), wait=wait) as locked:
+            if not locked:
+                return False
+            # Anything in the delta file by now was committed before the scan below starts
+            with _flock(self.lock_path):
+                carried_from = os.path.getsize(self.delta_path) if os.path.exists(self.delta_path) else 0
+            tmp_path = os.path.join(self.path, f"base.building-{os.getpid()}-{threading.get_ident()}")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            indexed = set()
+            Segment.build(tmp_path, _iter_db_chunks(db, indexed))
+            with self._lock, _flock(self.lock_path):
+                # Chunks any worker appended since the scan started stay in the delta, unless
+                # the scan already picked their content up
+                with open(self.delta_path, "a+") as f:
+                    f.seek(carried_from)
+                    remaining = [line for line in f.read().splitlines()
+                                 if line.strip() and json.loads(line)["content_id"] not in indexed]
+                with open(self.delta_path + ".tmp", "w") as f:
+                    f.write("".join(line + "\n" for line in remaining))
+                base_path = os.path.join(self.path, "base")
+                old_path = base_path + ".old"
+                shutil.rmtree(old_path, ignore_errors=True)
+                if os.path.exists(base_path):
+                    os.rename(base_path, old_path)
+                os.rename(tmp_path, base_path)
+                os.replace(self.delta_path + ".tmp", self.delta_path)
+                shutil.rmtree(old_path, ignore_errors=True)
+                self._load()
+        shared_state.get_state().bump("retrieval")
+        return True
+
+    def compact_in_background(self):
+        with self._lock:
+            if self._compacting:
+                return
+            self._compacting = True
+
+        def run():
+            db = database.SessionLocal()
+            try:
+                self.rebuild(db, wait=False) # another worker already compacting covers it
+            except Exception:
+                logger.exception("Retrieval index compaction failed")
+            finally:
+                db.close()
+                self._compacting = False
+
+        threading.Thread(target=run, name="retrieval-compaction", daemon=True).start()
+
+
+def _iter_db_chunks(db: Session, seen: set = None, batch: int = 200):
+    # `seen` collects the ids of the content rows read
+    last_id = 0
+    while True:
+        rows = db.query(models.Content).filter(
+            models.Content.id > last_id, models.Content.type.notin_(SKIPPED_TYPES)
+        ).order_by(models.Content.id).limit(batch).all()
+        if not rows:
+            return
+        for content in rows:
+            if seen is not None:
+                seen.add(content.id)
+            yield from content_chunks(content)
+        last_id = rows[-1].id
+        db.expunge_all()
+
+
+_index: Optional[RetrievalIndex] = None
+_index_lock = threading.Lock()
+
+
+def index_dir() -> str:
+    return os.getenv("RETRIEVAL_INDEX_DIR", "./retrieval_index")
+
+
+def get_index() -> RetrievalIndex:
+    # Other workers append to delta.jsonl and swap the base directory; a bumped shared
+    # version means this process reloads both from disk
+    global _index
+    version = shared_state.get_state().cached_version("retrieval")
+    if _index is None or _index.version != version:
+        with _index_lock:
+            if _index is None or _index.version != version:
+                _index = RetrievalIndex(index_dir(), version)
+    return _index
+
+
+def ensure_built(db: Session, force: bool = False):
+    # Startup hook: build the base segment on first boot (or after seeding new content)
+    index = get_index()
+    if force or index.base is None:
+        index.rebuild(db)
+
+
+def format_context(chunks: List[dict]) -> str:
+    return "\n\n".join(f"[{i}] {chunk['title']}: {chunk['text']}" for i, chunk in enumerate(chunks, 1))
+
+
+if __name__ == "__main__":
+    # python -m app.retrieval rebuild
+    if sys.argv[1:] != ["rebuild"]:
+        print("usage: python -m app.retrieval rebuild")
+        sys.exit(2)
+    session = database.SessionLocal()
+    try:
+        index = get_index()
+        index.rebuild(session)
+        print(f"Indexed {index.base.n_chunks} chunks into {index.path}.")
+    finally:
+        session.close()
@@ -0,0 +1,185 @@
+import datetime
+import sys
+from collections import defaultdict
+
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from . import archive, database, migrate, models
+
+# Incrementally maintained analytics. Write paths call the event helpers below after adding
+# the source row and before commit, so counters and buckets commit atomically with it.
+# Async sessions go through run_sync, e.g. await db.run_sync(rollups.chat_message).
+
+GRANULARITIES = {
+    "hour": lambda t: t.replace(minute=0, second=0, microsecond=0),
+    "day": lambda t: t.replace(hour=0, minute=0, second=0, microsecond=0),
+}
+METRICS = ("signups", "enrollments", "chat_messages", "llm_latency_ms")
+COUNTERS = ("users", "courses", "enrollments", "revenue")
+
+# Latency is only observed live; backfill keeps these buckets instead of wiping them
+NOT_BACKFILLED = ("llm_latency_ms",)
+
+
+def _insert(db: Session):
+    return postgresql.insert if db.get_bind().dialect.name == "postgresql" else sqlite.insert
+
+
+def bump(db: Session, name: str, delta: int = 1):
+    stmt = _insert(db)(models.AnalyticsCounter).values(name=name, value=delta)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["name"],
+        set_={"value": models.AnalyticsCounter.value + stmt.excluded.value},
+    ))
+
+
+def record(db: Session, metric: str, count: int = 1, total: int = 0, dimension="", at: datetime.datetime = None):
+    at = at or datetime.datetime.utcnow()
+    rows = [
+        {"granularity": granularity, "metric": metric, "bucket_start": truncate(at),
+         "dimension": str(dimension), "count": count, "total": total}
+        for granularity, truncate in GRANULARITIES.items()
+    ]
+    stmt = _insert(db)(models.AnalyticsBucket).values(rows)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["granularity", "metric", "bucket_start", "dimension"],
+        set_={
+            "count": models.AnalyticsBucket.count + stmt.excluded["count"],
+            "total": models.AnalyticsBucket.total + stmt.excluded["total"],
+        },
+    ))
+
+
+def user_registered(db: Session):
+    bump(db, "users")
+    record(db, "signups")
+
+
+def course_created(db: Session, count: int = 1):
+    bump(db, "courses", count)
+
+
+def course_enrolled(db: Session, course: models.Course):
+    bump(db, "enrollments")
+    bump(db, "revenue", course.price or 0)
+    record(db, "enrollments", total=course.price or 0, dimension=course.id)
+
+
+def chat_message(db: Session, count: int = 1):
+    record(db, "chat_messages", count=count)
+
+
+def llm_latency(db: Session, milliseconds: float):
+    record(db, "llm_latency_ms", total=int(milliseconds))
+
+
+def counters(db: Session) -> dict:
+    values = dict(db.query(models.AnalyticsCounter.name, models.AnalyticsCounter.value).filter(
+        models.AnalyticsCounter.name.in_(COUNTERS)
+    ).all())
+    return {name: values.get(name, 0) for name in COUNTERS}
+
+
+def series(db: Session, metric: str, granularity: str, start: datetime.datetime, end: datetime.datetime, dimension=None):
+    bucket = models.AnalyticsBucket
+    query = db.query(bucket.bucket_start, func.sum(bucket.count), func.sum(bucket.total)).filter(
+        bucket.granularity == granularity,
+        bucket.metric == metric,
+        bucket.bucket_start >= GRANULARITIES[granularity](start),
+        bucket.bucket_start <= end,
+    )
+    if dimension is not None:
+        query = query.filter(bucket.dimension == str(dimension))
+    rows = query.group_by(bucket.bucket_start).order_by(bucket.bucket_start).all()
+    return [
+        {"bucket_start": start_at, "count": count, "total": total,
+         "average": round(total / count, 2) if count else None}
+        for start_at, count, total in rows
+    ]
+
+
+def breakdown(db: Session, metric: str, start: datetime.datetime, end: datetime.datetime):
+    # Per-dimension sums over daily buckets, e.g. revenue per course
+    bucket = models.AnalyticsBucket
+    rows = db.query(bucket.dimension, func.sum(bucket.count), func.sum(bucket.total)).filter(
+        bucket.granularity == "day",
+        bucket.metric == metric,
+        bucket.bucket_start >= GRANULARITIES["day"](start),
+        bucket.bucket_start <= end,
+    ).group_by(bucket.dimension).order_by(func.sum(bucket.total).desc()).all()
+    return [{"dimension": dimension, "count": count, "total": total} for dimension, count, total in rows]
+
+
+def backfill(db: Session) -> dict:
+    """Rebuild counters and buckets from the raw tables in one transaction."""
+    db.query(models.AnalyticsCounter).delete(synchronize_session=False)
+    db.query(models.AnalyticsBucket).filter(
+        models.AnalyticsBucket.metric.notin_(NOT_BACKFILLED)
+    ).delete(synchronize_session=False)
+
+    revenue = db.query(func.sum(models.Course.price)).join(
+        models.Enrollment, models.Enrollment.course_id == models.Course.id
+    ).scalar() or 0
+    totals = {
+        "users": db.query(func.count(models.User.id)).scalar(),
+        "courses": db.query(func.count(models.Course.id)).scalar(),
+        "enrollments": db.query(func.count()).select_from(models.Enrollment).scalar(),
+        "revenue": revenue,
+    }
+    db.add_all(models.AnalyticsCounter(name=name, value=value) for name, value in totals.items())
+
+    # (granularity, metric, bucket_start, dimension) -> [count, total]; rows are streamed
+    buckets = defaultdict(lambda: [0, 0])
+
+    def add(metric, at, total=0, dimension=""):
+        if at is None:
+            return
+        for granularity, truncate in GRANULARITIES.items():
+            entry = buckets[(granularity, metric, truncate(at), str(dimension))]
+            entry[0] += 1
+            entry[1] += total
+
+    for (created_at,) in db.query(models.User.created_at).yield_per(1000):
+        add("signups", created_at)
+    for joined_at, course_id, price in db.query(
+        models.Enrollment.joined_at, models.Enrollment.course_id, models.Course.price
+    ).join(models.Course, models.Course.id == models.Enrollment.course_id).yield_per(1000):
+        add("enrollments", joined_at, price or 0, course_id)
+    for (timestamp,) in db.query(models.ChatMessage.timestamp).yield_per(1000):
+        add("chat_messages", timestamp)
+    # Archived sessions' messages only live in their blobs
+    for stored in db.query(models.ChatArchive).yield_per(50):
+        for row in archive.archived_messages(stored):
+            add("chat_messages", row["timestamp"])
+
+    db.bulk_insert_mappings(models.AnalyticsBucket, [
+        {"granularity": g, "metric": m, "bucket_start": b, "dimension": d, "count": c, "total": t}
+        for (g, m, b, d), (c, t) in buckets.items()
+    ])
+    db.commit()
+    return {**totals, "buckets": len(buckets)}
+
+
+def backfill_if_empty(db: Session) -> bool:
+    # Databases created before rollups existed get their counters on first startup
+    if db.query(models.AnalyticsCounter.name).first() is not None:
+        return False
+    if db.query(models.User.id).first() is None and db.query(models.Course.id).first() is None:
+        return False
+    backfill(db)
+    return True
+
+
+if __name__ == "__main__":
+    # python -m app.rollups backfill
+    if sys.argv[1:] != ["backfill"]:
+        print("usage: python -m app.rollups backfill")
+        sys.exit(2)
+    migrate.run()
+    session = database.SessionLocal()
+    try:
+        print(backfill(session))
+    finally:
+        session.close()
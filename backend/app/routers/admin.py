@@ -1,7 +1,8 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from typing import List
-from .. import database, schemas, models, auth
+from typing import List, Optional
+from .. import database, schemas, models, auth, catalog, search, retrieval, rollups, importer
 from pydantic import BaseModel
 
 router = APIRouter(
@@ -24,8 +25,10 @@ class ContentCreate(BaseModel):
 def create_course(course: schemas.CourseCreate, db: Session = Depends(database.get_db), current_user: models.User = Depends(get_current_admin)):
     db_course = models.Course(**course.dict())
     db.add(db_course)
+    rollups.course_created(db)
     db.commit()
     db.refresh(db_course)
+    catalog.invalidate()
     return db_course
 
 @router.post("/courses/{course_id}/content")
@@ -36,5 +39,24 @@ def add_content(course_id: int, content: ContentCreate, db: Session = Depends(da
     
     db_content = models.Content(course_id=course_id, **content.dict())
     db.add(db_content)
+    db.flush()
+    search.index_content(db, db_content)
     db.commit()
+    catalog.invalidate()
+    retrieval.get_index().add_content(db_content)
     return {"message": "Content added successfully"}
+
+@router.post("/import")
+async def import_catalogue(
+    request: Request,
+    format: Optional[str] = None,
+    batch_size: int = importer.BATCH_SIZE,
+    db: AsyncSession = Depends(database.get_async_db),
+    current_user: models.User = Depends(get_current_admin),
+):
+    # Body is NDJSON (default, application/x-ndjson) or CSV (text/csv or ?format=csv); see app/importer.py
+    format = format or ("csv" if request.headers.get("content-type", "").startswith("text/csv") else "ndjson")
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'csv'")
+    rows = importer.iter_csv(request.stream()) if format == "csv" else importer.iter_ndjson(request.stream())
+    return await importer.ImportJob(batch_size).run(db, rows)
@@ -1,7 +1,8 @@
+import datetime
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from .. import database, models, auth
+from typing import Optional
+from .. import database, models, auth, llm_cache, rollups, archive, entitlements
 
 router = APIRouter(
     prefix="/analytics",
@@ -15,17 +16,64 @@ def get_current_owner(current_user: models.User = Depends(auth.get_current_activ
     return current_user
 
 @router.get("/dashboard")
-def get_dashboard_stats(db: Session = Depends(database.get_db), current_user: models.User = Depends(get_current_owner)):
-    total_users = db.query(models.User).count()
-    total_courses = db.query(models.Course).count()
-    total_enrollments = db.query(models.Enrollment).count()
-    total_revenue = db.query(
-        func.sum(models.Course.price)
-    ).join(models.Enrollment, models.Enrollment.course_id == models.Course.id).scalar() or 0
+def get_dashboard_stats(db: Session = Depends(database.get_read_db), current_user: models.User = Depends(get_current_owner)):
+    # Four counter rows maintained by the write paths (see app/rollups.py)
+    counters = rollups.counters(db)
+    return {
+        "total_users": counters["users"],
+        "total_courses": counters["courses"],
+        "total_enrollments": counters["enrollments"],
+        "total_revenue": counters["revenue"]
+    }
+
+def resolve_range(start: Optional[datetime.datetime], end: Optional[datetime.datetime], default: datetime.timedelta):
+    end = end or datetime.datetime.utcnow()
+    start = start or end - default
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    return start, end
+
+@router.get("/series")
+def get_series(
+    metric: str,
+    granularity: str = "day",
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    dimension: Optional[str] = None,
+    db: Session = Depends(database.get_read_db),
+    current_user: models.User = Depends(get_current_owner),
+):
+    if metric not in rollups.METRICS:
+        raise HTTPException(status_code=400, detail=f"Unknown metric, expected one of: {', '.join(rollups.METRICS)}")
+    if granularity not in rollups.GRANULARITIES:
+        raise HTTPException(status_code=400, detail="granularity must be 'hour' or 'day'")
+    default = datetime.timedelta(days=2) if granularity == "hour" else datetime.timedelta(days=30)
+    start, end = resolve_range(start, end, default)
+    return rollups.series(db, metric, granularity, start, end, dimension)
+
+@router.get("/revenue/by-course")
+def get_revenue_by_course(
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    db: Session = Depends(database.get_read_db),
+    current_user: models.User = Depends(get_current_owner),
+):
+    start, end = resolve_range(start, end, datetime.timedelta(days=30))
+    return [
+        {"course_id": int(row["dimension"]), "enrollments": row["count"], "revenue": row["total"]}
+        for row in rollups.breakdown(db, "enrollments", start, end)
+    ]
+
+@router.get("/storage")
+def get_storage_report(db: Session = Depends(database.get_read_db), current_user: models.User = Depends(get_current_owner)):
+    # Result of the last archival/compaction run, by any worker or the cron CLI
+    return archive.last_report(db) or {"finished_at": None}
 
+@router.get("/cache")
+def get_cache_stats(current_user: models.User = Depends(get_current_owner)):
+    cache = llm_cache.get_cache()
     return {
-        "total_users": total_users,
-        "total_courses": total_courses,
-        "total_enrollments": total_enrollments,
-        "total_revenue": total_revenue
+        "llm_response_cache": cache.snapshot() if cache else {"enabled": False},
+        "principal_cache": auth.principal_cache_snapshot(),
+        "entitlement_cache": entitlements.snapshot(),
     }
@@ -1,21 +1,36 @@
 from datetime import timedelta
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy import or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi.security import OAuth2PasswordRequestForm
-from .. import database, schemas, models, auth
+from .. import database, schemas, models, auth, rollups
 
 router = APIRouter(
     prefix="/auth",
     tags=["Authentication"]
 )
 
+async def registration_conflict(db: AsyncSession, user: schemas.UserCreate):
+    # Username and email are both unique; say which one is taken
+    taken = (await db.execute(select(models.User.username, models.User.email).where(
+        or_(models.User.username == user.username, models.User.email == user.email)
+    ))).all()
+    if any(row.username == user.username for row in taken):
+        return "Username already registered"
+    if taken:
+        return "Email already registered"
+    return None
+
 @router.post("/register", response_model=schemas.UserResponse)
-def register(user: schemas.UserCreate, db: Session = Depends(database.get_db)):
-    db_user = db.query(models.User).filter(models.User.username == user.username).first()
-    if db_user:
-        raise HTTPException(status_code=400, detail="Username already registered")
+async def register(user: schemas.UserCreate, db: AsyncSession = Depends(database.get_async_db)):
+    conflict = await registration_conflict(db, user)
+    if conflict:
+        raise HTTPException(status_code=400, detail=conflict)
+    # Release the connection while hashing; the unique index catches a concurrent duplicate
+    await db.commit()
     
-    hashed_password = auth.get_password_hash(user.password)
+    hashed_password = await auth.get_password_hash_async(user.password)
     new_user = models.User(
         username=user.username,
         email=user.email,
@@ -23,22 +38,34 @@ def register(user: schemas.UserCreate, db: Session = Depends(database.get_db)):
         role=user.role
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.run_sync(rollups.user_registered)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        conflict = await registration_conflict(db, user)
+        raise HTTPException(status_code=400, detail=conflict or "Username or email already registered")
     return new_user
 
 @router.post("/token", response_model=schemas.Token)
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(database.get_db)):
-    user = db.query(models.User).filter(models.User.username == form_data.username).first()
-    if not user or not auth.verify_password(form_data.password, user.hashed_password):
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(database.get_async_db)):
+    user = (await db.execute(select(models.User).where(models.User.username == form_data.username))).scalars().first()
+    # Don't hold a connection while verifying on the hasher pool
+    await db.commit()
+    verified, new_hash = await auth.verify_password_async(form_data.password, user.hashed_password) if user else (False, None)
+    if not verified:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if new_hash:
+        # Argon2 parameters changed since this hash was made: upgrade it transparently
+        user.hashed_password = new_hash
+        await db.commit()
     access_token_expires = timedelta(minutes=auth.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = auth.create_access_token(
-        data={"sub": user.username, "role": user.role}, expires_delta=access_token_expires
+        data=auth.principal_claims(user), expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -1,7 +1,9 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from typing import List
-from .. import database, schemas, models, auth
+from typing import List, Optional
+from sqlalchemy import and_
+from .. import database, schemas, models, auth, catalog, pagination, rollups, entitlements, content_store, responses
 from pydantic import BaseModel
 
 router = APIRouter(
@@ -9,29 +11,50 @@ router = APIRouter(
     tags=["Courses"]
 )
 
+COURSE_FIELDS = ("id", "title", "description", "price", "image_url")
+
 @router.get("", response_model=List[schemas.CourseResponse])
-def get_courses(db: Session = Depends(database.get_db)):
-    # Seed mock courses if empty
-    if db.query(models.Course).count() == 0:
-        seed_courses = [
-            models.Course(title="Advanced React Patterns", description="Master Request", price=4999, image_url="https://via.placeholder.com/300/0f172a/eca338?text=React"),
-            models.Course(title="FastAPI Masterclass", description="Build high-performance APIs", price=3999, image_url="https://via.placeholder.com/300/0f172a/eca338?text=FastAPI"),
-            models.Course(title="AI Engineering 101", description="Integrate LLMs into apps", price=5999, image_url="https://via.placeholder.com/300/0f172a/eca338?text=AI"),
-        ]
-        db.add_all(seed_courses)
-        db.commit()
-        
-        # Seed Content
-        for course in seed_courses:
-            db.refresh(course)
-            contents = [
-                models.Content(course_id=course.id, title="Welcome to the Course", type="text", data=f"Welcome to {course.title}! Here is your overview."),
-                models.Content(course_id=course.id, title="Chapter 1: Getting Started", type="video", data="https://www.youtube.com/watch?v=dQw4w9WgXcQ"), # Placeholder
-                models.Content(course_id=course.id, title="Study Notes", type="text", data="1. Key Concept A\n2. Key Concept B\n3. Summary"),
-            ]
-            db.add_all(contents)
-        db.commit()
-    return db.query(models.Course).all()
+def get_courses(
+    request: Request,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    title_prefix: Optional[str] = None,
+    min_price: Optional[int] = None,
+    max_price: Optional[int] = None,
+    fields: Optional[str] = None,
+    db: Session = Depends(database.get_read_db),
+):
+    if any(param is not None for param in (limit, cursor, title_prefix, min_price, max_price, fields)):
+        return query_courses(db, limit, cursor, title_prefix, min_price, max_price, fields)
+
+    # Unfiltered catalogue: cached body with ETag / 304 support
+    body, etag = catalog.get_catalog(db)
+    headers = {"ETag": etag, "Cache-Control": "public, no-cache"}
+    if catalog.etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def query_courses(db: Session, limit, cursor, title_prefix, min_price, max_price, fields):
+    limit = pagination.clamp_limit(limit)
+    selected = pagination.parse_fields(fields, COURSE_FIELDS)
+    if selected:
+        query = db.query(models.Course.id, *[getattr(models.Course, f) for f in selected if f != "id"])
+    else:
+        query = db.query(models.Course)
+    if title_prefix:
+        # Range instead of LIKE so the title index can be used
+        query = query.filter(models.Course.title >= title_prefix, models.Course.title < title_prefix + "\uffff")
+    if min_price is not None:
+        query = query.filter(models.Course.price >= min_price)
+    if max_price is not None:
+        query = query.filter(models.Course.price <= max_price)
+    cursor_values = pagination.decode_cursor(cursor, (int,))
+    if cursor_values:
+        query = query.filter(models.Course.id > cursor_values[0])
+
+    rows = query.order_by(models.Course.id).limit(limit + 1).all()
+    rows, next_values = pagination.split_page(rows, limit, lambda row: [row.id])
+    return pagination.projected_response(rows, selected or COURSE_FIELDS, pagination.page_headers(next_values))
 
 @router.post("/{course_id}/buy")
 def buy_course(course_id: int, db: Session = Depends(database.get_db), current_user: models.User = Depends(auth.get_current_active_user)):
@@ -52,26 +75,72 @@ def buy_course(course_id: int, db: Session = Depends(database.get_db), current_u
     
     enrollment = models.Enrollment(user_id=current_user.id, course_id=course_id)
     db.add(enrollment)
+    rollups.course_enrolled(db, course)
     db.commit()
     
     return {"message": "Course purchased successfully", "course_title": course.title}
 
 @router.get("/my", response_model=List[schemas.CourseResponse])
-def get_my_courses(db: Session = Depends(database.get_db), current_user: models.User = Depends(auth.get_current_active_user)):
-    enrollments = db.query(models.Enrollment).filter(models.Enrollment.user_id == current_user.id).all()
-    course_ids = [e.course_id for e in enrollments]
-    return db.query(models.Course).filter(models.Course.id.in_(course_ids)).all()
+def get_my_courses(db: Session = Depends(database.get_read_db), current_user: models.User = Depends(auth.get_current_active_user)):
+    version = entitlements.current_version(current_user.id)
+    courses = db.query(models.Course).join(
+        models.Enrollment, models.Enrollment.course_id == models.Course.id
+    ).filter(models.Enrollment.user_id == current_user.id).order_by(models.Course.id).all()
+    # The dashboard loads this first, so the content pages that follow hit a warm entitlement cache
+    entitlements.remember(current_user.id, (course.id for course in courses), version)
+    return courses
 
 @router.get("/{course_id}/content", response_model=List[schemas.ContentResponse])
-def get_course_content(course_id: int, db: Session = Depends(database.get_db), current_user: models.User = Depends(auth.get_current_active_user)):
-    # Verify enrollment
-    enrollment = db.query(models.Enrollment).filter(
-        models.Enrollment.user_id == current_user.id,
-        models.Enrollment.course_id == course_id
-    ).first()
-    
-    # Allow Owner/Admin to view without enrollment
-    if not enrollment and current_user.role not in [models.UserRole.ADMIN, models.UserRole.OWNER]:
+def get_course_content(course_id: int, db: Session = Depends(database.get_read_db), current_user: models.User = Depends(auth.get_current_active_user)):
+    # Allow Owner/Admin to view without enrollment; everyone else goes through entitlements
+    if not entitlements.is_privileged(current_user):
+        course_ids = entitlements.cached_course_ids(current_user.id)
+        if course_ids is None:
+            return content_if_enrolled(db, current_user, course_id)
+        if course_id not in course_ids:
+            raise HTTPException(status_code=403, detail="Not enrolled in this course")
+    return db.query(models.Content).filter(models.Content.course_id == course_id).order_by(models.Content.id).all()
+
+def content_if_enrolled(db: Session, user: models.User, course_id: int):
+    # Cold entitlement cache: enrollment check and content fetch in one query. Rooted at the
+    # course so an enrolled course without content still yields a row.
+    rows = db.query(models.Enrollment.user_id, models.Content).select_from(models.Course).outerjoin(
+        models.Enrollment,
+        and_(models.Enrollment.course_id == models.Course.id, models.Enrollment.user_id == user.id),
+    ).outerjoin(models.Content, models.Content.course_id == models.Course.id).filter(
+        models.Course.id == course_id
+    ).order_by(models.Content.id).all()
+    if not rows or rows[0][0] is None:
         raise HTTPException(status_code=403, detail="Not enrolled in this course")
-    
-    return db.query(models.Content).filter(models.Content.course_id == course_id).all()
+    return [content for _, content in rows if content is not None]
+
+@router.get("/{course_id}/content/{content_id}/body")
+def get_content_body(course_id: int, content_id: int, request: Request, db: Session = Depends(database.get_read_db), current_user: models.User = Depends(auth.get_current_active_user)):
+    # Streams one content body from the row or the blob store, with ETag/If-None-Match and
+    # single-range (Range/If-Range) support so large material can be fetched in pieces
+    if not entitlements.can_access(db, current_user, course_id):
+        raise HTTPException(status_code=403, detail="Not enrolled in this course")
+    content = db.query(models.Content).filter(models.Content.id == content_id, models.Content.course_id == course_id).first()
+    if not content:
+        raise HTTPException(status_code=404, detail="Content not found")
+
+    etag = content_store.etag(content)
+    size = content.size if content.size is not None else len(content_store.body_bytes(content))
+    headers = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "private, no-cache"}
+    if catalog.etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    media_type = "text/plain; charset=utf-8"
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range == etag):
+        try:
+            byte_range = responses.parse_byte_range(range_header, size)
+        except ValueError:
+            raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+        if byte_range:
+            start, end = byte_range
+            headers.update({"Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(end - start + 1)})
+            return StreamingResponse(content_store.iter_body(content, start, end), status_code=206, media_type=media_type, headers=headers)
+    headers["Content-Length"] = str(size)
+    return StreamingResponse(content_store.iter_body(content), media_type=media_type, headers=headers)
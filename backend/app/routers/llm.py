@@ -1,8 +1,17 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from .. import database, schemas, models, auth
-import openai
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import raiseload, selectinload
+from typing import List, Literal, Optional
+from .. import database, schemas, models, auth, llm_providers, llm_cache, chat_context, pagination, rollups, archive, shared_state, jobs, responses
+import anyio
+import asyncio
+import json
 import os
+import time
 
 router = APIRouter(
     prefix="/llm",
@@ -10,95 +19,359 @@ router = APIRouter(
 )
 
 # Mocking LLM response if no API key is present for initial testing
-import google.generativeai as genai
+# (the stub provider is selected automatically when LLM_API_KEY is unset)
+async def generate_reply(history: list, use_cache: bool = True) -> str:
+    # Provider errors propagate; callers decide between an HTTP error, an error reply and a retry
+    cache = llm_cache.get_cache() if use_cache else None
+    key = cache.key(history) if cache else None
+    if key:
+        cached = await cache.get(key)
+        if cached is not None:
+            return cached
+    response_text = await llm_providers.generate(history)
+    if key and response_text != llm_providers.EMPTY_RESPONSE_TEXT:
+        await cache.set(key, response_text)
+    return response_text
 
-# Mocking LLM response if no API key is present for initial testing
-async def get_llm_response(history: list):
-    api_key = os.getenv("LLM_API_KEY")
-    if not api_key:
-        last_msg = history[-1]["parts"][0]
-        return f"Mock response: I received your message '{last_msg}'. (Set LLM_API_KEY to get real responses)"
-    
-    genai.configure(api_key=api_key)
-    # Using 'gemini-flash-latest' as it is typically the most efficient/generous tier
-    model = genai.GenerativeModel('gemini-flash-latest')
-    
-    import time
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            # Generate content with history
-            # For multi-turn chat, we usually use start_chat, but here we reconstruct history each time
-            # forstateless REST API. generate_content can take a list of contents.
-            response = model.generate_content(history)
-            if response.candidates and response.candidates[0].content.parts:
-                return response.text
-            else: 
-                return "I apologize, but I couldn't generate a response to that. Please try rephrasing your question."
-        except Exception as e:
-            error_str = str(e)
-            if "429" in error_str and attempt < max_retries - 1:
-                # Error suggests ~20-30s wait. Increasing backoff to cover this window.
-                # attempt 0: wait 10s
-                # attempt 1: wait 20s
-                # attempt 2: wait 30s
-                time.sleep(10 * (attempt + 1)) 
-                continue
-            return f"Error communicating with Gemini: {error_str}"
-
-@router.post("/chat", response_model=schemas.ChatMessageResponse)
-async def chat(request: schemas.ChatRequest, db: Session = Depends(database.get_db), current_user: models.User = Depends(auth.get_current_active_user)):
-    
+async def get_llm_response(history: list, use_cache: bool = True):
+    try:
+        return await generate_reply(history, use_cache)
+    except llm_providers.LLMBusyError as e:
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(int(e.retry_after))},
+        )
+    except Exception as e:
+        return f"Error communicating with Gemini: {e}"
+
+async def stream_llm_response(history: list, use_cache: bool = True):
+    cache = llm_cache.get_cache() if use_cache else None
+    key = cache.key(history) if cache else None
+    if key:
+        cached = await cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+    parts = []
+    async for chunk in llm_providers.stream(history):
+        parts.append(chunk)
+        yield chunk
+    response_text = "".join(parts)
+    if key and response_text != llm_providers.EMPTY_RESPONSE_TEXT:
+        await cache.set(key, response_text)
+
+async def start_turn(request: schemas.ChatRequest, db: AsyncSession, current_user: models.User, background_tasks: BackgroundTasks = None):
     # Create session if not provided
     if not request.session_id:
-        session = models.StudySession(user_id=current_user.id, topic=request.topic or "General Study")
+        session = models.StudySession(user_id=current_user.id, topic=request.topic or "General Study", cache_opt_out=bool(request.cache_opt_out))
         db.add(session)
-        db.commit()
-        db.refresh(session)
+        await db.commit()
         session_id = session.id
     else:
-        session = db.query(models.StudySession).filter(models.StudySession.id == request.session_id, models.StudySession.user_id == current_user.id).first()
+        session = (await db.execute(
+            select(models.StudySession).where(models.StudySession.id == request.session_id, models.StudySession.user_id == current_user.id)
+        )).scalars().first()
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
         session_id = session.id
+        if request.cache_opt_out is not None and request.cache_opt_out != session.cache_opt_out:
+            session.cache_opt_out = request.cache_opt_out
+        # Reopening an archived session moves its history back into chat_messages
+        await db.run_sync(archive.rehydrate, session)
 
     # Store User Message
     user_msg = models.ChatMessage(session_id=session_id, role="user", content=request.message)
     db.add(user_msg)
-    db.commit()
-    db.refresh(user_msg)
-    
-    # Fetch History (Last 20 messages for context)
-    history_records = db.query(models.ChatMessage).filter(
-        models.ChatMessage.session_id == session_id
-    ).order_by(models.ChatMessage.timestamp.asc()).limit(20).all()
+    await db.run_sync(rollups.chat_message)
+    await db.commit()
     
+    # Fetch the most recent turns that fit the token budget; older turns are
+    # represented by the session's rolling summary instead
+    history_records, overflow = await chat_context.select_recent_messages(db, session, chat_context.context_token_budget())
+    if overflow and background_tasks is not None:
+        background_tasks.add_task(chat_context.refresh_summary, session_id, history_records[0].id)
+
+    # Ground the answer in the user's own course material (part of history[0], so of the cache key too)
+    course_context = await chat_context.retrieve_course_context(db, current_user, request.message)
+
     # Format for Gemini
-    history = []
-    # Add System Prompt
-    history.append({
-        "role": "user",
-        "parts": ["You are an elite AI Study Assistant. Your goal is to help students learn faster, explain complex topics simply, and provide study plans. Be encouraging, concise, and professional."]
-    })
-    history.append({
-        "role": "model",
-        "parts": ["Understood. I am ready to assist with any study inquiries."]
-    })
-
-    for msg in history_records:
-        role = "user" if msg.role == "user" else "model"
-        history.append({"role": role, "parts": [msg.content]})
+    history = chat_context.build_history(session, history_records, course_context)
+
+    # End the read transaction so no connection is held while waiting on the LLM
+    await db.commit()
+
+    return session, history
+
+def chat_rate_limit(current_user: models.User = Depends(auth.get_current_active_user)):
+    # Per-user turns per window, counted in shared state so the limit holds across workers
+    limit = int(os.getenv("LLM_USER_RATE_LIMIT", "0"))
+    if limit <= 0:
+        return
+    window = float(os.getenv("LLM_USER_RATE_WINDOW_SECONDS", "60"))
+    retry_after = shared_state.get_state().hit(f"chat:{current_user.id}", limit, window)
+    if retry_after is not None:
+        raise HTTPException(status_code=429, detail="Too many chat requests, please slow down",
+                            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))})
+
+CHAT_JOB_PRIORITY = int(os.getenv("LLM_CHAT_JOB_PRIORITY", "10"))
+JOB_MAX_WAIT_SECONDS = float(os.getenv("JOB_MAX_WAIT_SECONDS", "30"))
+
+def job_response(job: dict) -> dict:
+    return {**job, "session_id": job["payload"].get("session_id"), "status_url": f"/llm/jobs/{job['id']}"}
+
+@router.post("/chat", response_model=schemas.ChatMessageResponse, dependencies=[Depends(chat_rate_limit)],
+             responses={202: {"model": schemas.JobResponse, "description": "Reply queued (mode=async)"}})
+async def chat(request: schemas.ChatRequest, background_tasks: BackgroundTasks, mode: Optional[Literal["sync", "async"]] = None, db: AsyncSession = Depends(database.get_async_db), current_user: models.User = Depends(auth.get_current_active_user)):
+    session, history = await start_turn(request, db, current_user, background_tasks)
+
+    # Async mode: the reply is generated by a job worker (app/jobs.py) and the client polls
+    # GET /llm/jobs/{id}, so no connection stays open for the length of the generation
+    if (mode or os.getenv("LLM_CHAT_MODE", "sync")) == "async":
+        queue = jobs.get_queue()
+        job_id = await asyncio.to_thread(
+            queue.enqueue, "chat_reply",
+            {"session_id": session.id, "history": history, "use_cache": not session.cache_opt_out},
+            user_id=current_user.id, priority=CHAT_JOB_PRIORITY,
+        )
+        job = job_response(await asyncio.to_thread(queue.get, job_id))
+        return responses.FastJSONResponse(
+            jsonable_encoder(schemas.JobResponse.model_validate(job)), status_code=202, headers={"Location": job["status_url"]},
+        )
 
     # Get LLM Response
-    ai_response_content = await get_llm_response(history)
-    
-    # Store AI Message
+    started = time.monotonic()
+    ai_response_content = await get_llm_response(history, use_cache=not session.cache_opt_out)
+    latency_ms = (time.monotonic() - started) * 1000
     
     # Store AI Message
-    ai_msg = models.ChatMessage(session_id=session_id, role="ai", content=ai_response_content)
+    ai_msg = models.ChatMessage(session_id=session.id, role="ai", content=ai_response_content)
     db.add(ai_msg)
+    await db.run_sync(rollups.chat_message)
+    await db.run_sync(rollups.llm_latency, latency_ms)
     
-    db.commit()
-    db.refresh(ai_msg)
+    # Defaults are client-side and expire_on_commit is off, so no refresh (and no new
+    # transaction holding the writer connection) is needed before returning
+    await db.commit()
     
     return ai_msg
+
+async def job_reply(job_id: int):
+    async with database.get_async_sessionmaker()() as db:
+        return (await db.execute(select(models.ChatMessage).where(models.ChatMessage.job_id == job_id))).scalar_one_or_none()
+
+async def store_job_reply(job: dict, content: str, latency_ms: Optional[float] = None) -> dict:
+    # The queue delivers at least once; the unique job_id makes a second store a no-op
+    async with database.get_async_sessionmaker()() as db:
+        ai_msg = models.ChatMessage(session_id=job["payload"]["session_id"], role="ai", content=content, job_id=job["id"])
+        db.add(ai_msg)
+        await db.run_sync(rollups.chat_message)
+        if latency_ms is not None:
+            await db.run_sync(rollups.llm_latency, latency_ms)
+        try:
+            await db.commit()
+        except IntegrityError:
+            await db.rollback()
+            ai_msg = await job_reply(job["id"])
+    return {"message": jsonable_encoder(schemas.ChatMessageResponse.model_validate(ai_msg))}
+
+async def run_chat_job(job: dict) -> dict:
+    # jobs.HANDLERS["chat_reply"]: generate and store the reply for a turn queued by /chat?mode=async
+    existing = await job_reply(job["id"])
+    if existing is not None: # stored by an earlier attempt that lost its lease before completing
+        return {"message": jsonable_encoder(schemas.ChatMessageResponse.model_validate(existing))}
+    payload = job["payload"]
+    started = time.monotonic()
+    try:
+        ai_response_content = await generate_reply(payload["history"], payload["use_cache"])
+    except llm_providers.LLMBusyError as e:
+        raise jobs.RetryableJobError(str(e), e.retry_after)
+    return await store_job_reply(job, ai_response_content, (time.monotonic() - started) * 1000)
+
+async def chat_job_failed(job: dict, error: str):
+    # jobs.FAILURE_HANDLERS["chat_reply"]: the turn gets the same error reply as sync mode
+    if await job_reply(job["id"]) is None:
+        await store_job_reply(job, f"Error communicating with Gemini: {error}")
+
+@router.get("/jobs/{job_id}", response_model=schemas.JobResponse)
+async def get_job(job_id: int, wait: float = 0, current_user: models.User = Depends(auth.get_current_active_user)):
+    # Poll, or long-poll with ?wait=<seconds> (capped at JOB_MAX_WAIT_SECONDS): the reply
+    # comes back as soon as the job finishes or when the wait runs out, whichever is first
+    queue = jobs.get_queue()
+    job = await asyncio.to_thread(queue.get, job_id)
+    if job is None or job["user_id"] != current_user.id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if wait > 0 and job["status"] not in jobs.FINISHED:
+        job = await queue.wait(job_id, min(wait, JOB_MAX_WAIT_SECONDS))
+    return job_response(job)
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@router.post("/chat/stream", dependencies=[Depends(chat_rate_limit)])
+async def chat_stream(request: schemas.ChatRequest, http_request: Request, background_tasks: BackgroundTasks, db: AsyncSession = Depends(database.get_async_db), current_user: models.User = Depends(auth.get_current_active_user)):
+    # Reject before the 200 + stream headers go out if we already know we can't serve it
+    limiter = llm_providers.get_limiter()
+    if limiter.is_saturated():
+        raise HTTPException(status_code=503, detail="LLM service is busy, please retry shortly", headers={"Retry-After": "5"})
+
+    session, history = await start_turn(request, db, current_user, background_tasks)
+    session_id = session.id
+    use_cache = not session.cache_opt_out
+    checkpoint_seconds = float(os.getenv("LLM_STREAM_CHECKPOINT_SECONDS", "2"))
+
+    async def event_stream():
+        parts = []
+        ai_msg = None
+        persisted_parts = 0
+        last_checkpoint = started = time.monotonic()
+
+        async def persist():
+            # One row per reply: inserted at the first checkpoint and updated in place afterwards
+            nonlocal ai_msg, persisted_parts
+            if len(parts) == persisted_parts:
+                return
+            persisted_parts = len(parts)
+            if ai_msg is None:
+                ai_msg = models.ChatMessage(session_id=session_id, role="ai", content="".join(parts))
+                db.add(ai_msg)
+                await db.run_sync(rollups.chat_message)
+            else:
+                ai_msg.content = "".join(parts)
+            await db.commit()
+
+        yield sse_event("session", {"session_id": session_id})
+        upstream = stream_llm_response(history, use_cache)
+        try:
+            async for chunk in upstream:
+                if await http_request.is_disconnected():
+                    break
+                parts.append(chunk)
+                yield sse_event("token", {"text": chunk})
+                if time.monotonic() - last_checkpoint >= checkpoint_seconds:
+                    await persist()
+                    last_checkpoint = time.monotonic()
+            else:
+                await db.run_sync(rollups.llm_latency, (time.monotonic() - started) * 1000)
+                await persist()
+                await db.commit()
+                if ai_msg is not None:
+                    message = schemas.ChatMessageResponse.model_validate(ai_msg)
+                    yield sse_event("done", json.loads(message.model_dump_json()))
+        except llm_providers.LLMBusyError as e:
+            yield sse_event("error", {"detail": str(e), "retry_after": e.retry_after})
+        except Exception as e:
+            parts.append(f"Error communicating with Gemini: {e}")
+            await persist()
+            yield sse_event("error", {"detail": str(e)})
+        finally:
+            # Client went away (break above, or the task was cancelled): stop the upstream
+            # generation and keep whatever text was already produced.
+            with anyio.CancelScope(shield=True):
+                await upstream.aclose()
+                await persist()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Session reads spell out their loader strategy: the newest message comes from one batched
+# selectinload, and any other relationship access raises instead of loading a full history
+SESSION_LOAD_OPTIONS = (selectinload(models.StudySession.last_message), raiseload("*"))
+
+@router.get("/sessions", response_model=List[schemas.StudySessionResponse])
+async def get_sessions(
+    response: Response,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(database.get_async_read_db),
+    current_user: models.User = Depends(auth.get_current_active_user),
+):
+    # Newest first, keyset on id (ix_study_sessions_user_id_id)
+    limit = pagination.clamp_limit(limit)
+    query = select(models.StudySession).where(models.StudySession.user_id == current_user.id)
+    cursor_values = pagination.decode_cursor(cursor, (int,))
+    if cursor_values:
+        query = query.where(models.StudySession.id < cursor_values[0])
+    rows = (await db.execute(
+        query.options(*SESSION_LOAD_OPTIONS).order_by(models.StudySession.id.desc()).limit(limit + 1)
+    )).scalars().all()
+    rows, next_values = pagination.split_page(rows, limit, lambda row: [row.id])
+    response.headers.update(pagination.page_headers(next_values))
+    return rows
+
+@router.get("/sessions/{session_id}", response_model=schemas.StudySessionResponse)
+async def get_session(session_id: int, db: AsyncSession = Depends(database.get_async_read_db), current_user: models.User = Depends(auth.get_current_active_user)):
+    session = (await db.execute(
+        select(models.StudySession).where(
+            models.StudySession.id == session_id, models.StudySession.user_id == current_user.id
+        ).options(*SESSION_LOAD_OPTIONS)
+    )).scalars().first()
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return session
+
+MESSAGE_FIELDS = ("id", "session_id", "role", "content", "timestamp")
+
+@router.get("/messages", response_model=List[schemas.ChatMessageResponse])
+async def get_message_history(
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(database.get_async_read_db),
+    current_user: models.User = Depends(auth.get_current_active_user),
+):
+    # All of the user's messages, newest session first and newest message first within it.
+    # Keyset on (session_id, id), which is exactly ix_chat_messages_session_id_id.
+    limit = pagination.clamp_limit(limit)
+    owned_sessions = select(models.StudySession.id).where(models.StudySession.user_id == current_user.id)
+    query = select(models.ChatMessage).where(models.ChatMessage.session_id.in_(owned_sessions))
+    cursor_values = pagination.decode_cursor(cursor, (int, int))
+    if cursor_values:
+        query = query.where(pagination.after([models.ChatMessage.session_id, models.ChatMessage.id], cursor_values, descending=True))
+    rows = (await db.execute(
+        query.order_by(models.ChatMessage.session_id.desc(), models.ChatMessage.id.desc()).limit(limit + 1)
+    )).scalars().all()
+    rows, next_values = pagination.split_page(rows, limit, lambda row: [row.session_id, row.id])
+    return pagination.projected_response(rows, MESSAGE_FIELDS, pagination.page_headers(next_values))
+
+@router.get("/sessions/{session_id}/messages", response_model=List[schemas.ChatMessageResponse])
+async def get_session_messages(
+    session_id: int,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: AsyncSession = Depends(database.get_async_read_db),
+    current_user: models.User = Depends(auth.get_current_active_user),
+):
+    session = (await db.execute(
+        select(models.StudySession.id, models.StudySession.archived_at).where(models.StudySession.id == session_id, models.StudySession.user_id == current_user.id)
+    )).first()
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    # Newest first, keyset on id within the session (ix_chat_messages_session_id_id)
+    limit = pagination.clamp_limit(limit)
+    selected = pagination.parse_fields(fields, MESSAGE_FIELDS)
+    cursor_values = pagination.decode_cursor(cursor, (int,))
+    if session.archived_at is not None:
+        # Read-only view of cold storage; the session is only rehydrated when chatted in again
+        stored = await db.get(models.ChatArchive, session_id)
+        rows = [models.ChatMessage(**row) for row in reversed(archive.archived_messages(stored))] if stored else []
+        if cursor_values:
+            rows = [row for row in rows if row.id < cursor_values[0]]
+        rows, next_values = pagination.split_page(rows[:limit + 1], limit, lambda row: [row.id])
+        return pagination.projected_response(rows, selected or MESSAGE_FIELDS, pagination.page_headers(next_values))
+    if selected:
+        query = select(models.ChatMessage.id, *[getattr(models.ChatMessage, f) for f in selected if f != "id"])
+    else:
+        query = select(models.ChatMessage)
+    query = query.where(models.ChatMessage.session_id == session_id)
+    if cursor_values:
+        query = query.where(models.ChatMessage.id < cursor_values[0])
+
+    result = await db.execute(query.order_by(models.ChatMessage.id.desc()).limit(limit + 1))
+    rows = result.all() if selected else result.scalars().all()
+    rows, next_values = pagination.split_page(rows, limit, lambda row: [row.id])
+    return pagination.projected_response(rows, selected or MESSAGE_FIELDS, pagination.page_headers(next_values))
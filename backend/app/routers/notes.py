@@ -1,9 +1,11 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
-from .. import database, schemas, models, auth
-from pydantic import BaseModel, ConfigDict
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Literal, Optional
+from .. import database, schemas, models, auth, pagination, search
+from pydantic import BaseModel, ConfigDict, Field, model_validator
 import datetime
+import os
 
 router = APIRouter(
     prefix="/notes",
@@ -19,41 +21,269 @@ class NoteCreate(NoteBase):
 
 class NoteResponse(NoteBase):
     id: int
+    version: int
     created_at: datetime.datetime
     updated_at: datetime.datetime
 
     model_config = ConfigDict(from_attributes=True)
 
+async def get_owned_note(db: AsyncSession, note_id: int, current_user: models.User):
+    result = await db.execute(select(models.Note).where(models.Note.id == note_id, models.Note.user_id == current_user.id))
+    return result.scalars().first()
+
+NOTE_FIELDS = ("id", "title", "content", "version", "created_at", "updated_at")
+
+async def next_change_seq(db: AsyncSession, user_id: int) -> int:
+    # Every write to a user's notes takes the next value of users.note_seq first. The UPDATE
+    # holds the user's row lock until commit, so writers for one user commit in sequence
+    # order and a sync cursor never skips a change that commits late.
+    result = await db.execute(
+        update(models.User).where(models.User.id == user_id)
+        .values(note_seq=func.coalesce(models.User.note_seq, 0) + 1)
+        .returning(models.User.note_seq)
+    )
+    return result.scalar_one()
+
+async def fresh_note_ids(db: AsyncSession, count: int) -> list:
+    # SQLite gives a new row max(id) + 1, so deleting the newest note would let its id come
+    # back and a stale sync mutation for the deleted note would land on the new one. Ids are
+    # taken past the tombstones too; call after next_change_seq, which holds the write lock.
+    # Postgres sequences never go back, so ids are left to the database there.
+    if db.bind.dialect.name != "sqlite":
+        return [None] * count
+    top = max(
+        await db.scalar(select(func.max(models.Note.id))) or 0,
+        await db.scalar(select(func.max(models.NoteTombstone.note_id))) or 0,
+    )
+    return list(range(top + 1, top + 1 + count))
+
+def bury(db: AsyncSession, note: models.Note, seq: int):
+    db.add(models.NoteTombstone(note_id=note.id, user_id=note.user_id, change_seq=seq))
+
 @router.get("", response_model=List[NoteResponse])
-def get_notes(db: Session = Depends(database.get_db), current_user: models.User = Depends(auth.get_current_active_user)):
-    return db.query(models.Note).filter(models.Note.user_id == current_user.id).all()
+async def get_notes(
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    title_prefix: Optional[str] = None,
+    updated_since: Optional[datetime.datetime] = None,
+    fields: Optional[str] = None,
+    db: AsyncSession = Depends(database.get_async_read_db),
+    current_user: models.User = Depends(auth.get_current_active_user),
+):
+    # Keyset pagination over (updated_at, id), served by ix_notes_user_id_updated_at_id.
+    # Without limit or cursor the whole list comes back, as it did before pagination.
+    paginated = limit is not None or cursor is not None
+    limit = pagination.clamp_limit(limit)
+    selected = pagination.parse_fields(fields, NOTE_FIELDS)
+    sort_columns = [models.Note.updated_at, models.Note.id]
+    if selected:
+        extra = [getattr(models.Note, f) for f in selected if f not in ("updated_at", "id")]
+        query = select(*sort_columns, *extra)
+    else:
+        query = select(models.Note)
+    query = query.where(models.Note.user_id == current_user.id)
+    if title_prefix:
+        # Same range form as title_prefix on courses: case-sensitive, and no LIKE pattern to escape
+        query = query.where(models.Note.title >= title_prefix, models.Note.title < title_prefix + "\uffff")
+    if updated_since:
+        query = query.where(models.Note.updated_at >= updated_since)
+    cursor_filter = pagination.after(sort_columns, pagination.decode_cursor(cursor, (datetime.datetime, int)))
+    if cursor_filter is not None:
+        query = query.where(cursor_filter)
+
+    query = query.order_by(*sort_columns)
+    result = await db.execute(query.limit(limit + 1) if paginated else query)
+    rows = result.all() if selected else result.scalars().all()
+    next_values = None
+    if paginated:
+        rows, next_values = pagination.split_page(rows, limit, lambda row: [row.updated_at, row.id])
+    return pagination.projected_response(rows, selected or NOTE_FIELDS, pagination.page_headers(next_values))
 
 @router.post("", response_model=NoteResponse)
-def create_note(note: NoteCreate, db: Session = Depends(database.get_db), current_user: models.User = Depends(auth.get_current_active_user)):
-    db_note = models.Note(**note.model_dump(), user_id=current_user.id)
+async def create_note(note: NoteCreate, db: AsyncSession = Depends(database.get_async_db), current_user: models.User = Depends(auth.get_current_active_user)):
+    seq = await next_change_seq(db, current_user.id)
+    [note_id] = await fresh_note_ids(db, 1)
+    db_note = models.Note(**note.model_dump(), id=note_id, user_id=current_user.id, version=1, change_seq=seq)
     db.add(db_note)
-    db.commit()
-    db.refresh(db_note)
+    await db.flush()
+    await db.run_sync(search.index_note, db_note)
+    await db.commit()
     return db_note
 
 @router.put("/{note_id}", response_model=NoteResponse)
-def update_note(note_id: int, note: NoteCreate, db: Session = Depends(database.get_db), current_user: models.User = Depends(auth.get_current_active_user)):
-    db_note = db.query(models.Note).filter(models.Note.id == note_id, models.Note.user_id == current_user.id).first()
+async def update_note(note_id: int, note: NoteCreate, db: AsyncSession = Depends(database.get_async_db), current_user: models.User = Depends(auth.get_current_active_user)):
+    seq = await next_change_seq(db, current_user.id)
+    db_note = await get_owned_note(db, note_id, current_user)
     if not db_note:
         raise HTTPException(status_code=404, detail="Note not found")
     
     db_note.title = note.title
     db_note.content = note.content
-    db.commit()
-    db.refresh(db_note)
+    db_note.version = (db_note.version or 1) + 1
+    db_note.change_seq = seq
+    await db.flush()
+    await db.run_sync(search.index_note, db_note)
+    await db.commit()
     return db_note
 
 @router.delete("/{note_id}")
-def delete_note(note_id: int, db: Session = Depends(database.get_db), current_user: models.User = Depends(auth.get_current_active_user)):
-    db_note = db.query(models.Note).filter(models.Note.id == note_id, models.Note.user_id == current_user.id).first()
+async def delete_note(note_id: int, db: AsyncSession = Depends(database.get_async_db), current_user: models.User = Depends(auth.get_current_active_user)):
+    seq = await next_change_seq(db, current_user.id)
+    db_note = await get_owned_note(db, note_id, current_user)
     if not db_note:
         raise HTTPException(status_code=404, detail="Note not found")
     
-    db.delete(db_note)
-    db.commit()
+    await db.delete(db_note)
+    bury(db, db_note, seq)
+    await db.run_sync(search.remove_note, note_id)
+    await db.commit()
     return {"message": "Note deleted"}
+
+
+# Delta sync. A client keeps the cursor from its last sync and sends it back as `since`;
+# the reply holds only notes written after it plus the ids of notes deleted after it
+# (tombstones). Without `since` the reply is a full snapshot. Offline edits go in
+# `mutations` and are applied in one transaction: updates and deletes name the version
+# they were made against and come back as "conflict" (with the server copy) when the note
+# has moved on; creates carry a client_id so replaying a batch doesn't duplicate notes.
+
+SYNC_MAX_MUTATIONS = int(os.getenv("NOTES_SYNC_MAX_MUTATIONS", "500"))
+
+class NoteMutation(BaseModel):
+    op: Literal["create", "update", "delete"]
+    id: Optional[int] = None
+    client_id: Optional[str] = Field(default=None, max_length=64)
+    version: Optional[int] = None
+    title: Optional[str] = None
+    content: Optional[str] = None
+
+    @model_validator(mode="after")
+    def _required_fields(self):
+        if self.op == "create" and (self.client_id is None or self.title is None or self.content is None):
+            raise ValueError("create needs client_id, title and content")
+        if self.op != "create" and (self.id is None or self.version is None):
+            raise ValueError(f"{self.op} needs id and version")
+        return self
+
+class MutationResult(BaseModel):
+    op: str
+    id: Optional[int] = None
+    client_id: Optional[str] = None
+    status: Literal["applied", "conflict", "not_found"]
+    note: Optional[NoteResponse] = None # the note as the server now has it
+
+class SyncRequest(BaseModel):
+    since: Optional[str] = None
+    limit: Optional[int] = None
+    mutations: List[NoteMutation] = Field(default_factory=list, max_length=SYNC_MAX_MUTATIONS)
+
+class SyncResponse(BaseModel):
+    notes: List[NoteResponse]
+    deleted: List[int]
+    cursor: str
+    has_more: bool # call again with `cursor` for the rest
+    results: List[MutationResult] = []
+
+async def changes_since(db: AsyncSession, user_id: int, since: Optional[str], limit: Optional[int]) -> dict:
+    # Changes in (change_seq, id) order; a cursor is the position of the last one returned
+    limit = pagination.clamp_limit(limit)
+    position = pagination.decode_cursor(since, (int, int))
+    notes_query = select(models.Note).where(models.Note.user_id == user_id)
+    after_notes = pagination.after([models.Note.change_seq, models.Note.id], position)
+    if after_notes is not None:
+        notes_query = notes_query.where(after_notes)
+    notes = (await db.scalars(notes_query.order_by(models.Note.change_seq, models.Note.id).limit(limit + 1))).all()
+    changes = [(note.change_seq or 0, note.id, note) for note in notes]
+    if position is not None:
+        # A snapshot only holds live notes, so tombstones matter from the first cursor on
+        tombstones = (await db.execute(
+            select(models.NoteTombstone.change_seq, models.NoteTombstone.note_id)
+            .where(models.NoteTombstone.user_id == user_id)
+            .where(pagination.after([models.NoteTombstone.change_seq, models.NoteTombstone.note_id], position))
+            .order_by(models.NoteTombstone.change_seq, models.NoteTombstone.note_id).limit(limit + 1)
+        )).all()
+        changes.extend((seq, note_id, None) for seq, note_id in tombstones)
+    changes.sort(key=lambda change: change[:2])
+    page = changes[:limit]
+    last = list(page[-1][:2]) if page else (position or [0, 0])
+    return {
+        "notes": [note for _, _, note in page if note is not None],
+        "deleted": [note_id for _, note_id, note in page if note is None],
+        "cursor": pagination.encode_cursor(last),
+        "has_more": len(changes) > limit,
+    }
+
+async def apply_mutations(db: AsyncSession, user_id: int, mutations: List[NoteMutation]) -> list:
+    seq = await next_change_seq(db, user_id) # one sequence value for the whole batch
+    ids = {m.id for m in mutations if m.id is not None}
+    client_ids = {m.client_id for m in mutations if m.op == "create"}
+    owned = {}
+    if ids:
+        owned = {note.id: note for note in await db.scalars(
+            select(models.Note).where(models.Note.user_id == user_id, models.Note.id.in_(ids))
+        )}
+    created = {}
+    if client_ids:
+        created = {note.client_id: note for note in await db.scalars(
+            select(models.Note).where(models.Note.user_id == user_id, models.Note.client_id.in_(client_ids))
+        )}
+
+    new_ids = iter(await fresh_note_ids(db, sum(1 for m in mutations if m.op == "create")))
+    results, new_notes, changed, removed = [], [], [], []
+    for m in mutations:
+        result = MutationResult(op=m.op, id=m.id, client_id=m.client_id, status="applied")
+        results.append((result, m))
+        if m.op == "create":
+            if m.client_id not in created: # otherwise a replay: report the note made the first time
+                created[m.client_id] = models.Note(
+                    id=next(new_ids), user_id=user_id, title=m.title, content=m.content, client_id=m.client_id, version=1, change_seq=seq
+                )
+                db.add(created[m.client_id])
+                new_notes.append(created[m.client_id])
+            continue
+        note = owned.get(m.id)
+        if note is None:
+            result.status = "not_found"
+        elif note.version != m.version:
+            result.status = "conflict"
+        elif m.op == "update":
+            note.title = m.title if m.title is not None else note.title
+            note.content = m.content if m.content is not None else note.content
+            note.version += 1
+            note.change_seq = seq
+            changed.append(note)
+        else:
+            await db.delete(note)
+            bury(db, note, seq)
+            removed.append(owned.pop(m.id))
+
+    await db.flush()
+    for note in new_notes + changed:
+        await db.run_sync(search.index_note, note)
+    for note in removed:
+        await db.run_sync(search.remove_note, note.id)
+    await db.commit()
+
+    for result, m in results:
+        note = created.get(m.client_id) if m.op == "create" else owned.get(m.id)
+        if note is not None:
+            result.id = note.id
+            result.note = NoteResponse.model_validate(note)
+    return [result for result, _ in results]
+
+@router.get("/sync", response_model=SyncResponse)
+async def sync_notes(
+    since: Optional[str] = None,
+    limit: Optional[int] = None,
+    db: AsyncSession = Depends(database.get_async_read_db),
+    current_user: models.User = Depends(auth.get_current_active_user),
+):
+    return await changes_since(db, current_user.id, since, limit)
+
+@router.post("/sync", response_model=SyncResponse)
+async def push_notes(request: SyncRequest, db: AsyncSession = Depends(database.get_async_db), current_user: models.User = Depends(auth.get_current_active_user)):
+    # Mutations first, then the changes since `since` (including the ones just applied),
+    # so an offline client catches up in one round trip
+    pagination.decode_cursor(request.since, (int, int)) # reject a bad cursor before writing anything
+    results = await apply_mutations(db, current_user.id, request.mutations) if request.mutations else []
+    return {**await changes_since(db, current_user.id, request.since, request.limit), "results": results}
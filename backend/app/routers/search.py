@@ -0,0 +1,20 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.orm import Session
+from typing import List, Optional
+from .. import database, schemas, models, auth, search
+
+router = APIRouter(
+    prefix="/search",
+    tags=["Search"]
+)
+
+@router.get("", response_model=List[schemas.SearchResult])
+def search_all(
+    q: str = Query(..., min_length=1, max_length=200),
+    kind: Optional[str] = Query(None, pattern="^(note|content)$"),
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(database.get_read_db),
+    current_user: models.User = Depends(auth.get_current_active_user),
+):
+    # Notes are limited to the caller's own; course content to enrolled courses (admins/owners see all)
+    return search.search(db, current_user, q, limit=limit, kind=kind)
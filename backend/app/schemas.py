@@ -1,4 +1,4 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, computed_field
 from typing import Optional, List
 from datetime import datetime
 
@@ -47,9 +47,10 @@ class StudySessionCreate(StudySessionBase):
     pass
 
 class StudySessionResponse(StudySessionBase):
+    # History is not embedded; page through GET /llm/sessions/{id}/messages instead
     id: int
     created_at: datetime
-    messages: List[ChatMessageResponse] = []
+    last_message: Optional[ChatMessageResponse] = None
 
     class Config:
         from_attributes = True
@@ -58,6 +59,21 @@ class ChatRequest(BaseModel):
     session_id: Optional[int] = None
     topic: Optional[str] = None
     message: str
+    cache_opt_out: Optional[bool] = None # Persisted on the session when provided
+
+class JobResponse(BaseModel):
+    # A background job (app/jobs.py); for chat_reply, result is {"message": ChatMessageResponse}
+    id: int
+    kind: str
+    status: str # queued | running | done | failed
+    attempts: int
+    max_attempts: int
+    session_id: Optional[int] = None
+    result: Optional[dict] = None
+    error: Optional[str] = None # last failure, kept while a retry is pending
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+    status_url: str
 
 class CourseBase(BaseModel):
     title: str
@@ -82,9 +98,27 @@ class ContentBase(BaseModel):
 class ContentCreate(ContentBase):
     pass
 
-class ContentResponse(ContentBase):
+class ContentResponse(BaseModel):
+    # Metadata only; the body is fetched from body_url
     id: int
     course_id: int
+    title: str
+    type: str # 'video' or 'text'
+    size: Optional[int] = None
+    sha256: Optional[str] = None
+
+    @computed_field
+    @property
+    def body_url(self) -> str:
+        return f"/courses/{self.course_id}/content/{self.id}/body"
 
     class Config:
         from_attributes = True
+
+class SearchResult(BaseModel):
+    kind: str # 'note' or 'content'
+    ref_id: int
+    course_id: Optional[int] = None
+    title: str # highlighted
+    snippet: str # highlighted excerpt
+    score: float
@@ -0,0 +1,239 @@
+import html
+import re
+import sys
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from . import content_store, database, models
+
+# Full-text search over Note.title/content and Content.title/data.
+#
+# SQLite: an FTS5 table kept in sync by the write paths (notes router, admin router) in the
+# same transaction as the row change. rowids are derived from the source row so updates and
+# deletes are point operations: notes -> 2*id, contents -> 2*id + 1.
+# Postgres: no side table; the query runs to_tsvector/ts_rank/ts_headline over the base
+# tables, backed by GIN expression indexes created in ensure_index().
+
+FTS_TABLE = "search_index"
+HIGHLIGHT_START = "<mark>"
+HIGHLIGHT_END = "</mark>"
+# The database marks matches with these control characters; titles and snippets are
+# HTML-escaped before they become <mark> tags, so the markers are the only markup
+_MATCH_START = "\x02"
+_MATCH_END = "\x03"
+REBUILD_BATCH = 500
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def _is_sqlite(bind) -> bool:
+    return bind.dialect.name == "sqlite"
+
+
+def _rowid(kind: str, ref_id: int) -> int:
+    return ref_id * 2 + (1 if kind == "content" else 0)
+
+
+def ensure_index(engine: Engine):
+    with engine.begin() as conn:
+        if _is_sqlite(conn):
+            exists = conn.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": FTS_TABLE}
+            ).first()
+            if exists:
+                return
+            conn.execute(text(
+                f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                "title, body, kind UNINDEXED, ref_id UNINDEXED, owner_id UNINDEXED, course_id UNINDEXED, "
+                "tokenize = 'porter unicode61')"
+            ))
+        else:
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_notes_fts ON notes USING GIN "
+                "(to_tsvector('english', coalesce(title, '') || ' ' || coalesce(content, '')))"
+            ))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_contents_fts ON contents USING GIN "
+                "(to_tsvector('english', coalesce(title, '') || ' ' || coalesce(data, '')))"
+            ))
+            return
+    # New FTS table on a database that already has rows: backfill it once
+    rebuild(engine)
+
+
+def _upsert(db: Session, kind: str, ref_id: int, title: str, body: str, owner_id=None, course_id=None):
+    if not _is_sqlite(db.get_bind()):
+        return
+    rowid = _rowid(kind, ref_id)
+    db.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :rowid"), {"rowid": rowid})
+    db.execute(
+        text(
+            f"INSERT INTO {FTS_TABLE} (rowid, title, body, kind, ref_id, owner_id, course_id) "
+            "VALUES (:rowid, :title, :body, :kind, :ref_id, :owner_id, :course_id)"
+        ),
+        {"rowid": rowid, "title": title or "", "body": body or "", "kind": kind,
+         "ref_id": ref_id, "owner_id": owner_id, "course_id": course_id},
+    )
+
+
+def _remove(db: Session, kind: str, ref_id: int):
+    if not _is_sqlite(db.get_bind()):
+        return
+    db.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :rowid"), {"rowid": _rowid(kind, ref_id)})
+
+
+# Call these after flush (ids assigned) and before commit, so index and rows commit together.
+# Async sessions go through run_sync, e.g. await db.run_sync(search.index_note, note).
+def index_note(db: Session, note: models.Note):
+    _upsert(db, "note", note.id, note.title, note.content, owner_id=note.user_id)
+
+
+def remove_note(db: Session, note_id: int):
+    _remove(db, "note", note_id)
+
+
+def index_content(db: Session, content: models.Content):
+    _upsert(db, "content", content.id, content.title, content_store.body_text(content), course_id=content.course_id)
+
+
+def index_contents(db: Session, contents: list, bodies: Optional[list] = None):
+    # Bulk form of index_content for imports: two executemany statements per batch. Callers
+    # that still have the body text pass it as bodies, so no blob is read back from the store.
+    if not contents or not _is_sqlite(db.get_bind()):
+        return
+    if bodies is None:
+        bodies = [content_store.body_text(c) for c in contents]
+    rows = [
+        {"rowid": _rowid("content", c.id), "title": c.title or "", "body": body, "kind": "content",
+         "ref_id": c.id, "owner_id": None, "course_id": c.course_id}
+        for c, body in zip(contents, bodies)
+    ]
+    db.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :rowid"), [{"rowid": row["rowid"]} for row in rows])
+    db.execute(
+        text(
+            f"INSERT INTO {FTS_TABLE} (rowid, title, body, kind, ref_id, owner_id, course_id) "
+            "VALUES (:rowid, :title, :body, :kind, :ref_id, :owner_id, :course_id)"
+        ),
+        rows,
+    )
+
+
+def remove_content(db: Session, content_id: int):
+    _remove(db, "content", content_id)
+
+
+def fts_query(q: str) -> Optional[str]:
+    # Quote every token so user input can't inject FTS5 syntax; the last token is a prefix match
+    tokens = _TOKEN.findall(q)
+    if not tokens:
+        return None
+    quoted = ['"' + token.replace('"', '""') + '"' for token in tokens]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def _highlighted(value: Optional[str]) -> Optional[str]:
+    if value is None:
+        return None
+    return html.escape(value, quote=False).replace(_MATCH_START, HIGHLIGHT_START).replace(_MATCH_END, HIGHLIGHT_END)
+
+
+def _result(row, score: float) -> dict:
+    return {**row, "title": _highlighted(row["title"]), "snippet": _highlighted(row["snippet"]), "score": score}
+
+
+def search(db: Session, user: models.User, q: str, limit: int = 20, kind: Optional[str] = None) -> List[dict]:
+    can_see_all_content = user.role in [models.UserRole.ADMIN, models.UserRole.OWNER]
+    if _is_sqlite(db.get_bind()):
+        return _search_sqlite(db, user, q, limit, kind, can_see_all_content)
+    return _search_postgres(db, user, q, limit, kind, can_see_all_content)
+
+
+def _search_sqlite(db, user, q, limit, kind, can_see_all_content):
+    match = fts_query(q)
+    if match is None:
+        return []
+    content_scope = "1 = 1" if can_see_all_content else \
+        "course_id IN (SELECT course_id FROM enrollments WHERE user_id = :user_id)"
+    kinds = {"note": "(kind = 'note' AND owner_id = :user_id)", "content": f"(kind = 'content' AND {content_scope})"}
+    scope = " OR ".join(clause for name, clause in kinds.items() if kind in (None, name))
+    rows = db.execute(
+        text(
+            f"SELECT kind, ref_id, course_id, "
+            f"highlight({FTS_TABLE}, 0, :start, :end) AS title, "
+            f"snippet({FTS_TABLE}, 1, :start, :end, '…', 24) AS snippet, "
+            f"bm25({FTS_TABLE}, 10.0, 1.0) AS score "
+            f"FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match AND ({scope}) "
+            "ORDER BY score LIMIT :limit"
+        ),
+        {"match": match, "user_id": user.id, "start": _MATCH_START, "end": _MATCH_END, "limit": limit},
+    ).mappings().all()
+    # bm25() is "lower is better"; flip it so clients can sort descending like ts_rank
+    return [_result(row, -row["score"]) for row in rows]
+
+
+def _search_postgres(db, user, q, limit, kind, can_see_all_content):
+    options = f'StartSel="{_MATCH_START}", StopSel="{_MATCH_END}", MaxWords=24, MinWords=8'
+    content_scope = "" if can_see_all_content else \
+        "AND course_id IN (SELECT course_id FROM enrollments WHERE user_id = :user_id)"
+    parts = []
+    if kind in (None, "note"):
+        parts.append(
+            "SELECT 'note' AS kind, id AS ref_id, NULL::int AS course_id, "
+            "ts_headline('english', coalesce(title, ''), query, :options) AS title, "
+            "ts_headline('english', coalesce(content, ''), query, :options) AS snippet, "
+            "ts_rank(to_tsvector('english', coalesce(title, '') || ' ' || coalesce(content, '')), query) AS score "
+            "FROM notes, plainto_tsquery('english', :q) query "
+            "WHERE to_tsvector('english', coalesce(title, '') || ' ' || coalesce(content, '')) @@ query "
+            "AND user_id = :user_id"
+        )
+    if kind in (None, "content"):
+        parts.append(
+            "SELECT 'content' AS kind, id AS ref_id, course_id, "
+            "ts_headline('english', coalesce(title, ''), query, :options) AS title, "
+            "ts_headline('english', coalesce(data, ''), query, :options) AS snippet, "
+            "ts_rank(to_tsvector('english', coalesce(title, '') || ' ' || coalesce(data, '')), query) AS score "
+            "FROM contents, plainto_tsquery('english', :q) query "
+            f"WHERE to_tsvector('english', coalesce(title, '') || ' ' || coalesce(data, '')) @@ query {content_scope}"
+        )
+    rows = db.execute(
+        text(" UNION ALL ".join(parts) + " ORDER BY score DESC LIMIT :limit"),
+        {"q": q, "user_id": user.id, "options": options, "limit": limit},
+    ).mappings().all()
+    return [_result(row, row["score"]) for row in rows]
+
+
+def rebuild(engine: Engine) -> int:
+    # Repopulate the FTS table from the base tables, in batches to keep memory flat
+    if not _is_sqlite(engine):
+        return 0
+    indexed = 0
+    with Session(engine) as db:
+        db.execute(text(f"DELETE FROM {FTS_TABLE}"))
+        for model, index in ((models.Note, index_note), (models.Content, index_content)):
+            last_id = 0
+            while True:
+                batch = db.query(model).filter(model.id > last_id).order_by(model.id).limit(REBUILD_BATCH).all()
+                if not batch:
+                    break
+                for row in batch:
+                    index(db, row)
+                indexed += len(batch)
+                last_id = batch[-1].id
+                db.expunge_all()
+        db.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')"))
+        db.commit()
+    return indexed
+
+
+if __name__ == "__main__":
+    # python -m app.search rebuild
+    if sys.argv[1:] != ["rebuild"]:
+        print("usage: python -m app.search rebuild")
+        sys.exit(2)
+    from . import migrate
+    migrate.run()
+    print(f"Indexed {rebuild(database.engine)} documents.")
@@ -0,0 +1,44 @@
+from sqlalchemy.orm import Session
+from . import database, migrate, models, retrieval, rollups, search
+
+# Demo catalogue, previously seeded lazily by GET /courses on an empty table.
+# Run at startup (SEED_DEMO_DATA=1, the default) or explicitly with: python -m app.seed
+def seed_demo_courses(db: Session) -> bool:
+    if db.query(models.Course.id).first() is not None:
+        return False
+
+    seed_courses = [
+        models.Course(title="Advanced React Patterns", description="Master Request", price=4999, image_url="https://via.placeholder.com/300/0f172a/eca338?text=React"),
+        models.Course(title="FastAPI Masterclass", description="Build high-performance APIs", price=3999, image_url="https://via.placeholder.com/300/0f172a/eca338?text=FastAPI"),
+        models.Course(title="AI Engineering 101", description="Integrate LLMs into apps", price=5999, image_url="https://via.placeholder.com/300/0f172a/eca338?text=AI"),
+    ]
+    db.add_all(seed_courses)
+    db.flush()
+    for _ in seed_courses:
+        rollups.course_created(db)
+
+    # Seed Content
+    for course in seed_courses:
+        contents = [
+            models.Content(course_id=course.id, title="Welcome to the Course", type="text", data=f"Welcome to {course.title}! Here is your overview."),
+            models.Content(course_id=course.id, title="Chapter 1: Getting Started", type="video", data="https://www.youtube.com/watch?v=dQw4w9WgXcQ"), # Placeholder
+            models.Content(course_id=course.id, title="Study Notes", type="text", data="1. Key Concept A\n2. Key Concept B\n3. Summary"),
+        ]
+        db.add_all(contents)
+        db.flush()
+        for content in contents:
+            search.index_content(db, content)
+    db.commit()
+    return True
+
+if __name__ == "__main__":
+    migrate.run()
+    db = database.SessionLocal()
+    try:
+        if seed_demo_courses(db):
+            retrieval.ensure_built(db, force=True)
+            print("Seeded demo courses.")
+        else:
+            print("Courses already present, nothing to seed.")
+    finally:
+        db.close()
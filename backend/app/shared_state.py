@@ -0,0 +1,249 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+# Coordination state shared by every worker process on this host:
+# cache versions, rate-limit windows, concurrency leases and the second-level LLM cache.
+# SHARED_STATE_URL selects the backend:
+#
+#     local (default)         in-process dicts; correct for a single worker
+#     sqlite:////data/x.db    one SQLite file; its file lock serialises writers across processes.
+#                             WAL needs shared memory, so only processes on one host may share
+#                             it (never pods on a network volume)
+#
+# A networked backend (e.g. Redis) only needs to implement the SharedState methods below.
+#
+# Hot paths (every authenticated request, every retrieval) read versions and flags through
+# cached_version/cached_get, which keep a shared backend's answer for CACHE_SECONDS per
+# process. Writes made by this process are seen at once; other workers' within CACHE_SECONDS.
+
+CACHE_SECONDS = float(os.getenv("SHARED_STATE_CACHE_SECONDS", "1"))
+
+
+class SharedState:
+    shared = False # True when other processes see the same state
+    path = None
+    _read_cache = None # key -> (value, expires_at), for cached_get/cached_version
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None):
+        raise NotImplementedError
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        # Atomic add; ttl applies when the key is created
+        raise NotImplementedError
+
+    def acquire(self, name: str, holder: str, limit: int, ttl: float) -> bool:
+        # Take one of `limit` leases on `name`. Leases expire after ttl so a crashed worker
+        # can't hold a slot forever; holders renew by acquiring again.
+        raise NotImplementedError
+
+    def release(self, name: str, holder: str):
+        raise NotImplementedError
+
+    def purge_expired(self) -> int:
+        return 0
+
+    def version(self, name: str) -> int:
+        return int(self.get(f"version:{name}") or 0)
+
+    def bump(self, name: str) -> int:
+        value = self.incr(f"version:{name}")
+        self._forget(f"version:{name}")
+        return value
+
+    def cached_get(self, key: str, max_age: float = None) -> Optional[str]:
+        if not self.shared: # in-process dicts: nothing to save
+            return self.get(key)
+        if self._read_cache is None:
+            self._read_cache = {}
+        now = time.monotonic()
+        entry = self._read_cache.get(key)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+        value = self.get(key)
+        self._read_cache[key] = (value, now + (CACHE_SECONDS if max_age is None else max_age))
+        return value
+
+    def cached_version(self, name: str) -> int:
+        return int(self.cached_get(f"version:{name}") or 0)
+
+    def _forget(self, key: str):
+        if self._read_cache is not None:
+            self._read_cache.pop(key, None)
+
+    def hit(self, key: str, limit: int, window: float) -> Optional[float]:
+        # Fixed-window rate limit. Returns None when allowed, otherwise seconds until the window resets.
+        now = time.time()
+        bucket = int(now // window)
+        if self.incr(f"rate:{key}:{bucket}", ttl=window * 2) <= limit:
+            return None
+        return (bucket + 1) * window - now
+
+
+class LocalState(SharedState):
+    def __init__(self):
+        self._values = {} # key -> (value, expires_at or None)
+        self._leases = {} # name -> {holder: expires_at}
+        self._lock = threading.Lock()
+
+    def _live(self, key: str, now: float):
+        entry = self._values.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self._values[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key, time.time())
+            return entry[0] if entry else None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._values[key] = (value, time.time() + ttl if ttl else None)
+
+    def incr(self, key, amount=1, ttl=None):
+        now = time.time()
+        with self._lock:
+            entry = self._live(key, now)
+            value = int(entry[0]) + amount if entry else amount
+            self._values[key] = (str(value), entry[1] if entry else (now + ttl if ttl else None))
+            return value
+
+    def acquire(self, name, holder, limit, ttl):
+        now = time.time()
+        with self._lock:
+            leases = {h: expires for h, expires in self._leases.get(name, {}).items() if expires > now}
+            if holder not in leases and len(leases) >= limit:
+                self._leases[name] = leases
+                return False
+            leases[holder] = now + ttl
+            self._leases[name] = leases
+            return True
+
+    def release(self, name, holder):
+        with self._lock:
+            self._leases.get(name, {}).pop(holder, None)
+
+
+class SQLiteState(SharedState):
+    shared = True
+    PURGE_EVERY = 1000 # writes between sweeps of expired rate windows, leases and cache entries
+
+    def __init__(self, path: str):
+        self.path = path
+        self._writes = 0
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT, holder TEXT, expires_at REAL NOT NULL, PRIMARY KEY (name, holder))")
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per thread (and per process: forked workers open their own)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _write(self, fn):
+        # BEGIN IMMEDIATE takes SQLite's write lock up front, so read-modify-write is atomic across processes
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self.purge_expired()
+        return result
+
+    def get(self, key):
+        row = self._connect().execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl=None):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, time.time() + ttl if ttl else None),
+        )
+        self._forget(key)
+
+    def incr(self, key, amount=1, ttl=None):
+        def apply(conn):
+            now = time.time()
+            conn.execute("DELETE FROM kv WHERE key = ? AND expires_at <= ?", (key, now))
+            conn.execute(
+                "INSERT INTO kv (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + ?",
+                (key, str(amount), now + ttl if ttl else None, amount),
+            )
+            return int(conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()[0])
+        return self._write(apply)
+
+    def acquire(self, name, holder, limit, ttl):
+        def apply(conn):
+            now = time.time()
+            conn.execute("DELETE FROM leases WHERE name = ? AND expires_at <= ?", (name, now))
+            held = conn.execute("SELECT 1 FROM leases WHERE name = ? AND holder = ?", (name, holder)).fetchone()
+            count = conn.execute("SELECT COUNT(*) FROM leases WHERE name = ?", (name,)).fetchone()[0]
+            if not held and count >= limit:
+                return False
+            conn.execute("INSERT OR REPLACE INTO leases (name, holder, expires_at) VALUES (?, ?, ?)", (name, holder, now + ttl))
+            return True
+        return self._write(apply)
+
+    def release(self, name, holder):
+        self._connect().execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+    def purge_expired(self) -> int:
+        now = time.time()
+        conn = self._connect()
+        deleted = conn.execute("DELETE FROM kv WHERE expires_at <= ?", (now,)).rowcount
+        return deleted + conn.execute("DELETE FROM leases WHERE expires_at <= ?", (now,)).rowcount
+
+
+def create_state(url: Optional[str] = None) -> SharedState:
+    url = url or os.getenv("SHARED_STATE_URL", "local")
+    if url == "local":
+        return LocalState()
+    if url.startswith("sqlite:///"):
+        return SQLiteState(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported SHARED_STATE_URL '{url}'")
+
+
+_state: Optional[SharedState] = None
+_state_lock = threading.Lock()
+
+
+def get_state() -> SharedState:
+    global _state
+    if _state is None:
+        with _state_lock:
+            if _state is None:
+                _state = create_state()
+    return _state
+
+
+def set_state(state: Optional[SharedState]):
+    # Tests swap in a fresh backend; None re-reads SHARED_STATE_URL on next use
+    global _state
+    _state = state
+
+
+def holder_id() -> str:
+    # Identifies this worker in lease tables
+    return f"{socket.gethostname()}:{os.getpid()}"
@@ -0,0 +1,85 @@
+import argparse
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+# Cold-start accounting. main.py imports this module first, marks each phase as it finishes
+# (module imports, then each lifespan step) and GET /ready reports the breakdown, which is
+# what the k8s startup/readiness probe timings in k8s/backend.yaml are sized from.
+#
+#     python -m app.startup            # -X importtime breakdown of `import app.main`
+#     python -m app.startup --lifespan # ...plus the lifespan phases against DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+_started = time.perf_counter()
+_last = _started
+phases = {}
+ready = False
+
+
+def mark(phase: str):
+    global _last
+    now = time.perf_counter()
+    phases[phase] = round((now - _last) * 1000, 1)
+    _last = now
+
+
+def finished():
+    global ready
+    ready = True
+    logger.info("Startup finished in %.0f ms: %s", report()["total_ms"], phases)
+
+
+def report() -> dict:
+    return {"ready": ready, "total_ms": round((_last - _started) * 1000, 1), "phases_ms": dict(phases)}
+
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_breakdown(module: str = "app.main", top: int = 15) -> dict:
+    # Self time summed per top-level package, from a fresh interpreter so nothing is cached
+    env = {**os.environ, "LLM_PROVIDER": os.getenv("LLM_PROVIDER", "stub")}
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.dirname(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "import failed")
+    by_package = defaultdict(int)
+    total_us = 0
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = int(match[1]), int(match[2]), match[3], match[4]
+        by_package[name.split(".")[0]] += self_us
+        if len(indent) == 1: # imported directly by the -c statement
+            total_us += cumulative_us
+    ranked = sorted(by_package.items(), key=lambda item: item[1], reverse=True)[:top]
+    return {"total_ms": round(total_us / 1000, 1), "top_packages_ms": {name: round(us / 1000, 1) for name, us in ranked}}
+
+
+async def _run_lifespan() -> dict:
+    # Under -m this file is __main__; the phases are recorded on the imported app.startup
+    from . import startup
+    from .main import app
+    async with app.router.lifespan_context(app):
+        return startup.report()
+
+
+if __name__ == "__main__":
+    import asyncio
+    import json
+
+    parser = argparse.ArgumentParser(description="Report where backend cold-start time goes")
+    parser.add_argument("--top", type=int, default=15, help="packages to list")
+    parser.add_argument("--lifespan", action="store_true", help="also run the app lifespan and time its phases")
+    args = parser.parse_args()
+    output = {"imports": import_breakdown(top=args.top)}
+    if args.lifespan:
+        output["lifespan"] = asyncio.run(_run_lifespan())
+    print(json.dumps(output, indent=2))
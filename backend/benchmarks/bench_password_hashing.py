@@ -0,0 +1,67 @@
+"""Argon2 login throughput through the dedicated hasher pool.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_password_hashing --seconds 5
+
+Reports verifications/sec for each pool size and the per-core figure, using the
+AUTH_ARGON2_* parameters from the environment.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from app import auth
+
+
+async def drive(pool: auth.PasswordHasherPool, hashed: str, seconds: float, concurrency: int) -> int:
+    deadline = time.perf_counter() + seconds
+    done = 0
+
+    async def worker():
+        nonlocal done
+        while time.perf_counter() < deadline:
+            verified, _ = await pool.run(auth.pwd_context.verify_and_update, "password", hashed)
+            assert verified
+            done += 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    hashed = auth.get_password_hash("password")
+    results = []
+    workers = 1
+    while workers <= args.max_workers:
+        pool = auth.PasswordHasherPool(workers, max_queue=workers)
+        started = time.perf_counter()
+        done = asyncio.run(drive(pool, hashed, args.seconds, concurrency=workers * 2))
+        elapsed = time.perf_counter() - started
+        results.append({
+            "workers": workers,
+            "logins_per_sec": round(done / elapsed, 2),
+            "logins_per_sec_per_core": round(done / elapsed / workers, 2),
+        })
+        workers *= 2
+
+    print(json.dumps({
+        "argon2": {
+            "time_cost": auth.ARGON2_TIME_COST,
+            "memory_cost_kib": auth.ARGON2_MEMORY_COST,
+            "parallelism": auth.ARGON2_PARALLELISM,
+        },
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Compare two benchmarks.load reports and flag latency/throughput regressions.
+
+    python -m benchmarks.compare baseline.json candidate.json --threshold 10
+
+Exits with status 1 when any endpoint's p95 grows, or its throughput drops, by more than
+--threshold percent, so it can gate CI.
+"""
+import argparse
+import json
+import sys
+
+
+def change(old: float, new: float) -> float:
+    return (new - old) / old * 100 if old else 0.0
+
+
+def compare(baseline: dict, candidate: dict, threshold: float) -> tuple:
+    rows = []
+    regressions = []
+    for name in sorted(set(baseline["endpoints"]) | set(candidate["endpoints"])):
+        old = baseline["endpoints"].get(name)
+        new = candidate["endpoints"].get(name)
+        if old is None or new is None:
+            rows.append((name, "only in " + ("candidate" if old is None else "baseline")))
+            continue
+        p95 = change(old["p95_ms"], new["p95_ms"])
+        rps = change(old["throughput_rps"], new["throughput_rps"])
+        rows.append((name, f"p50 {old['p50_ms']:.1f} -> {new['p50_ms']:.1f} ms, "
+                           f"p95 {old['p95_ms']:.1f} -> {new['p95_ms']:.1f} ms ({p95:+.1f}%), "
+                           f"p99 {old['p99_ms']:.1f} -> {new['p99_ms']:.1f} ms, "
+                           f"{old['throughput_rps']:.1f} -> {new['throughput_rps']:.1f} req/s ({rps:+.1f}%)"))
+        if p95 > threshold or rps < -threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed change in percent")
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    print(f"{baseline.get('git_commit')} -> {candidate.get('git_commit')}")
+    rows, regressions = compare(baseline, candidate, args.threshold)
+    width = max((len(name) for name, _ in rows), default=0)
+    for name, summary in rows:
+        marker = "!" if name in regressions else " "
+        print(f"{marker} {name:<{width}}  {summary}")
+    if regressions:
+        print(f"{len(regressions)} endpoint(s) regressed by more than {args.threshold}%")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
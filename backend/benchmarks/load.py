@@ -0,0 +1,264 @@
+"""In-process load test: mixed workloads against a temp SQLite database and the stub LLM.
+
+Run from the backend directory:
+
+    python -m benchmarks.load --seconds 20 --concurrency 32 --output results.json
+    python -m benchmarks.load --workload chat --chat-history 400
+    python -m benchmarks.compare baseline.json results.json
+
+The app runs inside this process (lifespan included) behind an ASGI transport, so numbers
+measure the application and database, not the network. Workloads and their weights:
+
+    login   POST /auth/token
+    browse  GET /courses (conditional and filtered), GET /courses/{id}/content
+    notes   POST/GET/PUT/DELETE /notes
+    chat    POST /llm/chat into a session that already has --chat-history messages
+
+Latency percentiles (p50/p95/p99) and throughput are reported per endpoint as JSON.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+WORKLOADS = ("login", "browse", "notes", "chat")
+DEFAULT_MIX = "login=1,browse=4,notes=3,chat=2"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=10.0, help="measured run length")
+    parser.add_argument("--concurrency", type=int, default=16, help="simultaneous virtual users")
+    parser.add_argument("--users", type=int, default=20, help="accounts created before the run")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="workload weights, e.g. browse=4,chat=1")
+    parser.add_argument("--workload", choices=WORKLOADS, help="run a single workload instead of the mix")
+    parser.add_argument("--chat-history", type=int, default=200, help="messages pre-loaded into each chat session")
+    parser.add_argument("--llm-latency-ms", type=float, default=50.0, help="stub LLM response time")
+    parser.add_argument("--db-profile", default="production", help="DB_PROFILE for the temp database")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for workload selection")
+    parser.add_argument("--output", help="write the JSON report here as well as to stdout")
+    return parser.parse_args(argv)
+
+
+def configure_environment(args, workdir: str):
+    # Must run before the app is imported: engines and providers read these at import time
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{workdir}/bench.db",
+        "DB_PROFILE": args.db_profile,
+        "LLM_PROVIDER": "stub",
+        "LLM_STUB_LATENCY_MS": str(args.llm_latency_ms),
+        "RETRIEVAL_INDEX_DIR": f"{workdir}/retrieval_index",
+        "JOB_QUEUE_URL": f"sqlite:///{workdir}/job_queue.db",
+        "CONTENT_STORE_URL": f"file://{workdir}/content_store",
+        "SHARED_STATE_URL": f"sqlite:///{workdir}/shared_state.db",
+        "SEED_DEMO_DATA": "1",
+    })
+
+
+def parse_mix(args) -> dict:
+    if args.workload:
+        return {args.workload: 1}
+    mix = {}
+    for part in args.mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in WORKLOADS:
+            raise SystemExit(f"Unknown workload {name!r}, expected one of {', '.join(WORKLOADS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    # Nearest-rank percentile
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    async def call(self, client, method: str, url: str, name: str, expect=(200,), **kwargs):
+        started = time.perf_counter()
+        response = await client.request(method, url, **kwargs)
+        self.latencies[name].append(time.perf_counter() - started)
+        self.statuses[name][response.status_code] += 1
+        if response.status_code not in expect:
+            self.errors[name] += 1
+        return response
+
+    def report(self, elapsed: float) -> dict:
+        endpoints = {}
+        for name, values in sorted(self.latencies.items()):
+            ordered = sorted(values)
+            endpoints[name] = {
+                "count": len(values),
+                "errors": self.errors[name],
+                "statuses": {str(code): count for code, count in sorted(self.statuses[name].items())},
+                "throughput_rps": round(len(values) / elapsed, 2),
+                "mean_ms": round(sum(values) / len(values) * 1000, 3),
+                "p50_ms": round(percentile(ordered, 50) * 1000, 3),
+                "p95_ms": round(percentile(ordered, 95) * 1000, 3),
+                "p99_ms": round(percentile(ordered, 99) * 1000, 3),
+                "max_ms": round(ordered[-1] * 1000, 3),
+            }
+        total = sum(len(values) for values in self.latencies.values())
+        return {
+            "total_requests": total,
+            "total_errors": sum(self.errors.values()),
+            "throughput_rps": round(total / elapsed, 2),
+            "endpoints": endpoints,
+        }
+
+
+class VirtualUser:
+    def __init__(self, client, recorder: Recorder, account: dict, course_ids: list, rng: random.Random):
+        self.client = client
+        self.recorder = recorder
+        self.account = account
+        self.course_ids = course_ids
+        self.rng = rng
+        self.catalogue_etag = None
+
+    @property
+    def headers(self):
+        return {"Authorization": f"Bearer {self.account['token']}"}
+
+    async def login(self):
+        await self.recorder.call(self.client, "POST", "/auth/token", "POST /auth/token",
+                                 data={"username": self.account["username"], "password": self.account["password"]})
+
+    async def browse(self):
+        headers = dict(self.headers)
+        if self.catalogue_etag:
+            headers["If-None-Match"] = self.catalogue_etag
+        response = await self.recorder.call(self.client, "GET", "/courses", "GET /courses", expect=(200, 304), headers=headers)
+        self.catalogue_etag = response.headers.get("etag", self.catalogue_etag)
+        await self.recorder.call(self.client, "GET", "/courses", "GET /courses?filtered",
+                                 params={"limit": 10, "max_price": 5000}, headers=self.headers)
+        await self.recorder.call(self.client, "GET", f"/courses/{self.rng.choice(self.course_ids)}/content",
+                                 "GET /courses/{id}/content", headers=self.headers)
+
+    async def notes(self):
+        body = {"title": f"Note {self.rng.randrange(10**6)}", "content": "spaced repetition " * self.rng.randint(5, 50)}
+        created = await self.recorder.call(self.client, "POST", "/notes", "POST /notes", json=body, headers=self.headers)
+        await self.recorder.call(self.client, "GET", "/notes", "GET /notes", params={"limit": 20}, headers=self.headers)
+        if created.status_code != 200:
+            return
+        note_id = created.json()["id"]
+        await self.recorder.call(self.client, "PUT", f"/notes/{note_id}", "PUT /notes/{id}",
+                                 json={**body, "content": body["content"] + " revised"}, headers=self.headers)
+        if self.rng.random() < 0.5:
+            await self.recorder.call(self.client, "DELETE", f"/notes/{note_id}", "DELETE /notes/{id}", headers=self.headers)
+
+    async def chat(self):
+        await self.recorder.call(self.client, "POST", "/llm/chat", "POST /llm/chat", headers=self.headers, json={
+            "session_id": self.account["session_id"],
+            "message": f"Explain topic {self.rng.randrange(1000)} again, briefly.",
+            "cache_opt_out": True,
+        })
+
+
+async def prepare_accounts(client, args, database, models) -> tuple:
+    password = "bench-password"
+    accounts = []
+    for i in range(args.users):
+        username = f"bench{i}"
+        await client.post("/auth/register", json={"username": username, "email": f"{username}@example.com", "password": password})
+        token = (await client.post("/auth/token", data={"username": username, "password": password})).json()["access_token"]
+        accounts.append({"username": username, "password": password, "token": token})
+
+    course_ids = [course["id"] for course in (await client.get("/courses")).json()]
+    for account in accounts:
+        for course_id in course_ids:
+            await client.post(f"/courses/{course_id}/buy", headers={"Authorization": f"Bearer {account['token']}"})
+
+    # Long chat histories are inserted directly; going through /llm/chat would take minutes
+    db = database.SessionLocal()
+    try:
+        for account in accounts:
+            user = db.query(models.User).filter(models.User.username == account["username"]).one()
+            session = models.StudySession(user_id=user.id, topic="Benchmark")
+            db.add(session)
+            db.flush()
+            db.bulk_save_objects([
+                models.ChatMessage(session_id=session.id, role="user" if n % 2 == 0 else "ai",
+                                   content=f"Turn {n}: " + "revision notes and follow-up questions " * 8)
+                for n in range(args.chat_history)
+            ])
+            account["session_id"] = session.id
+        db.commit()
+    finally:
+        db.close()
+    return accounts, course_ids
+
+
+async def run(args) -> dict:
+    try:
+        import httpx
+    except ImportError: # newer Starlette test stacks ship the fork under this name
+        import httpx2 as httpx
+    from app import database, models
+    from app.main import app
+
+    mix = parse_mix(args)
+    names, weights = list(mix), list(mix.values())
+    recorder = Recorder()
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            accounts, course_ids = await prepare_accounts(client, args, database, models)
+            deadline = time.perf_counter() + args.seconds
+
+            async def virtual_user(index: int):
+                rng = random.Random(args.seed * 1000 + index)
+                user = VirtualUser(client, recorder, accounts[index % len(accounts)], course_ids, rng)
+                while time.perf_counter() < deadline:
+                    await getattr(user, rng.choices(names, weights)[0])()
+
+            started = time.perf_counter()
+            await asyncio.gather(*(virtual_user(i) for i in range(args.concurrency)))
+            elapsed = time.perf_counter() - started
+
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != "output"} | {"mix": mix},
+        "git_commit": git_commit(),
+        "python": sys.version.split()[0],
+        "cpu_count": os.cpu_count(),
+        "elapsed_s": round(elapsed, 3),
+        **recorder.report(elapsed),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="study-bench-") as workdir:
+        configure_environment(args, workdir)
+        report = asyncio.run(run(args))
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
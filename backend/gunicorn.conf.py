@@ -0,0 +1,51 @@
+# Multi-worker mode: gunicorn supervises uvicorn workers, one per available CPU.
+#
+#     gunicorn -c gunicorn.conf.py app.main:app
+#
+# WEB_CONCURRENCY overrides the worker count. Workers share caches, rate limits and the LLM
+# concurrency budget through SHARED_STATE_URL (see app/shared_state.py); when it isn't set and
+# more than one worker runs, a SQLite file in the container's temp dir is used. /metrics
+# sums every worker's registry through METRICS_MULTIPROC_DIR (see app/metrics.py).
+import os
+import shutil
+import tempfile
+
+
+def available_cpus() -> int:
+    # Container CPU limits (cgroup v2 cpu.max) are lower than the host's core count
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return max(1, int(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", available_cpus()))
+worker_class = "uvicorn_worker.UvicornWorker"
+# LLM streams run for a while; give workers time to finish them on restart/deploy
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "60"))
+keepalive = 5
+# Recycle workers now and then to bound fragmentation from large chat payloads
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "5000"))
+max_requests_jitter = max_requests // 10
+accesslog = "-"
+
+if workers > 1:
+    os.environ.setdefault("SHARED_STATE_URL", f"sqlite:///{tempfile.gettempdir()}/study_app_shared_state.db")
+    os.environ.setdefault("METRICS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "study_app_metrics"))
+
+
+def on_starting(server):
+    # Counters start from zero with the server, not from a previous run's snapshots
+    directory = os.environ.get("METRICS_MULTIPROC_DIR")
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
@@ -1,31 +1,34 @@
-from fastapi.testclient import TestClient
-from app.main import app
-from app import models, database
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import asyncio
+import datetime
+import gzip
+import json
+import os
+import sqlite3
+import time
 
-from sqlalchemy.pool import StaticPool
+# Never call a real LLM from the test suite
+os.environ["LLM_PROVIDER"] = "stub"
 
-# Use in-memory SQLite for testing
-SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
+import tempfile
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-    connect_args={"check_same_thread": False},
-    poolclass=StaticPool,
-)
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Sync and async engines need to see the same database, so use a temp file rather than :memory:
+_test_dir = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{_test_dir}/test.db"
+# Exercise the WAL + writer pools / read-only reader split used in production
+os.environ["DB_PROFILE"] = "production"
+os.environ["RETRIEVAL_INDEX_DIR"] = f"{_test_dir}/retrieval_index"
+os.environ["CONTENT_STORE_URL"] = f"file://{_test_dir}/content_store"
+os.environ["JOB_QUEUE_URL"] = f"sqlite:///{_test_dir}/job_queue.db"
 
-models.Base.metadata.create_all(bind=engine)
-
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
-        yield db
-    finally:
-        db.close()
+import pytest
+from fastapi.testclient import TestClient
+from app.main import app
+from app import models, database, llm_providers, llm_cache, chat_context, auth, seed, catalog, search, retrieval, rollups, metrics, profiling, archive, migrate, startup, jobs, pagination
+from app.routers import llm
 
-app.dependency_overrides[database.get_db] = override_get_db
+# The module-level client doesn't run the lifespan, so apply the schema the way the init container does
+migrate.run()
+TestingSessionLocal = database.SessionLocal
 
 client = TestClient(app)
 
@@ -44,6 +47,25 @@ def test_register_user():
     assert data["username"] == "testuser"
     assert "id" in data
 
+def test_register_reports_which_unique_field_is_taken(monkeypatch):
+    from app.routers import auth as auth_router
+    user = {"username": "dupcheck", "email": "dupcheck@example.com", "password": "password123"}
+    assert client.post("/auth/register", json=user).status_code == 200
+    assert client.post("/auth/register", json=user).json()["detail"] == "Username already registered"
+    taken_email = {**user, "username": "dupcheck2"}
+    assert client.post("/auth/register", json=taken_email).json()["detail"] == "Email already registered"
+
+    # A duplicate that slips past the pre-check (concurrent registration) is reported by the unique index
+    real = auth_router.registration_conflict
+    calls = []
+
+    async def racing(db, user):
+        calls.append(user.username)
+        return None if len(calls) == 1 else await real(db, user)
+    monkeypatch.setattr(auth_router, "registration_conflict", racing)
+    response = client.post("/auth/register", json=taken_email)
+    assert response.status_code == 400 and response.json()["detail"] == "Email already registered"
+
 def test_login_user():
     # Register first
     client.post(
@@ -58,3 +80,1162 @@ def test_login_user():
     data = response.json()
     assert "access_token" in data
     assert data["token_type"] == "bearer"
+
+def auth_headers(username, password="password123"):
+    client.post(
+        "/auth/register",
+        json={"username": username, "email": f"{username}@example.com", "password": password},
+    )
+    response = client.post("/auth/token", data={"username": username, "password": password})
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+def test_chat_uses_stub_provider():
+    headers = auth_headers("chatter")
+    response = client.post("/llm/chat", json={"message": "Explain Big-O", "topic": "Algorithms"}, headers=headers)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["role"] == "ai"
+    assert "Explain Big-O" in data["content"]
+
+def test_chat_fails_fast_when_llm_queue_full():
+    headers = auth_headers("busyuser")
+    limiter = llm_providers.ConcurrencyLimiter(max_concurrency=1, max_queue=0)
+    llm_providers.set_limiter(limiter)
+
+    class BlockedProvider(llm_providers.LLMProvider):
+        async def generate(self, history):
+            # A second request arriving now would have to wait for the only slot
+            async with limiter.slot():
+                pass
+            return "unreachable"
+
+    llm_providers.set_provider(BlockedProvider())
+    try:
+        response = client.post("/llm/chat", json={"message": "hi"}, headers=headers)
+        assert response.status_code == 503
+        assert "Retry-After" in response.headers
+    finally:
+        llm_providers.set_limiter(None)
+        llm_providers.set_provider(None)
+
+def test_llm_retry_honours_server_hint(monkeypatch):
+    delays = []
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(llm_providers.asyncio, "sleep", fake_sleep)
+    provider = llm_providers.StubProvider(rate_limit_ratio=1.0, retry_after=7)
+    with pytest.raises(llm_providers.LLMRateLimitError):
+        asyncio.run(llm_providers.generate_with_retry(provider, [{"role": "user", "parts": ["hi"]}], max_retries=3))
+    assert len(delays) == 2
+    assert all(7 <= d <= 8 for d in delays)
+    assert llm_providers.parse_retry_after("429 Quota exceeded. Please retry in 21.5s.") == 21.5
+    # No retries configured still means one attempt
+    assert "hi" in asyncio.run(llm_providers.generate_with_retry(llm_providers.StubProvider(), [{"role": "user", "parts": ["hi"]}], max_retries=0))
+
+def test_chat_stream_emits_tokens_and_persists_once():
+    headers = auth_headers("streamer")
+    with client.stream("POST", "/llm/chat/stream", json={"message": "Summarise chapter 1"}, headers=headers) as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        body = "".join(response.iter_text())
+
+    events = [block.split("\n") for block in body.strip().split("\n\n")]
+    names = [lines[0].removeprefix("event: ") for lines in events]
+    assert names[0] == "session"
+    assert names[-1] == "done"
+    assert names.count("token") > 1
+
+    done = json.loads(events[-1][1].removeprefix("data: "))
+    tokens = "".join(json.loads(lines[1].removeprefix("data: "))["text"] for lines in events if lines[0] == "event: token")
+    assert done["content"] == tokens
+    db = TestingSessionLocal()
+    try:
+        ai_rows = db.query(models.ChatMessage).filter(
+            models.ChatMessage.session_id == done["session_id"], models.ChatMessage.role == "ai"
+        ).count()
+    finally:
+        db.close()
+    assert ai_rows == 1
+
+def test_llm_cache_normalises_and_respects_session_opt_out():
+    cache = llm_cache.ResponseCache()
+    llm_cache.set_cache(cache)
+    calls = []
+
+    class CountingProvider(llm_providers.StubProvider):
+        async def generate(self, history):
+            calls.append(history[-1]["parts"][0])
+            return await super().generate(history)
+
+    llm_providers.set_provider(CountingProvider())
+    try:
+        headers = auth_headers("cacheuser")
+        first = client.post("/llm/chat", json={"message": "Explain Big-O?"}, headers=headers).json()
+        second = client.post("/llm/chat", json={"message": "explain  big-o"}, headers=headers).json()
+        assert len(calls) == 1
+        assert second["content"] == first["content"]
+        assert cache.stats["hits"] == 1
+
+        client.post("/llm/chat", json={"message": "Explain Big-O?", "cache_opt_out": True}, headers=headers)
+        assert len(calls) == 2
+    finally:
+        llm_providers.set_provider(None)
+        llm_cache.set_cache(None)
+
+def test_llm_cache_evicts_by_size_and_ttl(tmp_path):
+    backend = llm_cache.SQLiteCacheBackend(str(tmp_path / "shared.db"))
+    cache = llm_cache.ResponseCache(max_bytes=200, ttl=60, backend=backend)
+    asyncio.run(cache.set("a" * 10, "x" * 100))
+    asyncio.run(cache.set("b" * 10, "y" * 100))
+    assert cache.snapshot()["entries"] == 1
+    assert cache.stats["evictions"] == 1
+
+    # Evicted locally but still served from the shared tier
+    assert asyncio.run(cache.get("a" * 10)) == "x" * 100
+    assert cache.stats["shared_hits"] == 1
+
+    cache.ttl = -1
+    asyncio.run(cache.set("c", "z"))
+    assert cache._get_local("c") is None
+
+    # The shared tier sweeps expired rows and trims itself to max_bytes as it is written
+    backend.max_bytes, backend.PURGE_EVERY, backend._writes = 250, 2, 0
+    for index in range(4):
+        backend.set(f"k{index}", "v" * 100, ttl=60)
+    rows = sqlite3.connect(backend.path).execute("SELECT key FROM llm_cache ORDER BY key").fetchall()
+    assert rows == [("k2",), ("k3",)]
+
+def test_chat_context_keeps_recent_turns_within_budget(monkeypatch):
+    monkeypatch.setenv("LLM_CONTEXT_TOKEN_BUDGET", "120")
+    monkeypatch.setenv("LLM_SUMMARY_MIN_TOKENS", "1")
+    prompts = []
+
+    class RecordingProvider(llm_providers.StubProvider):
+        async def generate(self, history):
+            prompts.append(history)
+            return "ok"
+
+    llm_providers.set_provider(RecordingProvider())
+    try:
+        headers = auth_headers("longsession")
+        session_id = None
+        for i in range(6):
+            payload = {"message": f"question {i} " + "padding " * 20, "cache_opt_out": True}
+            if session_id:
+                payload["session_id"] = session_id
+            session_id = client.post("/llm/chat", json=payload, headers=headers).json()["session_id"]
+    finally:
+        llm_providers.set_provider(None)
+
+    chat_prompts = [p for p in prompts if p[0]["parts"][0].startswith(chat_context.SYSTEM_PROMPT)]
+    last_prompt = chat_prompts[-1]
+    texts = [entry["parts"][0] for entry in last_prompt[2:]]
+    assert texts[-1].startswith("question 5")
+    assert not any(t.startswith("question 0") for t in texts)
+    assert sum(chat_context.estimate_tokens(t) for t in texts) <= 120
+
+    db = TestingSessionLocal()
+    try:
+        session = db.query(models.StudySession).filter(models.StudySession.id == session_id).first()
+        assert session.summary == "ok"
+        assert session.summary_upto_id is not None
+    finally:
+        db.close()
+    assert "Summary of the earlier conversation" in last_prompt[0]["parts"][0]
+
+def test_principal_cache_skips_db_and_invalidates_on_role_change():
+    headers = auth_headers("cachedprincipal")
+    client.get("/auth/me", headers=headers)
+    lookups = auth.principal_stats["db_lookups"]
+    response = client.get("/auth/me", headers=headers)
+    assert response.json()["role"] == "student"
+    assert auth.principal_stats["db_lookups"] == lookups
+
+    db = TestingSessionLocal()
+    try:
+        user = db.query(models.User).filter(models.User.username == "cachedprincipal").first()
+        user.role = models.UserRole.ADMIN
+        db.commit()
+    finally:
+        db.close()
+    response = client.get("/auth/me", headers=headers)
+    assert response.json()["role"] == "admin"
+    assert auth.principal_stats["db_lookups"] == lookups + 1
+
+    # A change that is flushed but rolled back leaves the cached principal alone
+    db = TestingSessionLocal()
+    try:
+        user = db.query(models.User).filter(models.User.username == "cachedprincipal").first()
+        user.role = models.UserRole.STUDENT
+        db.flush()
+        db.rollback()
+    finally:
+        db.close()
+    response = client.get("/auth/me", headers=headers)
+    assert response.json()["role"] == "admin"
+    assert auth.principal_stats["db_lookups"] == lookups + 1
+
+def test_principal_from_trusted_token_claims(monkeypatch):
+    headers = auth_headers("claimsuser")
+    monkeypatch.setattr(auth, "TRUST_TOKEN_CLAIMS", True)
+    lookups = auth.principal_stats["db_lookups"]
+    auth.invalidate_principal(None)
+    response = client.get("/auth/me", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["username"] == "claimsuser"
+    assert auth.principal_stats["db_lookups"] == lookups
+
+    # Deactivation is seen immediately, even though the token still says active
+    db = TestingSessionLocal()
+    try:
+        db.query(models.User).filter(models.User.username == "claimsuser").first().is_active = False
+        db.commit()
+    finally:
+        db.close()
+    assert client.get("/auth/me", headers=headers).status_code == 400
+
+def test_login_rehashes_outdated_argon2_parameters():
+    db = TestingSessionLocal()
+    try:
+        old_context = auth.CryptContext(schemes=["argon2"], argon2__rounds=1, argon2__memory_cost=8192)
+        db.add(models.User(username="legacyhash", email="legacy@example.com", hashed_password=old_context.hash("password123")))
+        db.commit()
+    finally:
+        db.close()
+
+    response = client.post("/auth/token", data={"username": "legacyhash", "password": "password123"})
+    assert response.status_code == 200
+
+    db = TestingSessionLocal()
+    try:
+        stored = db.query(models.User).filter(models.User.username == "legacyhash").first().hashed_password
+    finally:
+        db.close()
+    assert f"t={auth.ARGON2_TIME_COST}" in stored
+    assert not auth.pwd_context.needs_update(stored)
+
+def test_login_returns_503_when_hasher_pool_full():
+    pool = auth.PasswordHasherPool(workers=1, max_queue=0)
+    pool.pending = 1
+    auth.set_hasher_pool(pool)
+    try:
+        response = client.post("/auth/token", data={"username": "testlogin", "password": "password123"})
+        assert response.status_code == 503
+        assert pool.rejected == 1
+    finally:
+        auth.set_hasher_pool(None)
+
+def test_notes_crud_on_async_session():
+    headers = auth_headers("noteowner")
+    created = client.post("/notes", json={"title": "Draft", "content": "v1"}, headers=headers).json()
+    updated = client.put(f"/notes/{created['id']}", json={"title": "Final", "content": "v2"}, headers=headers).json()
+    assert updated["title"] == "Final"
+    assert updated["updated_at"] >= created["updated_at"]
+
+    other = auth_headers("notestranger")
+    assert client.put(f"/notes/{created['id']}", json={"title": "x", "content": "y"}, headers=other).status_code == 404
+
+    assert [n["id"] for n in client.get("/notes", headers=headers).json()] == [created["id"]]
+    assert client.delete(f"/notes/{created['id']}", headers=headers).status_code == 200
+    assert client.get("/notes", headers=headers).json() == []
+
+def test_production_profile_applies_pragmas_and_read_only_split():
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+
+    with database.engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1 # NORMAL
+    assert database.engine.pool.size() == 1
+
+    assert database.read_engine is not database.engine
+    with database.read_engine.connect() as conn:
+        assert conn.execute(text("SELECT count(*) FROM users")).scalar() >= 0
+        with pytest.raises(OperationalError):
+            conn.execute(text("DELETE FROM users"))
+
+def test_course_catalogue_etag_and_invalidation():
+    db = TestingSessionLocal()
+    try:
+        seed.seed_demo_courses(db)
+        assert not seed.seed_demo_courses(db)
+    finally:
+        db.close()
+    catalog.invalidate()
+
+    first = client.get("/courses")
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+    assert any(c["title"] == "FastAPI Masterclass" for c in first.json())
+
+    assert client.get("/courses", headers={"If-None-Match": etag}).status_code == 304
+
+    admin_headers = auth_headers("catalogadmin")
+    db = TestingSessionLocal()
+    try:
+        db.query(models.User).filter(models.User.username == "catalogadmin").first().role = models.UserRole.ADMIN
+        db.commit()
+    finally:
+        db.close()
+    created = client.post(
+        "/admin/courses",
+        json={"title": "New Course", "description": "d", "price": 100, "image_url": "http://x"},
+        headers=admin_headers,
+    )
+    assert created.status_code == 200
+
+    refreshed = client.get("/courses", headers={"If-None-Match": etag})
+    assert refreshed.status_code == 200
+    assert refreshed.headers["etag"] != etag
+    assert refreshed.json()[-1]["title"] == "New Course"
+
+def test_notes_keyset_pagination_filters_and_fields(monkeypatch):
+    headers = auth_headers("pager")
+    for i in range(5):
+        client.post("/notes", json={"title": f"{'algo' if i % 2 else 'bio'} {i}", "content": "x" * 50}, headers=headers)
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        page = client.get("/notes", params=params, headers=headers)
+        assert len(page.json()) <= 2
+        seen += [n["title"] for n in page.json()]
+        cursor = page.headers.get("x-next-cursor")
+        if not cursor:
+            break
+    assert seen == ["bio 0", "algo 1", "bio 2", "algo 3", "bio 4"]
+    # Without limit or cursor the list is unpaginated, as before
+    monkeypatch.setattr(pagination, "DEFAULT_LIMIT", 2)
+    everything = client.get("/notes", headers=headers)
+    assert [n["title"] for n in everything.json()] == seen and "x-next-cursor" not in everything.headers
+
+    filtered = client.get("/notes", params={"title_prefix": "algo", "fields": "id,title"}, headers=headers).json()
+    assert filtered == [{"id": n["id"], "title": n["title"]} for n in filtered]
+    assert [n["title"] for n in filtered] == ["algo 1", "algo 3"]
+
+    assert client.get("/notes", params={"fields": "password"}, headers=headers).status_code == 400
+    assert client.get("/notes", params={"cursor": "garbage"}, headers=headers).status_code == 400
+
+def test_course_filters_and_session_message_pages():
+    db = TestingSessionLocal()
+    try:
+        db.add_all([models.Course(title=f"Zeta {p}", description="d", price=p, image_url="i") for p in (100, 200, 300)])
+        db.commit()
+    finally:
+        db.close()
+    courses = client.get("/courses", params={"title_prefix": "Zeta", "min_price": 150, "fields": "title,price"}).json()
+    assert courses == [{"title": "Zeta 200", "price": 200}, {"title": "Zeta 300", "price": 300}]
+
+    headers = auth_headers("historypager")
+    session_id = client.post("/llm/chat", json={"message": "one"}, headers=headers).json()["session_id"]
+    client.post("/llm/chat", json={"message": "two", "session_id": session_id}, headers=headers)
+    first = client.get(f"/llm/sessions/{session_id}/messages", params={"limit": 3}, headers=headers)
+    assert [m["role"] for m in first.json()] == ["ai", "user", "ai"]
+    rest = client.get(f"/llm/sessions/{session_id}/messages", params={"cursor": first.headers["x-next-cursor"]}, headers=headers)
+    assert [m["content"] for m in rest.json()] == ["one"]
+    assert client.get(f"/llm/sessions/{session_id}/messages", headers=auth_headers("historysnoop")).status_code == 404
+
+def make_admin(username):
+    headers = auth_headers(username)
+    db = TestingSessionLocal()
+    try:
+        db.query(models.User).filter(models.User.username == username).first().role = models.UserRole.ADMIN
+        db.commit()
+    finally:
+        db.close()
+    return headers
+
+def test_search_ranks_highlights_and_respects_access():
+    admin_headers = make_admin("searchadmin")
+    course_id = client.post(
+        "/admin/courses",
+        json={"title": "Graph Theory", "description": "d", "price": 10, "image_url": "i"},
+        headers=admin_headers,
+    ).json()["id"]
+    client.post(f"/admin/courses/{course_id}/content",
+                json={"title": "Dijkstra", "type": "text", "data": "Shortest paths with a priority queue"},
+                headers=admin_headers)
+
+    student = auth_headers("searchstudent")
+    note = client.post("/notes", json={"title": "Queues", "content": "priority queue revision"}, headers=student).json()
+    client.post("/notes", json={"title": "Private", "content": "priority queue secrets"}, headers=auth_headers("searchother"))
+
+    results = client.get("/search", params={"q": "priority queue"}, headers=student).json()
+    assert [(r["kind"], r["ref_id"]) for r in results] == [("note", note["id"])]
+    assert "<mark>" in results[0]["snippet"]
+    # Stored text is escaped; only the match markers are markup
+    client.post("/notes", json={"title": "<b>Tags</b>", "content": "<img src=x onerror=alert(1)> xsscheck"}, headers=student)
+    hit = client.get("/search", params={"q": "xsscheck"}, headers=student).json()[0]
+    assert hit["snippet"] == "&lt;img src=x onerror=alert(1)&gt; <mark>xsscheck</mark>" and hit["title"] == "&lt;b&gt;Tags&lt;/b&gt;"
+
+    client.post(f"/courses/{course_id}/buy", headers=student)
+    results = client.get("/search", params={"q": "priority qu"}, headers=student).json()
+    assert {r["kind"] for r in results} == {"note", "content"}
+    assert client.get("/search", params={"q": "priority", "kind": "content"}, headers=student).json()[0]["title"] == "Dijkstra"
+
+    # Edits and deletes are reflected immediately
+    client.put(f"/notes/{note['id']}", json={"title": "Heaps", "content": "binary heap"}, headers=student)
+    assert client.get("/search", params={"q": "priority", "kind": "note"}, headers=student).json() == []
+    client.delete(f"/notes/{note['id']}", headers=student)
+    assert client.get("/search", params={"q": "heap"}, headers=student).json() == []
+
+    assert search.rebuild(database.engine) > 0
+    assert len(client.get("/search", params={"q": "priority"}, headers=student).json()) == 1
+    assert client.get("/search", params={"q": '"); DROP'}, headers=student).status_code == 200
+
+def test_chat_is_grounded_in_enrolled_course_material():
+    admin_headers = make_admin("ragadmin")
+    course_id = client.post(
+        "/admin/courses",
+        json={"title": "Marine Biology", "description": "d", "price": 10, "image_url": "i"},
+        headers=admin_headers,
+    ).json()["id"]
+    client.post(f"/admin/courses/{course_id}/content",
+                json={"title": "Cephalopods", "type": "text", "data": "Octopuses have three hearts and blue copper-based blood."},
+                headers=admin_headers)
+    client.post(f"/admin/courses/{course_id}/content",
+                json={"title": "Octopus video", "type": "video", "data": "https://example.com/octopus.mp4"},
+                headers=admin_headers)
+    prompts = []
+
+    class RecordingProvider(llm_providers.StubProvider):
+        async def generate(self, history):
+            prompts.append(history[0]["parts"][0])
+            return "ok"
+
+    llm_providers.set_provider(RecordingProvider())
+    try:
+        student = auth_headers("ragstudent")
+        question = {"message": "How many hearts does an octopus have?", "cache_opt_out": True}
+        client.post("/llm/chat", json=question, headers=student)
+        client.post(f"/courses/{course_id}/buy", headers=student)
+        client.post("/llm/chat", json=question, headers=student)
+    finally:
+        llm_providers.set_provider(None)
+
+    assert "three hearts" not in prompts[0]
+    assert "[1] Cephalopods: Octopuses have three hearts" in prompts[1]
+    assert "example.com" not in prompts[1]
+
+def test_retrieval_index_rebuild_and_delta_replay():
+    index = retrieval.get_index()
+    db = TestingSessionLocal()
+    try:
+        index.rebuild(db)
+    finally:
+        db.close()
+    assert index.base.n_chunks > 0 and index.delta == []
+
+    content = models.Content(id=10**6, course_id=424242, title="Tides", type="text", data="lunar gravity drives ocean tides")
+    index.add_content(content)
+    # A fresh process replays the delta log on top of the memory-mapped base
+    reopened = retrieval.RetrievalIndex(index.path)
+    assert reopened.base.n_chunks == index.base.n_chunks
+    assert reopened.search("what causes tides", [424242])[0]["content_id"] == 10**6
+    assert reopened.search("what causes tides", [1]) == []
+    assert retrieval.chunk_text("a b c d e", chunk_words=3, overlap=1) == ["a b c", "c d e"]
+
+def test_dashboard_reads_rollups_maintained_by_write_paths():
+    owner = auth_headers("rollupowner")
+    db = TestingSessionLocal()
+    try:
+        db.query(models.User).filter(models.User.username == "rollupowner").first().role = models.UserRole.OWNER
+        db.commit()
+        # Some fixtures above insert rows directly; start from counters rebuilt off the raw tables
+        rollups.backfill(db)
+    finally:
+        db.close()
+    before = client.get("/analytics/dashboard", headers=owner).json()
+
+    course = client.post("/admin/courses", json={"title": "Rollups", "description": "d", "price": 700, "image_url": "i"},
+                         headers=make_admin("rollupadmin")).json()
+    student = auth_headers("rollupstudent")
+    client.post(f"/courses/{course['id']}/buy", headers=student)
+    client.post("/llm/chat", json={"message": "hello", "cache_opt_out": True}, headers=student)
+
+    after = client.get("/analytics/dashboard", headers=owner).json()
+    assert after["total_users"] == before["total_users"] + 2
+    assert after["total_courses"] == before["total_courses"] + 1
+    assert after["total_enrollments"] == before["total_enrollments"] + 1
+    assert after["total_revenue"] == before["total_revenue"] + 700
+
+    by_course = client.get("/analytics/revenue/by-course", headers=owner).json()
+    assert {"course_id": course["id"], "enrollments": 1, "revenue": 700} in by_course
+    latency = client.get("/analytics/series", params={"metric": "llm_latency_ms", "granularity": "hour"}, headers=owner).json()
+    assert latency[-1]["count"] >= 1 and latency[-1]["average"] is not None
+    assert client.get("/analytics/series", params={"metric": "nope"}, headers=owner).status_code == 400
+
+    # A backfill from the raw tables agrees with the incrementally maintained values
+    db = TestingSessionLocal()
+    try:
+        rollups.backfill(db)
+    finally:
+        db.close()
+    assert client.get("/analytics/dashboard", headers=owner).json() == after
+    signups = client.get("/analytics/series", params={"metric": "signups"}, headers=owner).json()
+    assert sum(row["count"] for row in signups) == after["total_users"]
+
+def test_metrics_endpoint_reports_routes_sql_and_llm():
+    headers = auth_headers("metricsuser")
+    client.get("/notes", headers=headers)
+    client.post("/llm/chat", json={"message": "metrics please", "cache_opt_out": True}, headers=headers)
+
+    body = client.get("/metrics").text
+    assert 'http_requests_total{method="GET",route="/notes",status="200"}' in body
+    assert 'http_request_duration_seconds_bucket{method="POST",route="/llm/chat",le="+Inf"}' in body
+    assert "http_requests_in_flight 1" in body # the scrape itself
+    assert metrics.HTTP_DB_QUERIES.count(route="/notes") >= 1
+    notes_queries = [line for line in body.splitlines() if line.startswith('http_request_db_queries_sum{route="/notes"}')]
+    assert float(notes_queries[0].split()[-1]) > 0 # async session queries are attributed to the request
+    assert metrics.LLM_TOKENS.value(provider="stub", kind="completion") > 0
+    assert 'llm_request_duration_seconds_count{provider="stub",operation="generate",outcome="ok"}' in body
+
+def test_slow_request_profiler_writes_folded_stacks(tmp_path):
+    profiler = profiling.SamplingProfiler(interval=0.001, max_samples=10000, out_dir=str(tmp_path))
+    profiler.start()
+
+    def busy_handler():
+        deadline = time.perf_counter() + 0.1
+        while time.perf_counter() < deadline:
+            pass
+
+    started = time.time()
+    busy_handler()
+    path = profiler.dump("GET", "/slow/{item_id}", started, time.time() - started)
+    assert os.path.basename(path).startswith(time.strftime("%Y")) and "GET-slow_item_id" in path
+    lines = open(path).read().splitlines()
+    assert any("busy_handler (test_main.py:" in line for line in lines)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+def test_session_listing_and_history_pages_without_loading_all_messages():
+    headers = auth_headers("historyuser")
+    session_ids = []
+    for topic in ("Algebra", "Biology", "Chemistry"):
+        reply = client.post("/llm/chat", json={"message": f"{topic} question", "topic": topic, "cache_opt_out": True}, headers=headers).json()
+        session_ids.append(reply["session_id"])
+    client.post("/llm/chat", json={"message": "follow-up", "session_id": session_ids[0], "cache_opt_out": True}, headers=headers)
+
+    first = client.get("/llm/sessions", params={"limit": 2}, headers=headers)
+    assert [s["id"] for s in first.json()] == [session_ids[2], session_ids[1]]
+    assert "messages" not in first.json()[0]
+    assert first.json()[0]["last_message"]["role"] == "ai"
+    rest = client.get("/llm/sessions", params={"cursor": first.headers["x-next-cursor"]}, headers=headers).json()
+    assert [s["id"] for s in rest] == [session_ids[0]]
+    assert "follow-up" in rest[0]["last_message"]["content"]
+
+    seen = []
+    cursor = None
+    while True:
+        page = client.get("/llm/messages", params={"limit": 3, **({"cursor": cursor} if cursor else {})}, headers=headers)
+        seen += [(m["session_id"], m["id"]) for m in page.json()]
+        cursor = page.headers.get("x-next-cursor")
+        if not cursor:
+            break
+    assert len(seen) == 8 and seen == sorted(seen, reverse=True)
+    assert client.get(f"/llm/sessions/{session_ids[0]}", headers=auth_headers("historyother")).status_code == 404
+
+    db = TestingSessionLocal()
+    try:
+        session = db.query(models.StudySession).filter(models.StudySession.id == session_ids[0]).one()
+        with pytest.raises(Exception, match="lazy='raise'"):
+            session.messages
+    finally:
+        db.close()
+
+def test_inactive_sessions_are_archived_compacted_and_rehydrated():
+    headers = auth_headers("archiveuser")
+    session_id = None
+    for i in range(3):
+        payload = {"message": f"archived turn {i} " + "lorem ipsum " * 200, "cache_opt_out": True}
+        if session_id:
+            payload["session_id"] = session_id
+        session_id = client.post("/llm/chat", json=payload, headers=headers).json()["session_id"]
+    db = TestingSessionLocal()
+    try:
+        for message in db.query(models.ChatMessage).filter(models.ChatMessage.session_id == session_id):
+            message.timestamp -= datetime.timedelta(days=90)
+        db.commit()
+    finally:
+        db.close()
+    before = client.get(f"/llm/sessions/{session_id}/messages", headers=headers).json()
+    report = archive.run_maintenance(older_than_days=30)
+    assert report["archived"]["sessions"] >= 1
+    assert report["archived"]["compressed_bytes"] < report["archived"]["raw_bytes"] / 5
+    assert report["compaction"]["reclaimed_bytes"] >= 0
+
+    db = TestingSessionLocal()
+    try:
+        assert db.query(models.ChatMessage).filter(models.ChatMessage.session_id == session_id).count() == 0
+        assert archive.last_report(db) == report # stored, not kept in the process that ran it
+    finally:
+        db.close()
+    # History stays readable from cold storage, then chatting again moves it back
+    assert client.get(f"/llm/sessions/{session_id}/messages", headers=headers).json() == before
+    # Ids freed by archival aren't handed out again, so the restore can't collide
+    other = client.post("/llm/chat", json={"message": "meanwhile", "cache_opt_out": True}, headers=headers).json()
+    assert other["id"] > max(m["id"] for m in before)
+    db = TestingSessionLocal()
+    try:
+        backfilled = rollups.backfill(db)
+        archived_counted = sum(b.count for b in db.query(models.AnalyticsBucket).filter(
+            models.AnalyticsBucket.metric == "chat_messages", models.AnalyticsBucket.granularity == "day"
+        ))
+        assert backfilled["buckets"] and archived_counted == db.query(models.ChatMessage).count() + report["archived"]["messages"]
+    finally:
+        db.close()
+    assert client.post("/llm/chat", json={"message": "back again", "session_id": session_id, "cache_opt_out": True}, headers=headers).status_code == 200
+    after = client.get(f"/llm/sessions/{session_id}/messages", headers=headers).json()
+    assert after[2:] == before and after[1]["content"] == "back again"
+
+def test_large_responses_are_compressed_and_small_ones_and_streams_are_not():
+    headers = auth_headers("compressuser")
+    for i in range(5):
+        client.post("/notes", json={"title": f"Long {i}", "content": "mitochondria are the powerhouse " * 100}, headers=headers)
+    response = client.get("/notes", headers=headers)
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert int(response.headers["content-length"]) < len(response.content) / 5
+    assert len(response.json()) == 5 and response.json()[0]["created_at"]
+
+    assert "content-encoding" not in client.get("/notes", params={"limit": 1, "fields": "id"}, headers=headers).headers
+    assert "content-encoding" not in client.get("/notes", headers={**headers, "Accept-Encoding": "identity"}).headers
+    with client.stream("POST", "/llm/chat/stream", json={"message": "x " * 600, "cache_opt_out": True}, headers=headers) as stream:
+        assert "content-encoding" not in stream.headers
+
+    # The catalogue's strong ETag becomes weak once compressed, and still revalidates
+    catalogue = client.get("/courses", params={}, headers={"Accept-Encoding": "gzip"})
+    if "content-encoding" in catalogue.headers:
+        assert catalogue.headers["etag"].startswith('W/"')
+    assert client.get("/courses", headers={"If-None-Match": catalogue.headers["etag"]}).status_code == 304
+
+def test_large_bodies_are_compressed_off_the_event_loop(monkeypatch):
+    from app import responses
+    headers = auth_headers("threadcompress")
+    client.post("/notes", json={"title": "Long", "content": "krebs cycle " * 300}, headers=headers)
+    offloaded = []
+    run_sync = responses.anyio.to_thread.run_sync
+
+    async def recording_run_sync(fn, *args, **kwargs):
+        if fn is responses.compress: # anyio's run_sync also backs FastAPI's sync endpoints
+            offloaded.append(fn)
+        return await run_sync(fn, *args, **kwargs)
+
+    monkeypatch.setattr(responses.anyio.to_thread, "run_sync", recording_run_sync)
+    monkeypatch.setattr(responses, "COMPRESSION_THREAD_MIN_BYTES", 1 << 30)
+    assert client.get("/notes", headers=headers).headers["content-encoding"] == "gzip"
+    assert offloaded == []
+    monkeypatch.setattr(responses, "COMPRESSION_THREAD_MIN_BYTES", 0)
+    response = client.get("/notes", headers=headers)
+    assert response.headers["content-encoding"] == "gzip" and response.json()[0]["title"] == "Long"
+    assert offloaded == [responses.compress]
+
+def test_fast_json_matches_pydantic_encoding():
+    from app import responses
+    note = {"id": 1, "when": datetime.datetime(2024, 5, 1, 12, 30, 15, 123456), "role": models.UserRole.ADMIN, "text": "naïve ✓"}
+    assert json.loads(responses.dumps(note)) == {"id": 1, "when": "2024-05-01T12:30:15.123456", "role": "admin", "text": "naïve ✓"}
+
+def test_migrations_run_once_per_schema_and_app_import_does_no_ddl(tmp_path):
+    import subprocess, sys
+    engine = database.create_sqlite_aware_engine(f"sqlite:///{tmp_path}/fresh.db")
+    assert migrate.run(engine) is True
+    assert migrate.run(engine) is False
+    assert migrate.applied_fingerprint(engine) == migrate.fingerprint(models.Base.metadata)
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql(f"SELECT 1 FROM sqlite_master WHERE name = '{search.FTS_TABLE}'").first()
+    engine.dispose()
+
+    # chat_messages from before AUTOINCREMENT is rebuilt, with ids continuing past archived ones
+    engine = database.create_sqlite_aware_engine(f"sqlite:///{tmp_path}/old.db")
+    models.Base.metadata.create_all(engine)
+    payload = json.dumps([{"id": 9, "role": "user", "content": "old", "timestamp": None}]).encode()
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP TABLE chat_messages")
+        conn.exec_driver_sql("CREATE TABLE chat_messages (id INTEGER PRIMARY KEY, session_id INTEGER, role VARCHAR,"
+                             " content TEXT, timestamp DATETIME, job_id INTEGER)")
+        conn.exec_driver_sql("INSERT INTO chat_messages (id, session_id, role, content) VALUES (3, 2, 'user', 'live')")
+        conn.execute(models.ChatArchive.__table__.insert().values(session_id=1, codec="gzip", payload=gzip.compress(payload)))
+    assert migrate.run(engine) is True
+    with engine.begin() as conn:
+        assert "AUTOINCREMENT" in conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE name = 'chat_messages'").scalar()
+        assert conn.exec_driver_sql("SELECT content FROM chat_messages WHERE id = 3").scalar() == "live"
+        assert conn.exec_driver_sql("INSERT INTO chat_messages (session_id, role) VALUES (2, 'ai') RETURNING id").scalar() == 10
+    engine.dispose()
+
+    # Importing the app creates no database and pulls in no LLM SDK
+    env = {**os.environ, "DATABASE_URL": f"sqlite:///{tmp_path}/untouched.db"}
+    code = "import sys, app.main; assert 'google.generativeai' not in sys.modules and 'openai' not in sys.modules"
+    subprocess.run([sys.executable, "-c", code], check=True, env=env, cwd=os.path.dirname(os.path.dirname(__file__)))
+    assert not os.path.exists(tmp_path / "untouched.db")
+
+def test_readiness_waits_for_lifespan():
+    assert client.get("/health").json() == {"status": "ok"}
+    with TestClient(app) as started:
+        body = started.get("/ready").json()
+        assert body["status"] == "ready"
+        assert {"imports", "rollups", "seed", "retrieval_index"} <= set(body["phases_ms"])
+
+def test_sqlite_shared_state_coordinates_workers(tmp_path, monkeypatch):
+    from app import shared_state
+    from concurrent.futures import ThreadPoolExecutor
+    path = str(tmp_path / "shared.db")
+    worker_a, worker_b = shared_state.SQLiteState(path), shared_state.SQLiteState(path)
+
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda i: (worker_a, worker_b)[i % 2].incr("hits"), range(200)))
+    assert worker_a.get("hits") == "200"
+
+    assert worker_a.acquire("llm", "a1", limit=2, ttl=60) and worker_b.acquire("llm", "b1", limit=2, ttl=60)
+    assert not worker_b.acquire("llm", "b2", limit=2, ttl=60)
+    worker_a.release("llm", "a1")
+    assert worker_b.acquire("llm", "b2", limit=2, ttl=60)
+    assert worker_a.acquire("short", "a", limit=1, ttl=0.05) and not worker_b.acquire("short", "b", limit=1, ttl=1)
+    time.sleep(0.1)
+    assert worker_b.acquire("short", "b", limit=1, ttl=1)
+
+    assert worker_a.hit("chat:1", limit=2, window=60) is None and worker_b.hit("chat:1", limit=2, window=60) is None
+    assert 0 < worker_a.hit("chat:1", limit=2, window=60) <= 60
+
+    # A catalogue write in "worker B" invalidates the copy cached by this process
+    # (once the per-process version cache expires; zero here)
+    monkeypatch.setattr(shared_state, "CACHE_SECONDS", 0)
+    monkeypatch.setattr(shared_state, "_state", worker_a)
+    first = client.get("/courses").headers["etag"]
+    db = TestingSessionLocal()
+    db.add(models.Course(title="Shared State 101", description="x", price=100, image_url="x.png"))
+    db.commit()
+    db.close()
+    assert client.get("/courses").headers["etag"] == first
+    worker_b.bump("catalog")
+    assert client.get("/courses").headers["etag"] != first
+
+def test_chat_rate_limit_and_global_llm_budget(monkeypatch):
+    from app import shared_state
+    monkeypatch.setattr(shared_state, "_state", shared_state.LocalState())
+    headers = auth_headers("ratelimited")
+    monkeypatch.setenv("LLM_USER_RATE_LIMIT", "2")
+    assert client.post("/llm/chat", json={"message": "one"}, headers=headers).status_code == 200
+    assert client.post("/llm/chat", json={"message": "two"}, headers=headers).status_code == 200
+    limited = client.post("/llm/chat", json={"message": "three"}, headers=headers)
+    assert limited.status_code == 429 and int(limited.headers["retry-after"]) >= 1
+    assert client.post("/llm/chat", json={"message": "other user"}, headers=auth_headers("notlimited")).status_code == 200
+
+    # Another worker holds the only global slot: this one waits, then gives up with 503
+    monkeypatch.delenv("LLM_USER_RATE_LIMIT")
+    shared_state.get_state().acquire("llm", "other-worker", limit=1, ttl=60)
+    llm_providers.set_limiter(llm_providers.ConcurrencyLimiter(4, 4, global_max_concurrency=1, global_wait=0.2))
+    try:
+        busy = client.post("/llm/chat", json={"message": "blocked", "cache_opt_out": True}, headers=headers)
+        assert busy.status_code == 503
+        shared_state.get_state().release("llm", "other-worker")
+        assert client.post("/llm/chat", json={"message": "free", "cache_opt_out": True}, headers=headers).status_code == 200
+        assert shared_state.get_state().acquire("llm", "check", limit=1, ttl=1) # our lease was released
+    finally:
+        llm_providers.set_limiter(None)
+
+def test_entitlements_cached_per_user_and_invalidated_on_buy_and_role_change():
+    from app import entitlements
+    from sqlalchemy import event
+    headers = auth_headers("entitled")
+    db = TestingSessionLocal()
+    courses = [models.Course(title=f"Entitled {i}", description="x", price=100, image_url="x.png") for i in range(3)]
+    db.add_all(courses)
+    db.flush()
+    db.add(models.Content(course_id=courses[0].id, title="Intro", type="text", data="hello"))
+    db.commit()
+    first, second, third = [course.id for course in courses]
+    user_id = db.query(models.User.id).filter(models.User.username == "entitled").scalar()
+    db.close() # the production profile's writer pool has a single connection
+
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(database.read_engine, "before_cursor_execute", listener)
+    def content(course_id):
+        statements.clear()
+        response = client.get(f"/courses/{course_id}/content", headers=headers)
+        return response.status_code, len([s for s in statements if "users" not in s])
+    try:
+        client.post(f"/courses/{first}/buy", headers=headers)
+        assert content(first) == (200, 1) # cold: enrollment check and content in one query
+        assert content(second) == (403, 1)
+
+        assert [course["id"] for course in client.get("/courses/my", headers=headers).json()] == [first]
+        assert entitlements.cached_course_ids(user_id) == {first}
+        assert content(second) == (403, 0) # warm: refused without touching the database
+        assert content(first) == (200, 1)
+
+        # Buying invalidates once committed
+        client.post(f"/courses/{second}/buy", headers=headers)
+        assert entitlements.cached_course_ids(user_id) is None
+        assert content(second) == (200, 1)
+        assert content(third)[0] == 403
+    finally:
+        event.remove(database.read_engine, "before_cursor_execute", listener)
+
+    # So does a role change
+    client.get("/courses/my", headers=headers)
+    assert entitlements.cached_course_ids(user_id) == {first, second}
+    db = TestingSessionLocal()
+    db.get(models.User, user_id).role = models.UserRole.ADMIN
+    db.commit()
+    db.close()
+    assert entitlements.cached_course_ids(user_id) is None
+
+def test_bulk_import_streams_batches_and_reports_row_errors():
+    admin = auth_headers("importadmin")
+    db = TestingSessionLocal()
+    db.query(models.User).filter(models.User.username == "importadmin").one().role = models.UserRole.ADMIN
+    db.commit()
+    db.close()
+    existing = client.post("/admin/courses", json={"title": "Import Target", "description": "d", "price": 0, "image_url": "x"}, headers=admin).json()["id"]
+    courses_before = rollups.counters(TestingSessionLocal())["courses"]
+
+    lines = [{"kind": "course", "ref": "bulk", "title": "Bulk Imported", "description": "d", "price": 4900, "image_url": "x.png"}]
+    lines += [{"kind": "content", "course_ref": "bulk", "title": f"Lesson {i}", "type": "text", "data": f"photosynthesis lesson {i}"} for i in range(12)]
+    lines += [
+        {"kind": "content", "course_id": existing, "title": "Appendix", "type": "text", "data": "chlorophyll"},
+        {"kind": "content", "course_ref": "missing", "title": "Orphan", "type": "text", "data": "x"},
+        {"kind": "course", "title": "No price", "description": "d", "image_url": "x"},
+        {"kind": "quiz"},
+    ]
+    body = "\n".join(json.dumps(line) for line in lines) + "\n{not json\n"
+
+    def chunks():
+        # Arbitrary chunk boundaries, including mid-line and mid-character
+        data = body.replace("lesson 3", "lesson 3 ✓").encode()
+        for i in range(0, len(data), 37):
+            yield data[i:i + 37]
+
+    report = client.post("/admin/import", params={"batch_size": 5}, content=chunks(),
+                         headers={**admin, "Content-Type": "application/x-ndjson"}).json()
+    assert report["rows"] == 18 and report["courses_created"] == 1 and report["contents_created"] == 13
+    assert report["batches"] == 3
+    assert {error["line"] for error in report["errors"]} == {15, 16, 17, 18}
+    assert "price" in report["errors"][1]["error"] and "Unknown course_ref" in report["errors"][0]["error"]
+    assert rollups.counters(TestingSessionLocal())["courses"] == courses_before + 1
+
+    bulk = next(course for course in client.get("/courses").json() if course["title"] == "Bulk Imported")
+    contents = client.get(f"/courses/{bulk['id']}/content", headers=admin).json()
+    assert [c["title"] for c in contents] == [f"Lesson {i}" for i in range(12)]
+    assert "✓" in client.get(contents[3]["body_url"], headers=admin).text
+    assert any(hit["title"] == "Appendix" for hit in client.get("/search", params={"q": "chlorophyll"}, headers=admin).json())
+    assert retrieval.get_index().search("photosynthesis", [bulk["id"]], 3)
+
+    csv_body = ('kind,ref,course_id,title,description,price,image_url,type,data\n'
+                f'content,,{existing},"Quoted, multi\nline",,,,text,"He said ""hi"""\n'
+                'content,,999999,Ghost,,,,text,x\n'
+                'course,c2,,CSV Course,desc,100,y.png,,\n')
+    report = client.post("/admin/import", content=csv_body, headers={**admin, "Content-Type": "text/csv"}).json()
+    assert report["contents_created"] == 1 and report["courses_created"] == 1
+    assert report["errors"] == [{"line": 4, "error": "Course 999999 not found"}]
+    appendix = client.get(f"/courses/{existing}/content", headers=admin).json()
+    assert appendix[-1]["title"] == "Quoted, multi\nline"
+    assert client.get(appendix[-1]["body_url"], headers=admin).text == 'He said "hi"'
+
+def test_import_line_limit_counts_encoded_bytes(monkeypatch):
+    from app import importer
+    monkeypatch.setattr(importer, "MAX_LINE_BYTES", 10)
+
+    async def lines(*chunks):
+        async def source():
+            for chunk in chunks:
+                yield chunk
+        return [line async for line in importer.iter_lines(source())]
+
+    assert asyncio.run(lines("ab\r\né".encode(), "é\n".encode())) == [(1, "ab"), (2, "éé")]
+    with pytest.raises(importer.RowError, match="Line 2"):
+        asyncio.run(lines("ok\n".encode(), ("é" * 6 + "\n").encode())) # 6 characters, 12 bytes
+
+def test_large_content_lives_in_blob_store_and_streams_with_ranges(tmp_path):
+    from app import content_store
+    admin = auth_headers("bloboadmin")
+    db = TestingSessionLocal()
+    db.query(models.User).filter(models.User.username == "bloboadmin").one().role = models.UserRole.ADMIN
+    db.commit()
+    db.close()
+    course_id = client.post("/admin/courses", json={"title": "Blob Course", "description": "d", "price": 0, "image_url": "x"}, headers=admin).json()["id"]
+    body = "".join(f"Paragraph {i}: the mitochondrial membrane potential. " for i in range(400))
+    client.post(f"/admin/courses/{course_id}/content", json={"title": "Long read", "type": "text", "data": body}, headers=admin)
+    client.post(f"/admin/courses/{course_id}/content", json={"title": "Clip", "type": "video", "data": "https://video/1"}, headers=admin)
+
+    listing = client.get(f"/courses/{course_id}/content", headers=admin).json()
+    assert "data" not in listing[0] and listing[0]["size"] == len(body)
+    db = TestingSessionLocal()
+    stored = db.get(models.Content, listing[0]["id"])
+    assert stored.data is None and content_store.get_store().exists(stored.blob_key)
+    assert db.get(models.Content, listing[1]["id"]).data == "https://video/1" # small bodies stay inline
+    db.close()
+    assert any(hit["title"] == "Long read" for hit in client.get("/search", params={"q": "mitochondrial"}, headers=admin).json())
+
+    url = listing[0]["body_url"]
+    full = client.get(url, headers=admin)
+    assert full.text == body and full.headers["accept-ranges"] == "bytes" and "content-encoding" not in full.headers
+    etag = full.headers["etag"]
+    assert client.get(url, headers={**admin, "If-None-Match": etag}).status_code == 304
+    part = client.get(url, headers={**admin, "Range": "bytes=10-19"})
+    assert part.status_code == 206 and part.content == body.encode()[10:20]
+    assert part.headers["content-range"] == f"bytes 10-19/{len(body)}"
+    assert client.get(url, headers={**admin, "Range": "bytes=-5"}).content == body.encode()[-5:]
+    unsatisfiable = client.get(url, headers={**admin, "Range": f"bytes={len(body)}-"})
+    assert unsatisfiable.status_code == 416 and unsatisfiable.headers["content-range"] == f"bytes */{len(body)}"
+    assert client.get(url, headers={**admin, "Range": "bytes=0-4", "If-Range": '"stale"'}).status_code == 200
+    assert client.get(url, headers=auth_headers("blobstudent")).status_code == 403
+
+    # The S3 backend against its filesystem stand-in
+    s3 = content_store.S3BlobStore(content_store.LocalS3Client(str(tmp_path)), "bucket", "lessons")
+    s3.put("content/ab/abc", b"0123456789")
+    assert s3.exists("content/ab/abc") and not s3.exists("content/ab/missing")
+    assert b"".join(s3.iter_range("content/ab/abc", 3, 5)) == b"345" and s3.get("content/ab/abc") == b"0123456789"
+    with pytest.raises(content_store.BlobNotFound):
+        list(s3.iter_range("content/ab/missing", 0, None))
+
+def test_inline_content_migrates_to_blob_store():
+    from app import content_store
+    from sqlalchemy import update
+    body = "legacy inline body " * 200
+    db = TestingSessionLocal()
+    content = models.Content(course_id=1, title="Legacy", type="text", data="short")
+    db.add(content)
+    db.commit()
+    # Simulate a row written before blobs existed
+    db.execute(update(models.Content).where(models.Content.id == content.id).values(data=body, size=None, sha256=None, blob_key=None))
+    db.commit()
+    content_id = content.id
+    db.close()
+    assert content_store.migrate_inline()["bodies_moved"] == 1
+    db = TestingSessionLocal()
+    migrated = db.get(models.Content, content_id)
+    assert migrated.data is None and migrated.size == len(body) and content_store.body_text(migrated) == body
+    db.close()
+
+def test_notes_delta_sync_with_tombstones_and_batched_mutations():
+    headers = auth_headers("syncuser")
+    first = client.post("/notes", json={"title": "One", "content": "a"}, headers=headers).json()
+    second = client.post("/notes", json={"title": "Two", "content": "b"}, headers=headers).json()
+    assert first["version"] == 1
+    snapshot = client.get("/notes/sync", headers=headers).json()
+    assert [n["id"] for n in snapshot["notes"]] == [first["id"], second["id"]] and snapshot["deleted"] == []
+    cursor = snapshot["cursor"]
+    assert client.get("/notes/sync", params={"since": cursor}, headers=headers).json()["notes"] == []
+
+    # Another device edits and deletes; the next sync carries only those changes
+    client.put(f"/notes/{first['id']}", json={"title": "One!", "content": "a2"}, headers=headers)
+    client.delete(f"/notes/{second['id']}", headers=headers)
+    delta = client.get("/notes/sync", params={"since": cursor}, headers=headers).json()
+    assert [(n["id"], n["version"]) for n in delta["notes"]] == [(first["id"], 2)]
+    assert delta["deleted"] == [second["id"]]
+    cursor = delta["cursor"]
+
+    batch = {"since": cursor, "mutations": [
+        {"op": "create", "client_id": "offline-1", "title": "Offline", "content": "c"},
+        {"op": "update", "id": first["id"], "version": 1, "content": "stale edit"},
+        {"op": "update", "id": first["id"], "version": 2, "content": "fresh edit"},
+        {"op": "delete", "id": second["id"], "version": 1},
+    ]}
+    reply = client.post("/notes/sync", json=batch, headers=headers).json()
+    assert [r["status"] for r in reply["results"]] == ["applied", "conflict", "applied", "not_found"]
+    assert reply["results"][1]["note"]["content"] == "fresh edit" # the server copy to merge with
+    created_id = reply["results"][0]["id"]
+    assert {n["id"]: n["content"] for n in reply["notes"]} == {first["id"]: "fresh edit", created_id: "c"}
+
+    # Replaying the same batch after a lost response doesn't duplicate the offline note
+    replay = client.post("/notes/sync", json=batch, headers=headers).json()
+    assert replay["results"][0]["id"] == created_id
+    assert len(client.get("/notes", headers=headers).json()) == 2
+
+    # Other users' notes are invisible; bad cursors and malformed mutations are rejected
+    assert client.post("/notes/sync", json={"mutations": [{"op": "delete", "id": created_id, "version": 1}]}, headers=auth_headers("syncother")).json()["results"][0]["status"] == "not_found"
+    assert client.get("/notes/sync", params={"since": "garbage"}, headers=headers).status_code == 400
+    assert client.post("/notes/sync", json={"mutations": [{"op": "update", "id": 1}]}, headers=headers).status_code == 422
+
+def test_notes_sync_pages_through_changes():
+    headers = auth_headers("syncpager")
+    ids = [client.post("/notes", json={"title": f"n{i}", "content": "x"}, headers=headers).json()["id"] for i in range(5)]
+    seen, cursor, has_more = [], None, True
+    while has_more:
+        page = client.get("/notes/sync", params={"limit": 2, **({"since": cursor} if cursor else {})}, headers=headers).json()
+        seen += [n["id"] for n in page["notes"]]
+        cursor, has_more = page["cursor"], page["has_more"]
+    assert seen == ids
+
+def test_async_chat_runs_as_a_job_and_long_polls():
+    headers = auth_headers("jobuser")
+    queued = client.post("/llm/chat", params={"mode": "async"}, json={"message": "Explain heaps", "topic": "Algo"}, headers=headers)
+    assert queued.status_code == 202
+    job = queued.json()
+    assert job["status"] == "queued" and queued.headers["location"] == job["status_url"]
+    # The user's turn is stored straight away; the reply comes from the worker
+    history = client.get(f"/llm/sessions/{job['session_id']}/messages", headers=headers).json()
+    assert [m["role"] for m in history] == ["user"]
+    assert client.get(job["status_url"], headers=auth_headers("jobsnoop")).status_code == 404
+
+    started = time.monotonic()
+    assert client.get(job["status_url"], params={"wait": 0.3}, headers=headers).json()["status"] == "queued"
+    assert time.monotonic() - started >= 0.3
+
+    assert asyncio.run(jobs.drain(jobs.get_queue())) == 1
+    done = client.get(job["status_url"], params={"wait": 5}, headers=headers).json()
+    assert done["status"] == "done" and done["attempts"] == 1
+    reply = done["result"]["message"]
+    history = client.get(f"/llm/sessions/{job['session_id']}/messages", headers=headers).json()
+    assert [m["role"] for m in history] == ["ai", "user"] and history[0]["id"] == reply["id"] # newest first
+
+def test_chat_jobs_store_one_reply_and_an_error_reply_on_final_failure(monkeypatch):
+    headers = auth_headers("jobretry")
+    queue = jobs.get_queue()
+    job = client.post("/llm/chat", params={"mode": "async"}, json={"message": "Explain tries", "topic": "Algo"}, headers=headers).json()
+    assert asyncio.run(jobs.drain(queue)) == 1
+    # Redelivery after the reply was stored (lease lost before complete) reuses that reply
+    claimed = queue.get(job["id"])
+    assert asyncio.run(llm.run_chat_job(claimed)) == queue.get(job["id"])["result"]
+    history = client.get(f"/llm/sessions/{job['session_id']}/messages", headers=headers).json()
+    assert [m["role"] for m in history] == ["ai", "user"]
+
+    async def broken(history):
+        raise RuntimeError("upstream down")
+    monkeypatch.setattr(llm_providers, "generate", broken)
+    monkeypatch.setattr(jobs, "RETRY_BASE_SECONDS", 0)
+    failing = client.post("/llm/chat", params={"mode": "async"}, json={"message": "Explain heaps again", "session_id": job["session_id"]}, headers=headers).json()
+    asyncio.run(jobs.drain(queue))
+    assert queue.get(failing["id"])["status"] == "failed"
+    history = client.get(f"/llm/sessions/{job['session_id']}/messages", headers=headers).json()
+    assert [m["role"] for m in history] == ["ai", "user", "ai", "user"]
+    assert history[0]["content"] == "Error communicating with Gemini: upstream down"
+
+    # A last attempt whose worker died is failed by the next claimer, with the same error reply
+    lost = client.post("/llm/chat", params={"mode": "async"}, json={"message": "Explain graphs", "session_id": job["session_id"]}, headers=headers).json()
+    queue._write(lambda conn: conn.execute("UPDATE jobs SET max_attempts = 1 WHERE id = ?", (lost["id"],)))
+    queue.claim("dead-worker", lease_seconds=-1)
+    asyncio.run(jobs.drain(queue))
+    assert queue.get(lost["id"])["error"] == "Lease expired after the last attempt"
+    history = client.get(f"/llm/sessions/{job['session_id']}/messages", headers=headers).json()
+    assert history[0]["content"] == "Error communicating with Gemini: Lease expired after the last attempt"
+
+def test_job_queue_priority_leases_and_retries(tmp_path, monkeypatch):
+    queue = jobs.JobQueue(str(tmp_path / "jobs.db"))
+    low = queue.enqueue("chat_reply", {}, priority=0)
+    high = queue.enqueue("chat_reply", {}, priority=10, max_attempts=2)
+    later = queue.enqueue("chat_reply", {}, priority=99, delay=60)
+    assert queue.claim("w1")["id"] == high # priority first; delayed jobs wait their turn
+    assert queue.claim("w2")["id"] == low
+    assert queue.claim("w3") is None
+
+    # Only the lease holder can finish a job; failures go back to the queue with backoff
+    assert not queue.complete(high, "w2", {"ok": True})
+    assert queue.fail(high, "w1", "boom", retry_after=0) == "queued"
+    again = queue.claim("w3")
+    assert again["id"] == high and again["attempts"] == 2 and again["error"] == "boom"
+    assert queue.fail(high, "w3", "boom again") == "failed"
+
+    # A worker that dies mid-job: its lease lapses and another worker takes over
+    assert queue.extend(low, "w2", lease_seconds=-1)
+    retaken = queue.claim("w4")
+    assert retaken["id"] == low and retaken["attempts"] == 2
+    assert not queue.extend(low, "w2") and queue.complete(low, "w4", {"ok": True})
+    assert queue.get(low)["result"] == {"ok": True} and queue.get(later)["status"] == "queued"
+    assert queue.stats() == {"queued": 1, "running": 0, "done": 1, "failed": 1}
+
+    # Handler errors are retried by the worker until one attempt succeeds
+    monkeypatch.setattr(jobs, "HANDLERS", {"flaky": f"{__name__}:_flaky_job"})
+    monkeypatch.setattr(jobs, "RETRY_BASE_SECONDS", 0)
+    flaky = queue.enqueue("flaky", {"fail_times": 1})
+    assert asyncio.run(jobs.drain(queue)) == 2
+    assert queue.get(flaky)["status"] == "done" and queue.get(flaky)["result"] == {"calls": 2}
+
+_flaky_calls = []
+
+async def _flaky_job(job):
+    _flaky_calls.append(job["id"])
+    if len(_flaky_calls) <= job["payload"]["fail_times"]:
+        raise RuntimeError("transient")
+    return {"calls": len(_flaky_calls)}
+
+def test_cancelled_slot_release_keeps_local_slot_and_returns_lease(monkeypatch):
+    from app import shared_state
+    state = shared_state.LocalState()
+    monkeypatch.setattr(shared_state, "_state", state)
+    slow_release = state.release
+    monkeypatch.setattr(state, "release", lambda name, holder: (time.sleep(0.1), slow_release(name, holder)))
+    limiter = llm_providers.ConcurrencyLimiter(max_concurrency=1, max_queue=0, global_max_concurrency=1, global_wait=0.5)
+
+    async def scenario():
+        async def hold():
+            async with limiter.slot():
+                await asyncio.sleep(10)
+        task = asyncio.create_task(hold())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.sleep(0.01)
+        task.cancel() # a second cancellation lands while the lease is being released
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert limiter.in_flight == 0 and not limiter._get_semaphore().locked()
+        async with limiter.slot(): # lease came back too, or this would time out with 503
+            pass
+
+    asyncio.run(scenario())
+
+def test_metrics_are_summed_across_worker_snapshots(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "MULTIPROC_DIR", str(tmp_path))
+    counter = metrics.HTTP_REQUESTS
+    key = ("GET", "/multiproc", "200")
+    here = counter.snapshot().get(key, 0)
+    # Another live worker (our parent stands in for it) and one that has exited
+    other = {"http_requests_total": [[list(key), 5]], "http_requests_in_flight": [[[], 2]]}
+    (tmp_path / f"{os.getppid()}.json").write_text(json.dumps(other))
+    exited = {"http_requests_total": [[list(key), 7]], "http_requests_in_flight": [[[], 9]]}
+    (tmp_path / "999999999.json").write_text(json.dumps(exited))
+
+    line = 'http_requests_total{method="GET",route="/multiproc",status="200"}'
+    body = metrics.render()
+    assert f"{line} {here + 12}" in body
+    assert not (tmp_path / "999999999.json").exists() # folded into the archive
+    in_flight = metrics.HTTP_IN_FLIGHT.snapshot().get((), 0)
+    assert f"http_requests_in_flight {in_flight + 2}" in body # the exited worker's gauge is gone
+    assert f"{line} {here + 12}" in metrics.render() # and its counts aren't added twice
+
+def test_shared_versions_are_cached_briefly_per_process(tmp_path, monkeypatch):
+    from app import shared_state
+    path = str(tmp_path / "state.db")
+    ours, other_worker = shared_state.SQLiteState(path), shared_state.SQLiteState(path)
+    assert ours.cached_version("principals") == 0
+    other_worker.bump("principals")
+    assert ours.cached_version("principals") == 0 # served from the per-process cache
+    assert ours.bump("principals") == 2 and ours.cached_version("principals") == 2 # own writes show at once
+    other_worker.set("principal_changed:x", "1")
+    assert ours.cached_get("principal_changed:x", max_age=0) == "1"
+    other_worker.bump("principals")
+    monkeypatch.setattr(shared_state, "CACHE_SECONDS", 0)
+    ours._read_cache.clear()
+    assert ours.cached_version("principals") == 3
+
+def test_retrieval_rebuild_keeps_other_workers_delta_and_serialises_builds(tmp_path, monkeypatch):
+    import fcntl
+    path = str(tmp_path / "index")
+    ours, other_worker = retrieval.RetrievalIndex(path), retrieval.RetrievalIndex(path)
+    scan = retrieval._iter_db_chunks
+
+    def scan_while_other_worker_appends(db, seen=None, batch=200):
+        yield from scan(db, seen, batch)
+        # Lands after the scan, as a commit in another worker would
+        other_worker.add_contents([
+            models.Content(id=10**7, course_id=777, title="Comets", type="text", data="comet tails point away from the sun"),
+            db.query(models.Content).filter(models.Content.type == "text").first(), # the scan already has this one
+        ])
+
+    monkeypatch.setattr(retrieval, "_iter_db_chunks", scan_while_other_worker_appends)
+    db = TestingSessionLocal()
+    try:
+        assert ours.rebuild(db)
+        # The other worker's chunk, which `ours` never had in memory, survives the swap
+        assert [chunk["content_id"] for chunk, _, _ in ours.delta] == [10**7]
+        assert retrieval.RetrievalIndex(path).search("comet tails", [777])[0]["content_id"] == 10**7
+        # While another process builds, a background compaction steps aside instead of racing it
+        with open(os.path.join(path, ".build.lock"), "a") as held:
+            fcntl.flock(held, fcntl.LOCK_EX)
+            assert not ours.rebuild(db, wait=False)
+    finally:
+        db.close()
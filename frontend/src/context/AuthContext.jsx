@@ -1,5 +1,6 @@
 import React, { createContext, useState, useEffect, useContext } from 'react';
 import api from '../services/api';
+import { clearPending } from '../services/pendingNotes';
 
 const AuthContext = createContext();
 
@@ -48,6 +49,8 @@ export const AuthProvider = ({ children }) => {
 
     const logout = () => {
         localStorage.removeItem('token');
+        // Unsynced note edits belong to this account; don't leave them for the next one
+        if (user) clearPending(user.id);
         setUser(null);
     };
 
@@ -8,6 +8,8 @@ const CourseViewer = () => {
     const [contents, setContents] = useState([]);
     const [loading, setLoading] = useState(true);
     const [currentContent, setCurrentContent] = useState(null);
+    const [body, setBody] = useState('');
+    const [bodyLoading, setBodyLoading] = useState(false);
 
     useEffect(() => {
         const fetchContent = async () => {
@@ -27,6 +29,27 @@ const CourseViewer = () => {
         fetchContent();
     }, [courseId]);
 
+    // The listing only carries metadata; bodies are fetched on demand
+    useEffect(() => {
+        if (!currentContent) return;
+        let cancelled = false;
+        const fetchBody = async () => {
+            setBodyLoading(true);
+            try {
+                const response = await api.get(currentContent.body_url, { responseType: 'text' });
+                if (!cancelled) setBody(response.data);
+            } catch (error) {
+                console.error("Failed to fetch content body", error);
+                if (!cancelled) setBody('');
+            } finally {
+                if (!cancelled) setBodyLoading(false);
+            }
+        };
+
+        fetchBody();
+        return () => { cancelled = true; };
+    }, [currentContent]);
+
     return (
         <div className="min-h-screen bg-premium-dark text-white flex flex-col">
             <header className="p-4 border-b border-white/10 flex items-center gap-4 bg-black/20">
@@ -66,13 +89,15 @@ const CourseViewer = () => {
                         <div className="max-w-4xl w-full">
                             <h2 className="text-3xl font-bold mb-6">{currentContent.title}</h2>
                             <div className="bg-white/5 border border-white/10 rounded-2xl p-8 min-h-[400px]">
-                                {currentContent.type === 'video' ? (
+                                {bodyLoading ? (
+                                    <div className="text-gray-400">Loading...</div>
+                                ) : currentContent.type === 'video' ? (
                                     <div className="aspect-video bg-black rounded-lg flex items-center justify-center border border-white/10">
-                                        <p className="text-gray-500">Video Player Placeholder: {currentContent.data}</p>
+                                        <p className="text-gray-500">Video Player Placeholder: {body}</p>
                                     </div>
                                 ) : (
                                     <div className="prose prose-invert max-w-none">
-                                        <p className="whitespace-pre-wrap">{currentContent.data}</p>
+                                        <p className="whitespace-pre-wrap">{body}</p>
                                     </div>
                                 )}
                             </div>
@@ -1,64 +1,101 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef, useCallback } from 'react';
 import api from '../services/api';
+import { loadPending, savePending } from '../services/pendingNotes';
+import { useAuth } from '../context/AuthContext';
 // eslint-disable-next-line no-unused-vars
 import { motion } from 'framer-motion';
 import { Plus, X, Edit, Trash2, Save } from 'lucide-react';
 import { Link } from 'react-router-dom';
 
+// Local edits are queued and sent to /notes/sync in one batch; the reply carries every
+// change since our cursor (including our own), so the list is never re-fetched wholesale.
+// A sync that fails on the network or a 5xx keeps the queue and retries when the browser is
+// back online; a batch the server rejects (4xx) is dropped and reported.
+const isRetryable = (error) => !error.response || error.response.status >= 500 || [401, 408, 429].includes(error.response.status);
+
 const Notes = () => {
+    const { user } = useAuth();
+    const userId = user?.id;
     const [notes, setNotes] = useState([]);
+    const [syncError, setSyncError] = useState(null);
     const [loading, setLoading] = useState(true);
     const [editingNote, setEditingNote] = useState(null);
     const [isCreating, setIsCreating] = useState(false);
     const [formData, setFormData] = useState({ title: '', content: '' });
+    const cursor = useRef(null);
+    const syncing = useRef(false);
 
-    useEffect(() => {
-        fetchNotes();
-    }, []);
+    const applyChanges = (changed, deleted) => {
+        setNotes(current => {
+            const byId = new Map(current.map(n => [n.id, n]));
+            deleted.forEach(id => byId.delete(id));
+            changed.forEach(n => byId.set(n.id, n));
+            return [...byId.values()].sort((a, b) => a.id - b.id);
+        });
+    };
 
-    const fetchNotes = async () => {
+    const sync = useCallback(async (mutations = []) => {
+        if (userId === undefined) return;
+        savePending(userId, [...loadPending(userId), ...mutations]);
+        if (syncing.current) return;
+        syncing.current = true;
+        let pending = [];
         try {
-            const response = await api.get('/notes');
-            setNotes(response.data);
-        } catch {
-            console.error("Failed to fetch notes");
+            let hasMore = true;
+            while (hasMore) {
+                pending = loadPending(userId);
+                const response = await api.post('/notes/sync', { since: cursor.current, mutations: pending });
+                // Anything queued while the request was in flight stays for the next round
+                savePending(userId, loadPending(userId).slice(pending.length));
+                const { notes: changed, deleted, results } = response.data;
+                const skipped = results.filter(r => r.status !== 'applied').length;
+                if (skipped) setSyncError(`${skipped} change(s) were not applied because the note was changed or deleted elsewhere; showing the latest version`);
+                applyChanges(changed, deleted);
+                cursor.current = response.data.cursor;
+                hasMore = response.data.has_more || loadPending(userId).length > 0;
+            }
+        } catch (error) {
+            if (isRetryable(error)) {
+                console.error("Failed to sync notes; changes will be retried");
+            } else {
+                savePending(userId, loadPending(userId).slice(pending.length));
+                setSyncError(`The server rejected ${pending.length} change(s): ${error.response.data?.detail ? JSON.stringify(error.response.data.detail) : error.response.status}`);
+            }
         } finally {
+            syncing.current = false;
             setLoading(false);
         }
-    };
+    }, [userId]);
+
+    useEffect(() => {
+        sync();
+        const retry = () => sync();
+        window.addEventListener('online', retry);
+        return () => window.removeEventListener('online', retry);
+    }, [sync]);
 
     const handleCreate = async (e) => {
         e.preventDefault();
-        try {
-            const response = await api.post('/notes', formData);
-            setNotes([...notes, response.data]);
-            setIsCreating(false);
-            setFormData({ title: '', content: '' });
-        } catch {
-            console.error("Failed to create note");
-        }
+        sync([{ op: 'create', client_id: crypto.randomUUID(), ...formData }]);
+        setIsCreating(false);
+        setFormData({ title: '', content: '' });
     };
 
     const handleUpdate = async (e) => {
         e.preventDefault();
-        try {
-            const response = await api.put(`/notes/${editingNote.id}`, formData);
-            setNotes(notes.map(n => n.id === editingNote.id ? response.data : n));
-            setEditingNote(null);
-            setFormData({ title: '', content: '' });
-        } catch {
-            console.error("Failed to update note");
-        }
+        // Shown (and versioned) locally straight away: the server bumps the version by one per
+        // applied update, so a second edit queued before this one syncs names the right base
+        const current = notes.find(n => n.id === editingNote.id) || editingNote;
+        setNotes(notes.map(n => n.id === current.id ? { ...n, ...formData, version: current.version + 1 } : n));
+        sync([{ op: 'update', id: current.id, version: current.version, ...formData }]);
+        setEditingNote(null);
+        setFormData({ title: '', content: '' });
     };
 
-    const handleDelete = async (id) => {
+    const handleDelete = async (note) => {
         if (!window.confirm("Are you sure?")) return;
-        try {
-            await api.delete(`/notes/${id}`);
-            setNotes(notes.filter(n => n.id !== id));
-        } catch {
-            console.error("Failed to delete note");
-        }
+        setNotes(notes.filter(n => n.id !== note.id));
+        sync([{ op: 'delete', id: note.id, version: note.version }]);
     };
 
     return (
@@ -84,6 +121,13 @@ const Notes = () => {
 
                 </header>
 
+                {syncError && (
+                    <div className="mb-6 flex justify-between items-center bg-red-500/10 border border-red-500/30 text-red-300 rounded-lg p-3">
+                        <span>{syncError}</span>
+                        <button onClick={() => setSyncError(null)} className="hover:text-white"><X className="w-4 h-4" /></button>
+                    </div>
+                )}
+
                 {(isCreating || editingNote) && (
                     <motion.div initial={{ y: -20, opacity: 0 }} animate={{ y: 0, opacity: 1 }} className="mb-8 bg-white/5 border border-white/10 rounded-2xl p-6">
                         <form onSubmit={editingNote ? handleUpdate : handleCreate} className="space-y-4">
@@ -123,7 +167,7 @@ const Notes = () => {
                                     <h3 className="text-xl font-bold truncate">{note.title}</h3>
                                     <div className="flex gap-2">
                                         <button onClick={() => { setEditingNote(note); setFormData({ title: note.title, content: note.content }); setIsCreating(false); }} className="text-gray-400 hover:text-white"><Edit className="w-4 h-4" /></button>
-                                        <button onClick={() => handleDelete(note.id)} className="text-gray-400 hover:text-red-500"><Trash2 className="w-4 h-4" /></button>
+                                        <button onClick={() => handleDelete(note)} className="text-gray-400 hover:text-red-500"><Trash2 className="w-4 h-4" /></button>
                                     </div>
                                 </div>
                                 <p className="text-gray-400 whitespace-pre-wrap line-clamp-4 flex-1">{note.content}</p>
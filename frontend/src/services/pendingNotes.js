@@ -0,0 +1,9 @@
+// Note edits not yet accepted by /notes/sync, kept in localStorage per user so a shared
+// browser never replays one account's edits as another. Cleared on logout.
+const pendingKey = (userId) => `notes.pendingMutations.${userId}`;
+
+export const loadPending = (userId) => JSON.parse(localStorage.getItem(pendingKey(userId)) || '[]');
+
+export const savePending = (userId, mutations) => localStorage.setItem(pendingKey(userId), JSON.stringify(mutations));
+
+export const clearPending = (userId) => localStorage.removeItem(pendingKey(userId));
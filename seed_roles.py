@@ -1,7 +1,7 @@
-from backend.app import models, database, auth
+from backend.app import models, database, auth, migrate, rollups
 
 def create_role_users():
-    models.Base.metadata.create_all(bind=database.engine)
+    migrate.run()
     db = database.SessionLocal()
     
     roles = [
@@ -21,6 +21,7 @@ def create_role_users():
                 role=data["role"]
             )
             db.add(user)
+            rollups.user_registered(db)
             db.commit()
             print(f"Created {data['role']} user: {data['username']} / password")
         else:
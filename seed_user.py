@@ -1,4 +1,4 @@
-from backend.app import models, database, auth
+from backend.app import models, database, auth, rollups
 import sys
 
 def create_user():
@@ -17,6 +17,7 @@ def create_user():
         hashed = auth.get_password_hash(password)
         user = models.User(username=username, email=email, hashed_password=hashed)
         db.add(user)
+        rollups.user_registered(db)
         db.commit()
         print(f"Created user: {username} / {password}")
     except Exception as e:
@@ -1,5 +1,5 @@
-from backend.app import models, database
-# This script basically just calls create_all causing new tables to be created.
-# existing tables are untouched in sqlite with create_all
-models.Base.metadata.create_all(bind=database.engine)
+from backend.app import migrate
+# Creates new tables, adds any columns/indexes missing from existing ones and the search index.
+# Same as `python -m app.migrate` from the backend directory.
+migrate.run(force=True)
 print("Database schema updated.")